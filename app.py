@@ -5,20 +5,51 @@ import os
 import subprocess
 import time
 import hashlib
+import hmac
+import gzip
 import uuid
 import psutil
 import threading
 from datetime import datetime, timedelta
-from collections import deque
+from collections import deque, OrderedDict, Counter
 import re
+import math
 import requests
 import random
 import fcntl
-import asyncio
+import codecs
+import select
+import signal
+import socket
+import mmap
+import struct
+import sqlite3
+import heapq
+import copy
+import sys
+import atexit
+import queue
+import logging
+import logging.handlers
+import itertools
+import contextvars
+from contextlib import contextmanager
 from concurrent.futures import ThreadPoolExecutor
 
+try:
+    from flask_sock import Sock
+    from simple_websocket import ConnectionClosed
+except ImportError:  # 未安装flask-sock时不提供WebSocket通道，前端自动使用HTTP接口
+    Sock = None
+
+try:
+    import brotli
+except ImportError:  # 未安装brotli时只使用gzip压缩
+    brotli = None
+
 app = Flask(__name__)
 CORS(app)
+sock = Sock(app) if Sock else None
 
 DATA_DIR = 'chat_data'
 GLOBAL_MEMORY_FILE = 'xiaobu.md'
@@ -26,13 +57,14 @@ QUESTION_FILE = 'security.md'
 PERSONA_QUESTION_FILE = 'question.md'
 MAX_CONTEXT_LENGTH = 32000  # Claude上下文最大字符数限制
 MAX_CONTEXT_PAIRS = 30     # 最大保留的对话轮数
+MAX_TRACKED_CLIENTS = 1000  # 最多跟踪的客户端情绪分片数，超出后按最近使用淘汰
+EMOTION_SHARD_STRIPES = 16  # 客户端情绪分片的分段锁数量
+CLIENT_EMOTION_WEIGHT = 0.7  # 情绪合成时客户端分量的权重，其余来自全局分量
 
 # 服务状态监控配置
 SERVICE_STATUS = {
     'status': 'running',
     'start_time': datetime.now().isoformat(),
-    'request_count': 0,
-    'error_count': 0,
     'last_request_time': None,
     'cpu_usage': 0.0,
     'memory_usage': 0.0,
@@ -40,7 +72,18 @@ SERVICE_STATUS = {
 }
 
 # 情绪分析配置
-EMOTION_HISTORY = deque(maxlen=100)
+EMOTION_RING_FILE = os.path.join(DATA_DIR, 'emotion_history.ring')  # 持久化情绪记录环形缓冲区
+EMOTION_RING_CAPACITY = max(1, int(os.environ.get('XIAOBU_EMOTION_RING_CAPACITY', 100000)))  # 最多保留的情绪记录数
+EMOTION_RING_SLACK = 1024  # 超出容量额外保留的槽位，供其他进程补发淘汰记录时读取
+EMOTION_ROLLUPS = {  # 情绪汇总分辨率: (桶宽秒数, 保留桶数)
+    'minute': (60, 24 * 60),     # 保留1天
+    'hour': (3600, 24 * 30),     # 保留30天
+    'day': (86400, 365),         # 保留1年
+}
+MAX_RANGE_BUCKETS = 5000  # 区间查询最多扫描的汇总桶数
+EMOTION_ROLLUP_FILE = os.path.join(DATA_DIR, 'emotion_rollups.json')  # 持久化的情绪汇总桶
+EMOTION_ROLLUP_SAVE_INTERVAL = 60  # 后台线程把汇总桶写盘的间隔（秒）
+CONFIDENCE_SCALE = 10000  # 统计桶中置信度按万分之一存为整数，移出记录时精确抵消
 EMOTION_KEYWORDS = {
     'happy': ['开心', '高兴', '快乐', '愉快', '兴奋', '棒', '好', '喜欢', '满意', '赞'],
     'sad': ['难过', '伤心', '悲伤', '失望', '沮丧', '糟糕', '不好', '痛苦', '遗憾'],
@@ -58,14 +101,85 @@ XIAOBU_STATE = {
     'sentiment_factor': 0,  # 情感影响因子
     'time_factor': 0,  # 时间因子（基于作息时间）
     'adolescent_factor': 0,  # 青春期随机因子
-    'last_weather_update': None,
-    'chat_frequency': deque(maxlen=50),  # 记录最近50次聊天时间
-    'weather_cache': None,
-    'weather_cache_time': None,
     'last_mood_swing': None,  # 上次情绪波动时间
     'current_hormonal_state': 'normal',  # 当前荷尔蒙状态
     'stress_level': 0,  # 压力等级 (0-100)
 }
+XIAOBU_STATE_LOCK = threading.Lock()  # 保护青春期情绪波动等共享状态
+ADOLESCENT_FACTOR_WINDOW = 300  # 青春期波动因子和作息情绪中的随机抽签每个时间窗（秒）只做一次，窗内复用
+ADOLESCENT_CACHE = {'window': None, 'result': None}  # 当前时间窗的(因子, 原因)
+
+# 多进程共享状态配置（gunicorn等多worker部署时开启）
+SHARED_STATE_ENABLED = os.environ.get('XIAOBU_SHARED_STATE', '0') == '1'
+SHARED_STATE_FILE = os.path.join(DATA_DIR, 'shared_state.db')  # 计数器、聊天频率和情绪波动状态
+SHARED_STATE_TIMEOUT = 5  # 等待数据库写锁的秒数
+COST_LEDGER_FILE = os.path.join(DATA_DIR, 'cost_ledger.db')  # Claude调用费用账本（开启共享状态时并入共享数据库）
+COST_LEDGER_RETENTION_DAYS = int(os.environ.get('XIAOBU_COST_LEDGER_DAYS', 90))  # 账本保留天数
+COST_USAGE_SAMPLE_INTERVAL = 0.25  # 异步模式下用psutil采样Claude进程资源的间隔（秒）
+SHARED_STATE_POLL_INTERVAL = 1  # 跟进其他进程写入的情绪记录的间隔（秒）
+CANCEL_POLL_INTERVAL = 0.5  # 读取其他worker转来的取消命令的间隔（秒）
+CANCEL_FORWARD_TTL = 120  # 转发的取消命令保留时长（秒），对应请求已结束或从未出现时到期清理
+
+# Claude调用超时（秒）
+CLAUDE_TIMEOUT = 30
+
+# 限流与Claude并发调度配置
+RATE_LIMIT_BURST = int(os.environ.get('XIAOBU_RATE_LIMIT_BURST', 5))  # 每个客户端令牌桶容量（允许的突发请求数）
+RATE_LIMIT_PER_MINUTE = float(os.environ.get('XIAOBU_RATE_LIMIT_PER_MINUTE', 12))  # 令牌补充速度（每分钟）
+LLM_SLOTS = int(os.environ.get('XIAOBU_LLM_SLOTS', 4))  # 本进程同时进行的Claude调用数
+LLM_QUEUE_TIMEOUT = 60  # 排队等待Claude调用名额的最长时间（秒）
+LLM_MAX_QUEUED_PER_CLIENT = 3  # 每个客户端最多排队的请求数，超出直接拒绝
+# 后台隐私分析共用一个调度队列，按较低权重与聊天请求轮流分配名额
+PRIVACY_ANALYSIS_QUEUE = 'background:privacy'
+PRIVACY_ANALYSIS_WEIGHT = 0.25
+DISCONNECT_CHECK_INTERVAL = 0.5  # Claude调用期间探测客户端是否断开的间隔（秒）
+
+# HTTP条件请求与压缩配置
+COMPRESS_MIN_SIZE = 1024  # 小于该字节数的响应不压缩
+COMPRESS_LEVEL = 6  # 动态响应的gzip压缩级别，预压缩的静态页面使用最高级别
+COMPRESSIBLE_TYPES = ('application/json', 'text/html', 'text/plain', 'text/markdown')
+
+# WebSocket通道配置
+WS_CHAT_WORKERS = 16  # 处理WebSocket聊天请求的线程数
+WS_OUTBOX_SIZE = 1000  # 每个连接最多积压的待发送帧数，超出视为慢客户端并断开
+
+# 系统指标采样配置
+METRICS_SAMPLE_INTERVAL = 5  # 系统指标采样间隔（秒）
+METRICS_HISTORY_SECONDS = 15 * 60  # 保留的采样历史时长，用于计算1/5/15分钟平均值
+TRACING_ENABLED = os.environ.get('XIAOBU_TRACING', '1') == '1'  # 是否记录聊天请求的分阶段追踪
+TRACE_RECENT_LIMIT = 100  # 保留最近的追踪数
+TRACE_SLOWEST_LIMIT = 20  # 另外保留耗时最长的追踪数
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)  # 耗时直方图分桶（秒）
+
+# 日志配置
+LOG_LEVEL = os.environ.get('XIAOBU_LOG_LEVEL', 'INFO').upper()
+LOG_SAMPLE_RATE = float(os.environ.get('XIAOBU_LOG_SAMPLE_RATE', 1.0))  # 按客户端采样的比例（只作用于INFO及以下级别）
+LOG_REDACT = os.environ.get('XIAOBU_LOG_REDACT', '1') == '1'  # 日志中隐去用户消息、回复和问题原文
+LOG_QUEUE_SIZE = 10000  # 等待写出的日志条数上限，超出时丢弃并计数
+
+# 采样分析配置
+ADMIN_TOKEN = os.environ.get('XIAOBU_ADMIN_TOKEN', '')  # 管理接口口令，未设置时管理接口全部关闭
+PROFILE_DEFAULT_SECONDS = 5  # 默认采样时长（秒）
+PROFILE_MAX_SECONDS = 60  # 单次采样时长上限（秒）
+PROFILE_DEFAULT_RATE = 100  # 默认每秒采样次数
+PROFILE_MAX_RATE = 1000  # 每秒采样次数上限
+PROFILE_TOP_FUNCTIONS = 50  # 函数汇总中返回的条数
+
+# 实时推送配置
+SSE_SUBSCRIBER_BUFFER = 100  # 每个订阅者最多积压的事件数，超出视为慢消费者并断开
+SSE_HEARTBEAT_INTERVAL = 15  # 无事件时发送心跳的间隔（秒），用于发现已断开的连接
+SSE_REPLAY_BUFFER = 256  # 每个主题保留的最近事件数，断线重连时按Last-Event-ID补发
+STATUS_PUSH_INTERVAL = 5  # 服务状态推送间隔（秒）
+EMOTION_PUSH_INTERVAL = 10  # 小布情绪快照重新计算的间隔（秒），只在有变化时推送
+
+# 天气数据源配置
+WEATHER_PROVIDER = os.environ.get('XIAOBU_WEATHER_PROVIDER', 'file')  # static / file / http
+WEATHER_FILE = os.environ.get('XIAOBU_WEATHER_FILE', 'weather_stub.json')  # 本地天气数据文件（离线替身）
+WEATHER_API_URL = os.environ.get('XIAOBU_WEATHER_API_URL', '')  # 返回天气JSON的HTTP接口
+WEATHER_REFRESH_INTERVAL = 900  # 天气数据刷新间隔（秒）
+WEATHER_MAX_STALE = 6 * 3600  # 超过该时长的旧数据不再使用（秒）
+WEATHER_HTTP_TIMEOUT = (2, 3)  # HTTP请求的(连接, 读取)超时预算（秒）
+WEATHER_COLD_WAIT = 0.5  # 冷启动时请求路径最多等待首次刷新的时长（秒）
 
 # 初中生作息时间表
 DAILY_SCHEDULE = {
@@ -175,6 +289,132 @@ EMOTION_EMOJIS = {
     'confused': '😕'
 }
 
+class JsonLogFormatter(logging.Formatter):
+    """每条日志输出为一行JSON"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'event': record.getMessage(),
+            'pid': record.process,
+            'thread': record.threadName
+        }
+        if getattr(record, 'client_id', None):
+            entry['client_id'] = record.client_id[:8]
+        if getattr(record, 'trace_id', None):
+            entry['trace_id'] = record.trace_id
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ClientLogSampler(logging.Filter):
+    """按客户端确定性采样：同一客户端的日志要么全部保留要么全部丢弃，WARNING及以上始终保留"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        client_id = getattr(record, 'client_id', None)
+        if self.rate >= 1 or record.levelno >= logging.WARNING or not client_id:
+            return True
+        return int(hashlib.md5(client_id[:8].encode()).hexdigest()[:8], 16) / 0xFFFFFFFF < self.rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """把日志非阻塞地放入队列，由独立的写出线程格式化并写到标准输出
+
+    请求线程只做一次入队，不会阻塞在管道写入上；队列满时丢弃并计数。
+    写出线程在首次写日志时启动，fork后的子进程中会重新启动。
+    """
+
+    def __init__(self, log_queue, target):
+        super().__init__(log_queue)
+        self.target = target
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._listener = logging.handlers.QueueListener(self.queue, self.target)
+                self._listener.start()
+                self._pid = os.getpid()
+
+    def prepare(self, record):
+        # 只在请求线程中展开消息参数，JSON格式化留给写出线程
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        """进程退出前写出队列中剩余的日志"""
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._pid = None
+
+    def stats(self):
+        return {
+            'level': logging.getLevelName(logger.level),
+            'sample_rate': LOG_SAMPLE_RATE,
+            'redact': LOG_REDACT,
+            'queued': self.queue.qsize(),
+            'dropped': self.dropped
+        }
+
+
+CURRENT_SPAN = contextvars.ContextVar('current_span', default=None)  # 当前追踪span，日志用它关联trace_id
+
+log_output = logging.StreamHandler(sys.stdout)
+log_output.setFormatter(JsonLogFormatter())
+LOG_HANDLER = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE), log_output)
+LOG_HANDLER.addFilter(ClientLogSampler(LOG_SAMPLE_RATE))
+logger = logging.getLogger('xiaobu')
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+logger.addHandler(LOG_HANDLER)
+atexit.register(LOG_HANDLER.stop)
+
+def log_event(level, event, client_id=None, **fields):
+    """记录一条结构化日志：event为简短的事件描述，其余关键字参数作为JSON字段输出"""
+    if not logger.isEnabledFor(level):
+        return
+    span = CURRENT_SPAN.get()
+    if client_id is None and span is not None:
+        # 后台线程等未传入客户端的日志沿用所在追踪的客户端，保证同一请求的日志一起采样
+        client_id = span.trace.root.attrs.get('client_id')
+    logger.log(level, event, extra={
+        'client_id': client_id,
+        'trace_id': span.trace.trace_id if span else None,
+        'fields': fields
+    })
+
+def redact(text):
+    """日志中代替用户消息、回复等原文：只保留长度和摘要，关闭脱敏时保留前100字符"""
+    if text is None:
+        return None
+    if not LOG_REDACT:
+        return text[:100]
+    return f'<{len(text)}字符 #{hashlib.sha1(text.encode()).hexdigest()[:8]}>'
+
 def ensure_data_dir():
     if not os.path.exists(DATA_DIR):
         os.makedirs(DATA_DIR)
@@ -192,7 +432,7 @@ def ensure_question_file():
         
         with open(QUESTION_FILE, 'w', encoding='utf-8') as f:
             f.write(initial_content)
-        print(f"创建安全问题文件: {QUESTION_FILE}")
+        log_event(logging.INFO, '创建安全问题文件', file=QUESTION_FILE)
 
 def ensure_persona_question_file():
     """确保question.md文件存在"""
@@ -207,35 +447,173 @@ def ensure_persona_question_file():
         
         with open(PERSONA_QUESTION_FILE, 'w', encoding='utf-8') as f:
             f.write(initial_content)
-        print(f"创建人设问题文件: {PERSONA_QUESTION_FILE}")
+        log_event(logging.INFO, '创建人设问题文件', file=PERSONA_QUESTION_FILE)
+
+DEFAULT_WEATHER = {
+    'temperature': 22,  # 温度
+    'humidity': 65,     # 湿度
+    'condition': 'cloudy',  # 天气状况: sunny, cloudy, rainy, snowy
+    'air_quality': 85,  # 空气质量指数
+    'comfort_index': 75  # 舒适度指数
+}
+
+def normalize_weather(data):
+    """校验并规整天气数据，缺失字段使用默认值"""
+    if not isinstance(data, dict):
+        raise ValueError(f"天气数据格式错误: {type(data).__name__}")
+    weather = dict(DEFAULT_WEATHER)
+    for key in ('temperature', 'humidity', 'air_quality', 'comfort_index'):
+        if key in data:
+            value = data[key]
+            weather[key] = value if isinstance(value, (int, float)) else float(value)
+    if 'condition' in data:
+        weather['condition'] = str(data['condition'])
+    return weather
+
+
+class StaticWeatherProvider:
+    """固定天气数据"""
+
+    name = 'static'
+
+    def fetch(self):
+        return dict(DEFAULT_WEATHER)
+
+
+class FileWeatherProvider:
+    """从本地JSON文件读取天气数据，用于离线开发和测试"""
+
+    name = 'file'
+
+    def __init__(self, path):
+        self.path = path
+
+    def fetch(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return normalize_weather(json.load(f))
+
+
+class HttpWeatherProvider:
+    """通过连接池复用的HTTP会话请求天气接口"""
+
+    name = 'http'
+
+    def __init__(self, url, timeout=WEATHER_HTTP_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch(self):
+        response = self.session.get(self.url, timeout=self.timeout)
+        response.raise_for_status()
+        return normalize_weather(response.json())
+
+
+class WeatherService:
+    """后台刷新的天气服务
+
+    请求路径只读取缓存；数据超过刷新间隔时立即返回旧数据并唤醒后台线程重新获取
+    （stale-while-revalidate），超过最大陈旧时长的数据不再使用。
+    """
+
+    def __init__(self, provider, refresh_interval=WEATHER_REFRESH_INTERVAL,
+                 max_stale=WEATHER_MAX_STALE):
+        self.provider = provider
+        self.refresh_interval = refresh_interval
+        self.max_stale = max_stale
+        self._data = None
+        self._fetched_at = None
+        self._last_error = None
+        self.version = 0  # 天气数据内容变化时递增，供ETag使用
+        self._refresh_count = 0
+        self._failure_count = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._ready = threading.Event()
+
+    def refresh(self):
+        """从数据源获取一次天气数据，失败时保留旧数据"""
+        try:
+            data = self.provider.fetch()
+            with self._lock:
+                if data != self._data:
+                    self.version += 1
+                self._data = data
+                self._fetched_at = time.time()
+                self._last_error = None
+                self._refresh_count += 1
+        except Exception as e:
+            with self._lock:
+                self._last_error = str(e)
+                self._failure_count += 1
+            log_event(logging.WARNING, '获取天气信息失败', error=str(e))
+        finally:
+            self._ready.set()
+
+    def _run(self):
+        while True:
+            self.refresh()
+            self._wakeup.wait(self.refresh_interval)
+            self._wakeup.clear()
+
+    def start(self):
+        """启动后台刷新线程（重复调用无副作用）"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def get(self):
+        """返回缓存的天气数据，不会阻塞在网络请求上"""
+        self.start()
+        if not self._ready.is_set():
+            self._ready.wait(WEATHER_COLD_WAIT)
+        with self._lock:
+            data, fetched_at = self._data, self._fetched_at
+        if data is None:
+            return None
+        age = time.time() - fetched_at
+        if age > self.refresh_interval:
+            self._wakeup.set()
+        if age > self.max_stale:
+            return None
+        return data
+
+    def status(self):
+        with self._lock:
+            return {
+                'provider': self.provider.name,
+                'configured_provider': WEATHER_PROVIDER,  # 与provider不同时说明配置不完整，已退回静态数据
+                'age_seconds': round(time.time() - self._fetched_at, 1) if self._fetched_at else None,
+                'refresh_count': self._refresh_count,
+                'failure_count': self._failure_count,
+                'last_error': self._last_error
+            }
+
+
+def create_weather_provider():
+    """根据配置创建天气数据源，配置不完整或无法识别时退回静态数据并记录警告"""
+    if WEATHER_PROVIDER == 'http':
+        if WEATHER_API_URL:
+            return HttpWeatherProvider(WEATHER_API_URL)
+        log_event(logging.WARNING, '天气数据源为http但未设置XIAOBU_WEATHER_API_URL，使用静态天气数据')
+    elif WEATHER_PROVIDER == 'file':
+        return FileWeatherProvider(WEATHER_FILE)
+    elif WEATHER_PROVIDER != 'static':
+        log_event(logging.WARNING, '未知的天气数据源，使用静态天气数据', provider=WEATHER_PROVIDER)
+    return StaticWeatherProvider()
+
+
+WEATHER = WeatherService(create_weather_provider())
 
 def get_wuhan_weather():
-    """获取武汉天气信息"""
-    try:
-        # 如果缓存有效（15分钟内），直接返回缓存
-        if (XIAOBU_STATE['weather_cache'] and 
-            XIAOBU_STATE['weather_cache_time'] and
-            (datetime.now() - XIAOBU_STATE['weather_cache_time']).total_seconds() < 900):
-            return XIAOBU_STATE['weather_cache']
-        
-        # 使用免费天气API (OpenWeatherMap或其他)
-        # 这里使用一个简化的天气模拟，实际使用时需要替换为真实API
-        weather_data = {
-            'temperature': 22,  # 温度
-            'humidity': 65,     # 湿度
-            'condition': 'cloudy',  # 天气状况: sunny, cloudy, rainy, snowy
-            'air_quality': 85,  # 空气质量指数
-            'comfort_index': 75  # 舒适度指数
-        }
-        
-        # 更新缓存
-        XIAOBU_STATE['weather_cache'] = weather_data
-        XIAOBU_STATE['weather_cache_time'] = datetime.now()
-        
-        return weather_data
-    except Exception as e:
-        print(f"获取天气信息失败: {e}")
-        return None
+    """获取武汉天气信息（读取后台刷新的缓存）"""
+    return WEATHER.get()
 
 def calculate_weather_factor():
     """计算天气对情绪的影响因子"""
@@ -274,20 +652,650 @@ def calculate_weather_factor():
     
     return max(-20, min(20, factor))  # 限制在-20到20之间
 
-def calculate_chat_load_factor():
-    """计算聊天负载对情绪的影响因子"""
-    now = datetime.now()
-    recent_chats = XIAOBU_STATE['chat_frequency']
-    
-    if len(recent_chats) < 2:
+CLAUDE_COSTS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS claude_costs (
+        hour TEXT NOT NULL, client_id TEXT NOT NULL, purpose TEXT NOT NULL,
+        calls INTEGER NOT NULL, failures INTEGER NOT NULL,
+        prompt_chars INTEGER NOT NULL, response_chars INTEGER NOT NULL,
+        wall_seconds REAL NOT NULL, cpu_seconds REAL NOT NULL, max_rss_kb INTEGER NOT NULL,
+        PRIMARY KEY (hour, client_id, purpose));
+"""
+
+class SQLiteStore:
+    """多进程共用的SQLite数据库
+
+    数据库使用WAL模式，读不阻塞写；每个线程（及fork后的进程）使用独立连接，首次连接时建表。
+    """
+
+    SCHEMA = ''
+
+    def __init__(self, path, schema=None):
+        self.path = path
+        self.schema = self.SCHEMA if schema is None else schema
+        self._local = threading.local()
+
+    def _initialize(self, conn):
+        conn.executescript(self.schema)
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=SHARED_STATE_TIMEOUT, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._initialize(conn)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            self._local.depth = 0
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """跨进程互斥的写事务，可嵌套（内层并入外层事务）"""
+        conn = self.connection()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        self._local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+        finally:
+            self._local.depth = 0
+
+
+class SharedState(SQLiteStore):
+    """基于SQLite的跨进程共享状态
+
+    同一台机器上的多个worker进程通过同一个数据库文件共享原子计数器、键值状态和聊天频率分桶，
+    费用账本也存放在这里。
+    """
+
+    scope = 'lifetime'  # 计数器保存在数据库中，跨重启和部署累计
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS chat_rate (
+            scope TEXT NOT NULL, resolution INTEGER NOT NULL, slot INTEGER NOT NULL, count INTEGER NOT NULL,
+            PRIMARY KEY (scope, resolution, slot));
+        CREATE TABLE IF NOT EXISTS rate_buckets (client_id TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS cancels (
+            client_id TEXT NOT NULL, request_id TEXT NOT NULL, reason TEXT NOT NULL, created REAL NOT NULL,
+            PRIMARY KEY (client_id, request_id));
+    """ + CLAUDE_COSTS_SCHEMA
+
+    def _initialize(self, conn):
+        super()._initialize(conn)
+        # 计数器跨重启累计，记下开始累计的时间，计算速率时用它而不是本进程的运行时长
+        conn.execute("INSERT OR IGNORE INTO kv (key, value) VALUES ('counters_since', ?)",
+                     (json.dumps(time.time()),))
+
+    def incr(self, name, amount=1):
+        """原子递增计数器"""
+        self.connection().execute(
+            'INSERT INTO counters (name, value) VALUES (?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value', (name, amount))
+
+    def get(self, name):
+        row = self.connection().execute('SELECT value FROM counters WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else 0
+
+    def since(self):
+        """计数器开始累计的时间戳（数据库创建时）"""
+        return self.fetch('counters_since')
+
+    def fetch(self, key, default=None):
+        """读取JSON键值"""
+        row = self.connection().execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def put(self, key, value):
+        self.connection().execute(
+            'INSERT INTO kv (key, value) VALUES (?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET value = excluded.value', (key, json.dumps(value)))
+
+    def stats(self):
+        return {
+            'enabled': True,
+            'path': self.path,
+            'size_bytes': os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+            'pid': os.getpid()
+        }
+
+
+class LocalCounters:
+    """单进程部署时使用的进程内计数器，接口与SharedState的计数器相同"""
+
+    scope = 'process'
+
+    def __init__(self):
+        self._values = Counter()
+        self._lock = threading.Lock()
+        self._since = time.time()
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._values[name] += amount
+
+    def get(self, name):
+        with self._lock:
+            return self._values[name]
+
+    def since(self):
+        return self._since
+
+
+SHARED_STATE = SharedState(SHARED_STATE_FILE) if SHARED_STATE_ENABLED else None
+COUNTERS = SHARED_STATE or LocalCounters()  # 请求数、错误数等原子计数器
+
+
+class CostLedger:
+    """Claude调用的资源账本
+
+    每次调用记录prompt和回复字符数、耗时、子进程CPU时间和内存峰值，按(小时, 客户端, 用途)聚合成一行，
+    用途为chat（首次调用）、retry（失败重试）或privacy（隐私分析）。账本存放在SQLite中，超过保留天数的小时行在整点后清理。
+    """
+
+    PURPOSES = ('chat', 'retry', 'privacy')
+    GROUP_COLUMNS = {'hour': 'hour', 'client': 'client_id', 'purpose': 'purpose'}
+
+    def __init__(self, store, retention_days=COST_LEDGER_RETENTION_DAYS):
+        self.store = store
+        self.retention_days = retention_days
+        self._pruned_hour = None
+        self.write_errors = 0
+
+    def record(self, client_id, purpose, prompt_chars, response_chars, wall_seconds, cpu_seconds, max_rss_kb, failed):
+        hour = datetime.now().strftime('%Y-%m-%dT%H')
+        try:
+            with self.store.transaction() as conn:
+                conn.execute(
+                    'INSERT INTO claude_costs VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT(hour, client_id, purpose) DO UPDATE SET '
+                    'calls = calls + 1, failures = failures + excluded.failures, '
+                    'prompt_chars = prompt_chars + excluded.prompt_chars, '
+                    'response_chars = response_chars + excluded.response_chars, '
+                    'wall_seconds = wall_seconds + excluded.wall_seconds, '
+                    'cpu_seconds = cpu_seconds + excluded.cpu_seconds, '
+                    'max_rss_kb = MAX(max_rss_kb, excluded.max_rss_kb)',
+                    (hour, client_id or 'unknown', purpose, int(failed), prompt_chars, response_chars,
+                     wall_seconds, cpu_seconds, max_rss_kb))
+                if hour != self._pruned_hour:
+                    cutoff = (datetime.now() - timedelta(days=self.retention_days)).strftime('%Y-%m-%dT%H')
+                    conn.execute('DELETE FROM claude_costs WHERE hour < ?', (cutoff,))
+                    self._pruned_hour = hour
+        except sqlite3.Error as e:
+            self.write_errors += 1
+            log_event(logging.WARNING, '费用账本写入失败', client_id, error=str(e))
+
+    def query(self, since_hour, group_by=('client',), client_id=None, purpose=None, limit=100):
+        """按group_by（hour/client/purpose的组合）汇总since_hour以来的账本，按CPU时间从高到低排序"""
+        columns = [self.GROUP_COLUMNS[name] for name in group_by]
+        conditions, params = ['hour >= ?'], [since_hour]
+        if client_id:
+            conditions.append('client_id = ?')
+            params.append(client_id)
+        if purpose:
+            conditions.append('purpose = ?')
+            params.append(purpose)
+        select_columns = ''.join(f'{column}, ' for column in columns)
+        group_clause = f"GROUP BY {', '.join(columns)} " if columns else ''
+        rows = self.store.connection().execute(
+            f'SELECT {select_columns}SUM(calls), SUM(failures), SUM(prompt_chars), SUM(response_chars), '
+            f'SUM(wall_seconds), SUM(cpu_seconds), MAX(max_rss_kb) FROM claude_costs '
+            f"WHERE {' AND '.join(conditions)} {group_clause}"
+            f'ORDER BY SUM(cpu_seconds) DESC LIMIT ?', params + [limit]).fetchall()
+        
+        results = []
+        for row in rows:
+            calls, failures, prompt_chars, response_chars, wall, cpu, max_rss = row[len(columns):]
+            if not calls:
+                continue
+            item = dict(zip(group_by, row[:len(columns)]))
+            item.update({
+                'calls': calls,
+                'failures': failures,
+                'prompt_chars': prompt_chars,
+                'response_chars': response_chars,
+                'wall_seconds': round(wall, 3),
+                'cpu_seconds': round(cpu, 3),
+                'avg_wall_seconds': round(wall / calls, 3),
+                'avg_cpu_seconds': round(cpu / calls, 3),
+                'max_rss_mb': round(max_rss / 1024, 1),
+            })
+            results.append(item)
+        return results
+
+
+COST_LEDGER = CostLedger(SHARED_STATE or SQLiteStore(COST_LEDGER_FILE, CLAUDE_COSTS_SCHEMA))
+
+def request_counts():
+    """返回(请求数, 错误数, 错误率%)"""
+    request_count = COUNTERS.get('request_count')
+    error_count = COUNTERS.get('error_count')
+    error_rate = (error_count / request_count * 100) if request_count > 0 else 0
+    return request_count, error_count, error_rate
+
+
+class SlidingWindowCounter:
+    """基于时间分桶环形缓冲区的滑动窗口计数器
+
+    每个桶记录一个时间片内的事件数，桶按时间片编号取模复用，
+    过期桶在时间推进时惰性清零并同步维护窗口总数，
+    因此记录和查询的开销只与桶数有关，与请求量无关。
+    """
+
+    def __init__(self, bucket_seconds, num_buckets):
+        self.bucket_seconds = bucket_seconds
+        self.num_buckets = num_buckets
+        self.span_seconds = bucket_seconds * num_buckets
+        self._counts = [0] * num_buckets
+        self._current_slot = None  # 最新的时间片编号
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def _advance(self, slot):
+        """推进到指定时间片，清零期间过期的桶（调用方需持有锁）"""
+        if self._current_slot is None:
+            self._current_slot = slot
+            return
+        if slot <= self._current_slot:
+            return
+        steps = min(slot - self._current_slot, self.num_buckets)
+        for i in range(1, steps + 1):
+            index = (self._current_slot + i) % self.num_buckets
+            self._total -= self._counts[index]
+            self._counts[index] = 0
+        self._current_slot = slot
+
+    def add(self, n=1, now=None):
+        """在当前时间片记录n次事件"""
+        now = time.time() if now is None else now
+        slot = int(now // self.bucket_seconds)
+        with self._lock:
+            self._advance(slot)
+            if slot <= self._current_slot - self.num_buckets:
+                return  # 早于窗口范围的事件直接丢弃
+            self._counts[slot % self.num_buckets] += n
+            self._total += n
+
+    def count(self, window_seconds=None, now=None):
+        """返回最近window_seconds秒内的事件数（按桶粒度对齐），默认整个窗口"""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._advance(int(now // self.bucket_seconds))
+            if window_seconds is None or window_seconds >= self.span_seconds:
+                return self._total
+            buckets = max(1, math.ceil(window_seconds / self.bucket_seconds))
+            return sum(self._counts[(self._current_slot - i) % self.num_buckets]
+                       for i in range(buckets))
+
+
+class ChatRateCounter:
+    """秒、分钟、小时三级分辨率的聊天频率计数器"""
+
+    def __init__(self):
+        self.per_second = SlidingWindowCounter(1, 60)      # 最近60秒
+        self.per_minute = SlidingWindowCounter(60, 60)     # 最近60分钟
+        self.per_hour = SlidingWindowCounter(3600, 24)     # 最近24小时
+
+    def record(self, now=None):
+        now = time.time() if now is None else now
+        self.per_second.add(now=now)
+        self.per_minute.add(now=now)
+        self.per_hour.add(now=now)
+
+    def count(self, window_seconds, now=None):
+        """选择能覆盖窗口的最细分辨率计数器统计最近window_seconds秒的聊天次数"""
+        for counter in (self.per_second, self.per_minute, self.per_hour):
+            if window_seconds <= counter.span_seconds:
+                return counter.count(window_seconds, now)
+        return self.per_hour.count(None, now)
+
+    def snapshot(self, now=None):
+        """返回各时间窗口的聊天次数和速率"""
+        now = time.time() if now is None else now
+        return build_chat_rate_snapshot(lambda window_seconds: self.count(window_seconds, now))
+
+
+def build_chat_rate_snapshot(count):
+    """根据窗口计数函数count(window_seconds)生成各时间窗口的聊天次数和速率"""
+    last_minute = count(60)
+    last_hour = count(3600)
+    last_24_hours = count(86400)
+    return {
+        'last_minute': last_minute,
+        'last_10_minutes': count(600),
+        'last_hour': last_hour,
+        'last_24_hours': last_24_hours,
+        'per_second_rate': round(last_minute / 60, 3),
+        'per_minute_rate': round(last_hour / 60, 3),
+        'per_hour_rate': round(last_24_hours / 24, 3)
+    }
+
+
+class SentimentWindow:
+    """最近N条用户情绪的滑动窗口，增量维护积极/消极计数"""
+
+    POSITIVE_EMOTIONS = ('happy', 'excited')
+    NEGATIVE_EMOTIONS = ('sad', 'angry', 'anxious')
+
+    def __init__(self, size=10):
+        self.size = size
+        self._window = deque(maxlen=size)
+        self.positive_count = 0
+        self.negative_count = 0
+
+    def _adjust(self, emotion, delta):
+        if emotion in self.POSITIVE_EMOTIONS:
+            self.positive_count += delta
+        elif emotion in self.NEGATIVE_EMOTIONS:
+            self.negative_count += delta
+
+    def add(self, emotion):
+        if len(self._window) == self._window.maxlen:
+            self._adjust(self._window[0], -1)
+        self._window.append(emotion)
+        self._adjust(emotion, 1)
+
+    def __len__(self):
+        return len(self._window)
+
+
+class EmotionShard:
+    """单个客户端（或全局）的情绪状态分片"""
+
+    def __init__(self):
+        self.chat_rate = ChatRateCounter()
+        self.sentiment = SentimentWindow()
+        self.stress_level = 0
+        self.version = 0
+        self.last_seen = time.time()
+
+
+class EmotionShardMap:
+    """按客户端分片的情绪状态表
+
+    客户端ID哈希到固定数量的分段，每段有独立的锁和按最近使用排序的表，
+    超出容量时淘汰该段最久未使用的客户端，不同客户端的更新互不阻塞。
+    """
+
+    def __init__(self, max_clients=MAX_TRACKED_CLIENTS, stripes=EMOTION_SHARD_STRIPES):
+        self._stripes = [(threading.Lock(), OrderedDict()) for _ in range(stripes)]
+        self._per_stripe_capacity = max(1, max_clients // stripes)
+
+    def _stripe(self, client_id):
+        return self._stripes[hash(client_id) % len(self._stripes)]
+
+    def get(self, client_id, create=False):
+        """获取客户端分片，create为True时不存在则创建"""
+        lock, shards = self._stripe(client_id)
+        with lock:
+            shard = shards.get(client_id)
+            if shard is not None:
+                shards.move_to_end(client_id)
+            elif create:
+                shard = EmotionShard()
+                shards[client_id] = shard
+                if len(shards) > self._per_stripe_capacity:
+                    shards.popitem(last=False)
+            return shard
+
+    def apply(self, client_id, updater):
+        """客户端分片存在时在分段锁内执行updater（不创建分片，不递增版本号）"""
+        lock, shards = self._stripe(client_id)
+        with lock:
+            shard = shards.get(client_id)
+            if shard is not None:
+                updater(shard)
+            return shard
+
+    def update(self, client_id, updater):
+        """在分段锁内对客户端分片执行updater并递增版本号"""
+        lock, shards = self._stripe(client_id)
+        with lock:
+            shard = shards.get(client_id)
+            if shard is None:
+                shard = EmotionShard()
+                shards[client_id] = shard
+                if len(shards) > self._per_stripe_capacity:
+                    shards.popitem(last=False)
+            else:
+                shards.move_to_end(client_id)
+            updater(shard)
+            shard.version += 1
+            shard.last_seen = time.time()
+            return shard
+
+    def __len__(self):
+        return sum(len(shards) for _, shards in self._stripes)
+
+
+GLOBAL_EMOTION = EmotionShard()  # 所有客户端共同作用的全局分量
+GLOBAL_EMOTION_LOCK = threading.Lock()
+EMOTION_SHARDS = EmotionShardMap()
+
+
+class ChatRateTracker:
+    """全局及按客户端的聊天频率统计，客户端计数器存放在情绪分片中"""
+
+    def __init__(self, shards, global_shard):
+        self.shards = shards
+        self.global_counter = global_shard.chat_rate
+
+    def record(self, client_id=None, now=None):
+        now = time.time() if now is None else now
+        self.global_counter.record(now)
+        if client_id:
+            self.shards.update(client_id, lambda shard: shard.chat_rate.record(now))
+
+    def count(self, window_seconds, client_id=None, now=None):
+        """统计全局或指定客户端最近window_seconds秒的聊天次数"""
+        if client_id is None:
+            return self.global_counter.count(window_seconds, now)
+        shard = self.shards.get(client_id)
+        return shard.chat_rate.count(window_seconds, now) if shard else 0
+
+    def snapshot(self, client_id=None, now=None):
+        if client_id is None:
+            return self.global_counter.snapshot(now)
+        shard = self.shards.get(client_id)
+        return (shard.chat_rate if shard else ChatRateCounter()).snapshot(now)
+
+    def tracked_clients(self):
+        return len(self.shards)
+
+
+class SharedChatRateTracker:
+    """跨进程共享的聊天频率统计，分桶计数存放在SQLite中
+
+    分辨率与ChatRateCounter相同（秒/分钟/小时），接口与ChatRateTracker一致；
+    过期分桶定期批量删除。
+    """
+
+    GLOBAL_SCOPE = '*'
+    RESOLUTIONS = ((1, 60), (60, 60), (3600, 24))  # (桶宽秒数, 桶数)
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, shared, shards):
+        self.shared = shared
+        self.shards = shards
+        self._last_prune = 0
+
+    def record(self, client_id=None, now=None):
+        now = time.time() if now is None else now
+        scopes = [self.GLOBAL_SCOPE] + ([client_id] if client_id else [])
+        rows = [(scope, resolution, int(now // resolution))
+                for scope in scopes for resolution, _ in self.RESOLUTIONS]
+        with self.shared.transaction() as conn:
+            conn.executemany(
+                'INSERT INTO chat_rate (scope, resolution, slot, count) VALUES (?, ?, ?, 1) '
+                'ON CONFLICT(scope, resolution, slot) DO UPDATE SET count = count + 1', rows)
+            if now - self._last_prune >= self.PRUNE_INTERVAL:
+                self._last_prune = now
+                for resolution, num_buckets in self.RESOLUTIONS:
+                    conn.execute('DELETE FROM chat_rate WHERE resolution = ? AND slot <= ?',
+                                 (resolution, int(now // resolution) - num_buckets))
+        if client_id:
+            # 客户端的情感窗口等其余状态仍在本进程的情绪分片中
+            self.shards.update(client_id, lambda shard: None)
+
+    def _sum(self, scope, resolution, buckets, now):
+        current = int(now // resolution)
+        row = self.shared.connection().execute(
+            'SELECT COALESCE(SUM(count), 0) FROM chat_rate '
+            'WHERE scope = ? AND resolution = ? AND slot > ? AND slot <= ?',
+            (scope, resolution, current - buckets, current)).fetchone()
+        return row[0]
+
+    def count(self, window_seconds, client_id=None, now=None):
+        """统计全局或指定客户端最近window_seconds秒的聊天次数"""
+        now = time.time() if now is None else now
+        scope = client_id or self.GLOBAL_SCOPE
+        for resolution, num_buckets in self.RESOLUTIONS:
+            if window_seconds <= resolution * num_buckets:
+                return self._sum(scope, resolution, max(1, math.ceil(window_seconds / resolution)), now)
+        resolution, num_buckets = self.RESOLUTIONS[-1]
+        return self._sum(scope, resolution, num_buckets, now)
+
+    def snapshot(self, client_id=None, now=None):
+        now = time.time() if now is None else now
+        return build_chat_rate_snapshot(lambda window_seconds: self.count(window_seconds, client_id, now))
+
+    def tracked_clients(self):
+        resolution, num_buckets = self.RESOLUTIONS[-1]
+        row = self.shared.connection().execute(
+            'SELECT COUNT(DISTINCT scope) FROM chat_rate WHERE resolution = ? AND scope != ? AND slot > ?',
+            (resolution, self.GLOBAL_SCOPE, int(time.time() // resolution) - num_buckets)).fetchone()
+        return row[0]
+
+
+if SHARED_STATE:
+    CHAT_RATE = SharedChatRateTracker(SHARED_STATE, EMOTION_SHARDS)
+else:
+    CHAT_RATE = ChatRateTracker(EMOTION_SHARDS, GLOBAL_EMOTION)
+
+
+class TokenBucketLimiter:
+    """按客户端的令牌桶限流
+
+    每个客户端最多积攒capacity个令牌，每秒补充refill_rate个，每次聊天请求消耗一个。
+    令牌桶存放在按最近使用淘汰的有界表中；传入shared时存放在SQLite中，多个worker进程共用同一额度。
+    """
+
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, capacity, refill_rate, max_clients=MAX_TRACKED_CLIENTS, shared=None):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.max_clients = max_clients
+        self.shared = shared
+        self._buckets = OrderedDict()  # client_id -> (令牌数, 更新时间)
+        self._rejections = OrderedDict()  # client_id -> 被拒绝次数
+        self._allowed = 0
+        self._rejected = 0
+        self._last_prune = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, tokens, updated, now):
+        return min(self.capacity, tokens + (now - updated) * self.refill_rate)
+
+    def _take_local(self, client_id, now):
+        tokens, updated = self._buckets.pop(client_id, (self.capacity, now))
+        tokens = self._refill(tokens, updated, now)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[client_id] = (tokens, now)
+        if len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)  # 被淘汰的客户端下次以满桶开始
+        return allowed, tokens
+
+    def _take_shared(self, client_id, now):
+        with self.shared.transaction() as conn:
+            row = conn.execute('SELECT tokens, updated FROM rate_buckets WHERE client_id = ?', (client_id,)).fetchone()
+            tokens = self._refill(*row, now) if row else self.capacity
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute('INSERT INTO rate_buckets (client_id, tokens, updated) VALUES (?, ?, ?) '
+                         'ON CONFLICT(client_id) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated',
+                         (client_id, tokens, now))
+            if now - self._last_prune >= self.PRUNE_INTERVAL:
+                # 已经补满的桶与不存在等价，直接删除
+                self._last_prune = now
+                conn.execute('DELETE FROM rate_buckets WHERE updated < ?', (now - self.capacity / self.refill_rate,))
+        return allowed, tokens
+
+    def acquire(self, client_id, now=None):
+        """尝试消耗一个令牌，返回(是否允许, 建议重试等待秒数)"""
+        if self.capacity <= 0 or self.refill_rate <= 0:
+            return True, 0
+        now = time.time() if now is None else now
+        if self.shared:
+            allowed, tokens = self._take_shared(client_id, now)
+        with self._lock:
+            if not self.shared:
+                allowed, tokens = self._take_local(client_id, now)
+            if allowed:
+                self._allowed += 1
+                return True, 0
+            self._rejected += 1
+            self._rejections[client_id] = self._rejections.pop(client_id, 0) + 1
+            if len(self._rejections) > self.max_clients:
+                self._rejections.popitem(last=False)
+        return False, math.ceil((1 - tokens) / self.refill_rate)
+
+    def stats(self, top=10):
+        with self._lock:
+            busiest = sorted(self._rejections.items(), key=lambda item: item[1], reverse=True)[:top]
+            return {
+                'burst': self.capacity,
+                'per_minute': round(self.refill_rate * 60, 2),
+                'shared': self.shared is not None,
+                'tracked_clients': len(self._buckets) if not self.shared else None,
+                'allowed': self._allowed,
+                'rejected': self._rejected,
+                'top_rejected_clients': [{'client_id': client_id[:8], 'rejected': count} for client_id, count in busiest]
+            }
+
+
+RATE_LIMITER = TokenBucketLimiter(RATE_LIMIT_BURST, RATE_LIMIT_PER_MINUTE / 60, shared=SHARED_STATE)
+
+def check_rate_limit(client_id):
+    """限流检查，超出额度时返回(响应数据, 429)，否则返回None"""
+    allowed, retry_after = RATE_LIMITER.acquire(client_id)
+    if allowed:
+        return None
+    RATE_LIMITED_TOTAL.inc()
+    log_event(logging.INFO, '请求过于频繁', client_id, retry_after=retry_after)
+    return {'error': f'消息发得太快啦，{retry_after}秒后再试吧', 'retry_after': retry_after}, 429
+
+def blend_client_factor(client_value, global_value):
+    """按权重合成客户端分量与全局分量"""
+    return round(CLIENT_EMOTION_WEIGHT * client_value
+                 + (1 - CLIENT_EMOTION_WEIGHT) * global_value, 1)
+
+
+def chat_load_level(total_chats, chat_count):
+    """根据24小时和最近10分钟的聊天次数计算负载因子"""
+    if total_chats < 2:
         return 0, "聊天记录较少"
     
-    # 计算最近10分钟的聊天频率
-    ten_minutes_ago = now - timedelta(minutes=10)
-    recent_10min = [t for t in recent_chats if t > ten_minutes_ago]
-    
     factor = 0
-    chat_count = len(recent_10min)
     
     if chat_count > 30:  # 高频聊天，增加压力
         factor = -15
@@ -304,19 +1312,24 @@ def calculate_chat_load_factor():
     
     return factor, reason
 
-def calculate_sentiment_factor():
-    """计算用户情感对情绪的影响因子"""
-    if not EMOTION_HISTORY:
+def calculate_chat_load_factor(client_id=None):
+    """计算聊天负载对情绪的影响因子（客户端分量与全局分量合成）"""
+    global_factor, global_reason = chat_load_level(CHAT_RATE.count(86400), CHAT_RATE.count(600))
+    if client_id is None:
+        return global_factor, global_reason
+    
+    client_factor, client_reason = chat_load_level(CHAT_RATE.count(86400, client_id),
+                                                   CHAT_RATE.count(600, client_id))
+    reason = client_reason if abs(client_factor) >= abs(global_factor) else global_reason
+    return blend_client_factor(client_factor, global_factor), reason
+
+def sentiment_level(window):
+    """根据情绪窗口中的积极/消极计数计算情感因子"""
+    if not len(window):
         return 0, "暂无情感数据"
     
-    # 分析最近10条对话的情感
-    recent_emotions = list(EMOTION_HISTORY)[-10:]
-    
-    positive_emotions = ['happy', 'excited']
-    negative_emotions = ['sad', 'angry', 'anxious']
-    
-    positive_count = sum(1 for e in recent_emotions if e['user_emotion'] in positive_emotions)
-    negative_count = sum(1 for e in recent_emotions if e['user_emotion'] in negative_emotions)
+    positive_count = window.positive_count
+    negative_count = window.negative_count
     
     # 计算情感倾向
     if positive_count > negative_count:
@@ -331,15 +1344,31 @@ def calculate_sentiment_factor():
     
     return factor, reason
 
-def calculate_xiaobu_emotion():
-    """计算小布的当前情绪状态"""
+def calculate_sentiment_factor(client_id=None):
+    """计算用户情感对情绪的影响因子（基于最近10条对话，客户端分量与全局分量合成）"""
+    global_factor, global_reason = sentiment_level(GLOBAL_EMOTION.sentiment)
+    if client_id is None:
+        return global_factor, global_reason
+    
+    shard = EMOTION_SHARDS.get(client_id)
+    if shard is None:
+        return blend_client_factor(0, global_factor), global_reason
+    
+    client_factor, client_reason = sentiment_level(shard.sentiment)
+    return blend_client_factor(client_factor, global_factor), client_reason
+
+def calculate_xiaobu_emotion(client_id=None, update_state=True):
+    """计算小布的当前情绪状态，指定client_id时合成该客户端的情绪分片
+
+    update_state为False时只计算，不把全局视角的因子和压力等级写回XIAOBU_STATE。
+    """
     # 更新各种影响因子
     weather_factor = calculate_weather_factor()
-    chat_load_factor, chat_reason = calculate_chat_load_factor()
-    sentiment_factor, sentiment_reason = calculate_sentiment_factor()
+    chat_load_factor, chat_reason = calculate_chat_load_factor(client_id)
+    sentiment_factor, sentiment_reason = calculate_sentiment_factor(client_id)
     time_factor, time_reason, holiday_type, holiday_name = calculate_time_factor()
     adolescent_factor, adolescent_reason = calculate_adolescent_factor()
-    stress_factor = update_stress_level()
+    stress_factor, stress_level = update_stress_level(client_id, update_state)
     
     # 计算总情绪值
     total_emotion = (XIAOBU_STATE['base_emotion'] + 
@@ -353,12 +1382,13 @@ def calculate_xiaobu_emotion():
     # 限制在0-100范围内
     total_emotion = max(0, min(100, total_emotion))
     
-    # 更新状态
-    XIAOBU_STATE['weather_factor'] = weather_factor
-    XIAOBU_STATE['chat_load_factor'] = chat_load_factor
-    XIAOBU_STATE['sentiment_factor'] = sentiment_factor
-    XIAOBU_STATE['time_factor'] = time_factor
-    XIAOBU_STATE['adolescent_factor'] = adolescent_factor
+    # 更新状态（只记录全局视角的因子）
+    if client_id is None and update_state:
+        XIAOBU_STATE['weather_factor'] = weather_factor
+        XIAOBU_STATE['chat_load_factor'] = chat_load_factor
+        XIAOBU_STATE['sentiment_factor'] = sentiment_factor
+        XIAOBU_STATE['time_factor'] = time_factor
+        XIAOBU_STATE['adolescent_factor'] = adolescent_factor
     
     # 获取当前时间段信息
     activity, is_weekend, _, _ = get_current_time_period()
@@ -392,7 +1422,7 @@ def calculate_xiaobu_emotion():
         'is_weekend': is_weekend,
         'holiday_type': holiday_type,
         'holiday_name': holiday_name,
-        'stress_level': XIAOBU_STATE['stress_level'],
+        'stress_level': stress_level,
         'identity': XIAOBU_IDENTITY,
         'factors': {
             'weather': weather_factor,
@@ -405,6 +1435,29 @@ def calculate_xiaobu_emotion():
         }
     }
 
+def emotion_inputs_key(client_id=None):
+    """情绪计算输入的粗粒度标识，不运行完整的情绪计算
+
+    由天气版本、作息时段、青春期波动时间窗和各因子的等级组成，
+    标识不变时情绪计算结果基本不变，用作ETag。
+    """
+    activity, is_weekend, holiday_type, _ = get_current_time_period()
+    window = int(time.time() // ADOLESCENT_FACTOR_WINDOW)
+    chat_load = calculate_chat_load_factor(client_id)[0]
+    sentiment = calculate_sentiment_factor(client_id)[0]
+    stress = update_stress_level(client_id, update_state=False)[1]
+    return (f"{WEATHER.version}-{activity}-{int(is_weekend)}-{holiday_type}-{window}"
+            f"-{chat_load:g}-{sentiment:g}-{stress:g}")
+
+def window_random(*key):
+    """本时间窗内固定的随机数发生器：同一时间窗、同一key的抽签结果相同（各进程一致）
+
+    情绪计算中的随机选择（想做的户外活动、是否饿了、这节是什么课）用它抽签，
+    同一时段内反复计算得到相同的情绪，推送和ETag只随情绪输入变化。
+    """
+    window = int(time.time() // ADOLESCENT_FACTOR_WINDOW)
+    return random.Random('-'.join(map(str, (window,) + key)))
+
 def determine_emotion_type(emotion_value, activity, is_weekend, time_factor, adolescent_factor, holiday_type, holiday_name):
     """根据情绪值和当前活动确定具体的情绪类型"""
     
@@ -422,7 +1475,7 @@ def determine_emotion_type(emotion_value, activity, is_weekend, time_factor, ado
             return 'very_happy', "暑假太爽"
         elif activity in ['outdoor_morning', 'outdoor_afternoon']:
             activities = ['camping', 'cycling', 'hiking']
-            chosen = random.choice(activities)
+            chosen = window_random('summer_outdoor', activity).choice(activities)
             return chosen, f"暑假想{['露营', '骑车', '徒步'][activities.index(chosen)]}"
         else:
             return 'happy', "暑假开心"
@@ -468,7 +1521,7 @@ def determine_emotion_type(emotion_value, activity, is_weekend, time_factor, ado
                 'cycling': '想骑车', 
                 'hiking': '想徒步'
             }
-            chosen = random.choice(list(activities.keys()))
+            chosen = window_random('weekend_outdoor', activity).choice(list(activities.keys()))
             return chosen, activities[chosen]
         else:
             return 'lazy_weekend', "周末想躺平"
@@ -506,9 +1559,9 @@ def determine_emotion_type(emotion_value, activity, is_weekend, time_factor, ado
     else:
         return 'very_sad', "心情很差"
 
-def record_chat_time():
+def record_chat_time(client_id=None):
     """记录聊天时间用于负载计算"""
-    XIAOBU_STATE['chat_frequency'].append(datetime.now())
+    CHAT_RATE.record(client_id)
 
 def check_holiday_status():
     """检查当前是否为假期"""
@@ -626,8 +1679,8 @@ def calculate_time_factor():
             factor = 20
             reason = "想去骑车"
         elif activity == 'outdoor_afternoon':
-            activities = ['露营', '徒步', '骑车']
-            chosen_activity = random.choice(activities)
+            activities = ['露营', '骑车', '徒步']  # 与determine_emotion_type中的顺序一致，抽到同一项活动
+            chosen_activity = window_random('weekend_outdoor', activity).choice(activities)
             factor = 25
             reason = f"想去{chosen_activity}"
         elif activity == 'afternoon_rest':
@@ -645,7 +1698,7 @@ def calculate_time_factor():
             factor = -35
             reason = "睡眠时间被打扰"
         elif activity in ['breakfast', 'lunch', 'dinner']:
-            if random.random() < 0.3:  # 30%概率饿了
+            if window_random('hungry', activity).random() < 0.3:  # 30%概率饿了
                 factor = -20
                 reason = "肚子饿了"
             else:
@@ -656,10 +1709,11 @@ def calculate_time_factor():
             favorite_subjects = XIAOBU_IDENTITY['subjects']['favorite']
             difficult_subjects = XIAOBU_IDENTITY['subjects']['difficult']
             
-            if random.choice(['数学', '物理', '语文', '英语']) in difficult_subjects:
+            subject_draw = window_random('subject', activity)
+            if subject_draw.choice(['数学', '物理', '语文', '英语']) in difficult_subjects:
                 factor = -5
                 reason = "不喜欢这科"
-            elif random.choice(['体育', '美术']) in favorite_subjects:
+            elif subject_draw.choice(['体育', '美术']) in favorite_subjects:
                 factor = 20
                 reason = "喜欢这节课"
             else:
@@ -678,7 +1732,41 @@ def calculate_time_factor():
     return factor, reason, holiday_type, holiday_name
 
 def calculate_adolescent_factor():
-    """计算青春期随机情绪波动因子"""
+    """计算青春期随机情绪波动因子
+
+    每个时间窗只计算一次，窗内的调用直接复用结果，情绪不会随每次计算随机跳动；
+    开启共享状态时每个时间窗只有第一个进程写入数据库，各进程的情绪波动保持一致。
+    """
+    window = int(time.time() // ADOLESCENT_FACTOR_WINDOW)
+    with XIAOBU_STATE_LOCK:
+        if ADOLESCENT_CACHE['window'] != window:
+            if SHARED_STATE is None:
+                result = _calculate_adolescent_factor()
+            else:
+                result = _calculate_shared_adolescent_factor(window)
+            ADOLESCENT_CACHE.update(window=window, result=result)
+        return ADOLESCENT_CACHE['result']
+
+def _calculate_shared_adolescent_factor(window):
+    """从共享数据库读取本时间窗的结果，还没有进程算过时计算并写入（调用方需持有XIAOBU_STATE_LOCK）"""
+    with SHARED_STATE.transaction():
+        shared = SHARED_STATE.fetch('hormonal_state')
+        if shared:
+            XIAOBU_STATE['current_hormonal_state'] = shared['state']
+            XIAOBU_STATE['last_mood_swing'] = (datetime.fromisoformat(shared['last_mood_swing'])
+                                               if shared['last_mood_swing'] else None)
+            if shared.get('window') == window:
+                return tuple(shared['result'])
+        result = _calculate_adolescent_factor()
+        SHARED_STATE.put('hormonal_state', {
+            'state': XIAOBU_STATE['current_hormonal_state'],
+            'last_mood_swing': XIAOBU_STATE['last_mood_swing'].isoformat() if XIAOBU_STATE['last_mood_swing'] else None,
+            'window': window,
+            'result': list(result)
+        })
+        return result
+
+def _calculate_adolescent_factor():
     now = datetime.now()
     
     # 检查是否处于情绪波动期
@@ -703,18 +1791,18 @@ def calculate_adolescent_factor():
     
     return base_randomness, "青春期正常波动"
 
-def update_stress_level():
-    """更新压力等级"""
-    # 基于聊天频率计算压力
-    recent_chats = len([t for t in XIAOBU_STATE['chat_frequency'] 
-                       if (datetime.now() - t).total_seconds() < 3600])  # 1小时内
+def update_stress_level(client_id=None, update_state=True):
+    """更新压力等级，返回(压力值, 限制在0-100的压力等级)；update_state为False时只计算不写回"""
+    # 基于聊天频率计算压力（客户端分量与全局分量合成）
+    chat_stress = 30 if CHAT_RATE.count(3600) > 20 else 0  # 1小时内聊天太频繁
+    if client_id is not None:
+        client_chat_stress = 30 if CHAT_RATE.count(3600, client_id) > 20 else 0
+        chat_stress = blend_client_factor(client_chat_stress, chat_stress)
     
     # 基于时间段增加压力
     activity, is_weekend, holiday_type, holiday_name = get_current_time_period()
     
-    stress = 0
-    if recent_chats > 20:
-        stress += 30  # 聊天太频繁
+    stress = chat_stress
         
     # 假期期间压力较低
     if holiday_type in ['winter_vacation', 'summer_vacation', 'national_holiday']:
@@ -727,48 +1815,1221 @@ def update_stress_level():
     if activity == 'sleep':
         stress += 40  # 睡眠被打扰压力最大
     
-    XIAOBU_STATE['stress_level'] = min(100, max(0, stress))
-    return stress
+    stress_level = min(100, max(0, stress))
+    if update_state and client_id is None:
+        XIAOBU_STATE['stress_level'] = stress_level
+    elif update_state:
+        EMOTION_SHARDS.apply(client_id, lambda shard: setattr(shard, 'stress_level', stress_level))
+    return stress, stress_level
+
+class MetricsSampler:
+    """后台系统指标采样器
+
+    CPU使用率取两次采样之间的增量（不阻塞等待），最近15分钟的样本保存在环形队列中，
+    每次采样后生成包含1/5/15分钟平均值和进程指标的快照，读取方只拿快照引用。
+    """
+
+    def __init__(self, interval=METRICS_SAMPLE_INTERVAL, history_seconds=METRICS_HISTORY_SECONDS):
+        self.interval = interval
+        self.process = psutil.Process()
+        self._samples = deque(maxlen=max(1, history_seconds // interval))
+        self._snapshot = None
+        self._thread = None
+        self._lock = threading.Lock()
+        # 首次调用只建立CPU时间基线
+        psutil.cpu_percent(interval=None)
+        self.process.cpu_percent(interval=None)
+
+    def _average(self, key, seconds):
+        count = max(1, min(len(self._samples), seconds // self.interval))
+        recent = list(self._samples)[-count:]
+        return round(sum(sample[key] for sample in recent) / len(recent), 1)
+
+    def sample(self):
+        """采集一次系统和进程指标并更新快照"""
+        with self.process.oneshot():
+            memory_info = self.process.memory_info()
+            process_cpu = self.process.cpu_percent(interval=None)
+            num_threads = self.process.num_threads()
+            num_fds = self.process.num_fds() if hasattr(self.process, 'num_fds') else None
+        current = {
+            'timestamp': time.time(),
+            'cpu_usage': psutil.cpu_percent(interval=None),
+            'memory_usage': psutil.virtual_memory().percent,
+            'disk_usage': psutil.disk_usage('/').percent
+        }
+        with self._lock:
+            self._samples.append(current)
+            self._snapshot = {
+                **current,
+                'cpu_avg_1m': self._average('cpu_usage', 60),
+                'cpu_avg_5m': self._average('cpu_usage', 300),
+                'cpu_avg_15m': self._average('cpu_usage', 900),
+                'sample_count': len(self._samples),
+                'sample_interval': self.interval,
+                'process': {
+                    'pid': self.process.pid,
+                    'cpu_percent': process_cpu,
+                    'rss_bytes': memory_info.rss,
+                    'num_threads': num_threads,
+                    'num_fds': num_fds
+                }
+            }
+        return self._snapshot
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sample()
+            except Exception as e:
+                log_event(logging.WARNING, '系统指标采样失败', error=str(e))
+
+    def start(self):
+        """启动后台采样线程（重复调用无副作用）"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def snapshot(self):
+        """返回最近一次采样的快照，尚未采样时立即做一次非阻塞采样"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            self.start()
+            snapshot = self.sample()
+        return snapshot
+
+
+METRICS = MetricsSampler()
 
 def update_system_metrics():
-    """更新系统性能指标"""
+    """从采样器快照更新系统性能指标（不阻塞）"""
     try:
-        SERVICE_STATUS['cpu_usage'] = psutil.cpu_percent(interval=1)
-        SERVICE_STATUS['memory_usage'] = psutil.virtual_memory().percent
-        SERVICE_STATUS['disk_usage'] = psutil.disk_usage('/').percent
+        snapshot = METRICS.snapshot()
+        SERVICE_STATUS['cpu_usage'] = snapshot['cpu_usage']
+        SERVICE_STATUS['memory_usage'] = snapshot['memory_usage']
+        SERVICE_STATUS['disk_usage'] = snapshot['disk_usage']
     except Exception as e:
-        print(f"更新系统指标失败: {e}")
+        log_event(logging.WARNING, '更新系统指标失败', error=str(e))
 
-def analyze_emotion(text):
-    """分析文本情绪"""
-    emotion_scores = {emotion: 0 for emotion in EMOTION_KEYWORDS.keys()}
-    
-    for emotion, keywords in EMOTION_KEYWORDS.items():
-        for keyword in keywords:
-            if keyword in text:
-                emotion_scores[emotion] += 1
-    
-    # 找到得分最高的情绪
-    max_emotion = max(emotion_scores, key=emotion_scores.get)
-    max_score = emotion_scores[max_emotion]
-    
-    # 如果没有匹配到关键词，返回neutral
-    if max_score == 0:
-        return 'neutral', 0.1
-    
-    # 计算置信度
-    total_score = sum(emotion_scores.values())
+
+class MetricFamily:
+    """一组同名指标（按标签值区分），所有更新都在锁内完成"""
+
+    TYPE = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {} if self.labelnames or self.TYPE == 'histogram' else {(): 0}  # 无标签指标从0开始输出
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self):
+        """返回[(指标名后缀, 标签字典, 值)]"""
+        with self._lock:
+            items = list(self._values.items())
+        return [('', dict(zip(self.labelnames, key)), value) for key, value in items]
+
+
+class MetricCounter(MetricFamily):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class MetricGauge(MetricFamily):
+    """可直接设置的仪表；传入collect时在抓取时调用它取值（返回数值或{标签元组: 值}）"""
+
+    TYPE = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self):
+        if self.collect is None:
+            return super().samples()
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [('', dict(zip(self.labelnames, key)), value) for key, value in values.items()]
+
+
+class MetricHistogram(MetricFamily):
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][i] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(state['counts']), state['sum'], state['count']) for key, state in self._values.items()]
+        samples = []
+        for key, counts, total, count in items:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', {**labels, 'le': repr(float(bound))}, cumulative))
+            samples.append(('_bucket', {**labels, 'le': '+Inf'}, count))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, count))
+        return samples
+
+
+class MetricsRegistry:
+    """进程内指标注册表，按Prometheus文本格式输出
+
+    多进程部署时每个worker各自暴露自己的指标，由Prometheus按实例汇总。
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(MetricCounter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), collect=None):
+        return self.register(MetricGauge(name, documentation, labelnames, collect))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(MetricHistogram(name, documentation, labelnames, buckets))
+
+    @staticmethod
+    def _format_value(value):
+        if value is None:
+            return 'NaN'
+        if isinstance(value, float) and math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(float(value)) if isinstance(value, float) else str(value)
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        escaped = []
+        for name, value in labels.items():
+            value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+            escaped.append(f'{name}="{value}"')
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                log_event(logging.WARNING, '采集指标失败', metric=metric.name, error=str(e))
+                continue
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.TYPE}')
+            for suffix, labels, value in samples:
+                lines.append(f'{metric.name}{suffix}{self._format_labels(labels)} {self._format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+CHAT_STAGE_SECONDS = REGISTRY.histogram(
+    'xiaobu_chat_stage_seconds', '聊天处理各阶段耗时', ['stage'])
+CHAT_REQUEST_SECONDS = REGISTRY.histogram(
+    'xiaobu_chat_request_seconds', '聊天请求总耗时（含排队和Claude调用）', ['status'])
+CHAT_REQUESTS_TOTAL = REGISTRY.counter(
+    'xiaobu_chat_requests_total', '按状态码统计的聊天请求数', ['status'])
+LLM_RETRIES_TOTAL = REGISTRY.counter(
+    'xiaobu_llm_retries_total', 'Claude调用失败后的重试次数')
+LLM_TIMEOUTS_TOTAL = REGISTRY.counter(
+    'xiaobu_llm_timeouts_total', 'Claude调用超时次数')
+PRIVACY_ANALYSIS_TOTAL = REGISTRY.counter(
+    'xiaobu_privacy_analysis_total', '隐私分析Claude调用次数', ['result'])
+RATE_LIMITED_TOTAL = REGISTRY.counter(
+    'xiaobu_rate_limited_total', '被限流拒绝的聊天请求数')
+LLM_PROCESSES_IN_FLIGHT = REGISTRY.gauge(
+    'xiaobu_llm_processes_in_flight', '正在运行的claude子进程数', ['kind'])
+REGISTRY.gauge('xiaobu_llm_slots_in_use', '已占用的Claude调用名额',
+               collect=lambda: LLM_SCHEDULER.in_use)
+REGISTRY.gauge('xiaobu_llm_queue_depth', '排队等待Claude调用名额的请求数',
+               collect=lambda: LLM_SCHEDULER.stats(top=0)['queued_now'])
+REGISTRY.gauge('xiaobu_sse_subscribers', '实时推送订阅者数', ['topic'],
+               collect=lambda: {(name,): stats['subscribers'] for name, stats in HUB.stats().items()})
+REGISTRY.gauge('xiaobu_process_resident_memory_bytes', '进程常驻内存（最近一次采样）',
+               collect=lambda: METRICS.snapshot()['process']['rss_bytes'])
+REGISTRY.gauge('xiaobu_process_cpu_percent', '进程CPU使用率（最近一次采样）',
+               collect=lambda: METRICS.snapshot()['process']['cpu_percent'])
+
+@contextmanager
+def chat_stage(name):
+    """记录聊天处理某个阶段的耗时，处于追踪中时同时记录为一个span"""
+    started = time.perf_counter()
+    try:
+        with trace_span(name):
+            yield
+    finally:
+        CHAT_STAGE_SECONDS.observe(time.perf_counter() - started, stage=name)
+
+class Span:
+    """追踪中的一个阶段"""
+
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'start', 'end', 'thread_id', 'thread_name', 'attrs')
+
+    def __init__(self, trace, name, parent_id, attrs):
+        self.trace = trace
+        self.span_id = trace.next_span_id()
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.perf_counter()
+        self.end = None
+        thread = threading.current_thread()
+        self.thread_id = thread.ident
+        self.thread_name = thread.name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self):
+        return {
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start_ms': round((self.start - self.trace.started) * 1000, 3),
+            'duration_ms': round((self.end - self.start) * 1000, 3) if self.end is not None else None,
+            'thread': self.thread_name,
+            'attrs': self.attrs
+        }
+
+
+class Trace:
+    """一次请求的追踪，包含根span和各阶段span（后台线程的span也挂在同一追踪下）"""
+
+    def __init__(self, name, attrs):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.wall_start = time.time()
+        self.started = time.perf_counter()
+        self.spans = []
+        self._span_seq = 0
+        self._lock = threading.Lock()
+        self.root = self.add_span(name, None, attrs)
+
+    def next_span_id(self):
+        with self._lock:
+            self._span_seq += 1
+            return self._span_seq
+
+    def add_span(self, name, parent_id, attrs):
+        span = Span(self, name, parent_id, attrs)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    @property
+    def duration(self):
+        return (self.root.end or time.perf_counter()) - self.started
+
+    def summary(self):
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'start': datetime.fromtimestamp(self.wall_start).isoformat(),
+            'duration_ms': round(self.duration * 1000, 3),
+            'span_count': len(self.spans),
+            'attrs': self.root.attrs
+        }
+
+    def to_dict(self):
+        with self._lock:
+            spans = list(self.spans)
+        return {**self.summary(), 'spans': [span.to_dict() for span in spans]}
+
+    def chrome_events(self):
+        """转换为Chrome trace-event格式（chrome://tracing、Perfetto可直接打开）"""
+        with self._lock:
+            spans = list(self.spans)
+        pid = os.getpid()
+        events = []
+        for span in spans:
+            end = span.end if span.end is not None else time.perf_counter()
+            events.append({
+                'name': span.name,
+                'cat': self.name,
+                'ph': 'X',
+                'ts': round((self.wall_start + span.start - self.started) * 1e6),
+                'dur': round((end - span.start) * 1e6),
+                'pid': pid,
+                'tid': span.thread_id,
+                'args': {'trace_id': self.trace_id, 'span_id': span.span_id,
+                         'parent_id': span.parent_id, **span.attrs}
+            })
+        return events
+
+
+class TraceStore:
+    """内存中保留最近N条和最慢N条追踪"""
+
+    def __init__(self, recent_limit=TRACE_RECENT_LIMIT, slowest_limit=TRACE_SLOWEST_LIMIT):
+        self.slowest_limit = slowest_limit
+        self._recent = deque(maxlen=recent_limit)
+        self._slowest = []  # (耗时, 序号, Trace) 小顶堆
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def add(self, trace):
+        with self._lock:
+            self._recent.append(trace)
+            self._seq += 1
+            entry = (trace.duration, self._seq, trace)
+            if len(self._slowest) < self.slowest_limit:
+                heapq.heappush(self._slowest, entry)
+            elif entry[0] > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def recent(self):
+        with self._lock:
+            return list(reversed(self._recent))
+
+    def slowest(self):
+        with self._lock:
+            return [trace for _, _, trace in sorted(self._slowest, key=lambda entry: entry[0], reverse=True)]
+
+    def get(self, trace_id):
+        for trace in self.recent() + self.slowest():
+            if trace.trace_id == trace_id:
+                return trace
+        return None
+
+    def all(self):
+        traces = {trace.trace_id: trace for trace in self.slowest() + self.recent()}
+        return list(traces.values())
+
+
+TRACES = TraceStore()
+
+@contextmanager
+def start_trace(name, **attrs):
+    """开始一次请求追踪，结束后存入TRACES；未开启追踪时不做任何记录"""
+    if not TRACING_ENABLED:
+        yield None
+        return
+    trace = Trace(name, attrs)
+    token = CURRENT_SPAN.set(trace.root)
+    try:
+        yield trace
+    except BaseException as e:
+        trace.root.set(error=type(e).__name__)
+        raise
+    finally:
+        trace.root.end = time.perf_counter()
+        CURRENT_SPAN.reset(token)
+        TRACES.add(trace)
+
+@contextmanager
+def trace_span(name, **attrs):
+    """在当前追踪下记录一个子span；不在追踪中时直接执行"""
+    parent = CURRENT_SPAN.get()
+    if parent is None:
+        yield None
+        return
+    span = parent.trace.add_span(name, parent.span_id, attrs)
+    token = CURRENT_SPAN.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.set(error=type(e).__name__)
+        raise
+    finally:
+        span.end = time.perf_counter()
+        CURRENT_SPAN.reset(token)
+
+def start_traced_thread(name, target, *args):
+    """启动后台线程，线程内的处理作为当前请求追踪的子span记录"""
+    context = contextvars.copy_context()
+    
+    def run():
+        with trace_span(name):
+            target(*args)
+    
+    thread = threading.Thread(target=context.run, args=(run,), name=name, daemon=True)
+    thread.start()
+    return thread
+
+def record_chat_request(status_code, seconds):
+    CHAT_REQUESTS_TOTAL.inc(status=status_code)
+    CHAT_REQUEST_SECONDS.observe(seconds, status=status_code)
+
+class SamplingProfiler:
+    """按固定频率采样所有线程的调用栈，输出折叠栈和按函数汇总
+    
+    只在请求期间运行，不需要任何追踪钩子；同一时间只允许一个采样任务。
+    """
+    
+    # 栈顶停在这些函数里的线程视为空闲（等锁、等队列、等网络），cpu模式下不计入
+    IDLE_FRAMES = {
+        ('threading.py', 'wait'), ('threading.py', '_wait_for_tstate_lock'),
+        ('queue.py', 'get'), ('selectors.py', 'select'), ('socketserver.py', 'serve_forever'),
+        ('socket.py', 'accept'), ('socket.py', 'readinto'), ('ssl.py', 'read'),
+        ('thread.py', '_worker'), ('base_events.py', '_run_once'),
+    }
+    
+    def __init__(self):
+        self._running = threading.Lock()
+        self._labels = {}  # code对象 -> 显示名，避免每次采样重复拼字符串
+        self.runs = 0
+    
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self._labels[code] = label
+        return label
+    
+    def _is_idle(self, frame):
+        code = frame.f_code
+        return (os.path.basename(code.co_filename), code.co_name) in self.IDLE_FRAMES
+    
+    def profile(self, seconds, rate, mode='cpu'):
+        """采样seconds秒，返回结果字典；已有采样任务在运行时返回None"""
+        if not self._running.acquire(blocking=False):
+            return None
+        try:
+            return self._run(seconds, rate, mode)
+        finally:
+            self._running.release()
+    
+    def _run(self, seconds, rate, mode):
+        own_ident = threading.get_ident()
+        interval = 1.0 / rate
+        stacks = Counter()
+        samples = 0
+        idle_skipped = 0
+        threads_seen = set()
+        sampling_cost = 0.0
+        
+        start = time.perf_counter()
+        deadline = start + seconds
+        next_tick = start
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                if mode == 'cpu' and self._is_idle(frame):
+                    idle_skipped += 1
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                thread_name = re.sub(r'[-_]\d+', '', names.get(ident, 'unknown'))  # 同类线程合并到一起
+                labels.append(thread_name)
+                stacks[tuple(reversed(labels))] += 1
+                threads_seen.add(ident)
+            samples += 1
+            sampling_cost += time.perf_counter() - now
+            next_tick += interval
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.perf_counter()  # 跟不上时不追赶，避免连续占用CPU
+        elapsed = time.perf_counter() - start
+        self.runs += 1
+        
+        self_counts = Counter()
+        total_counts = Counter()
+        for stack, count in stacks.items():
+            self_counts[stack[-1]] += count
+            for label in set(stack[1:]):
+                total_counts[label] += count
+        stack_samples = sum(stacks.values()) or 1
+        functions = [{
+            'function': label,
+            'self': self_counts[label],
+            'total': total,
+            'self_percent': round(self_counts[label] / stack_samples * 100, 2),
+            'total_percent': round(total / stack_samples * 100, 2),
+        } for label, total in total_counts.items()]
+        functions.sort(key=lambda item: (item['self'], item['total']), reverse=True)
+        
+        return {
+            'mode': mode,
+            'seconds': round(elapsed, 3),
+            'rate': rate,
+            'samples': samples,
+            'stack_samples': sum(stacks.values()),
+            'idle_skipped': idle_skipped,
+            'threads': len(threads_seen),
+            'overhead_percent': round(sampling_cost / elapsed * 100, 3) if elapsed else 0,
+            'collapsed': '\n'.join(f"{';'.join(stack)} {count}"
+                                   for stack, count in sorted(stacks.items(), key=lambda item: -item[1])),
+            'functions': functions[:PROFILE_TOP_FUNCTIONS],
+        }
+
+
+PROFILER = SamplingProfiler()
+
+def check_admin_token():
+    """校验管理口令（X-Admin-Token或Bearer），不通过时返回错误响应"""
+    if not ADMIN_TOKEN:
+        return jsonify({'error': '管理接口未开启，请设置XIAOBU_ADMIN_TOKEN'}), 403
+    supplied = request.headers.get('X-Admin-Token', '')
+    authorization = request.headers.get('Authorization', '')
+    if not supplied and authorization.startswith('Bearer '):
+        supplied = authorization[len('Bearer '):]
+    if not hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+        return jsonify({'error': '管理口令错误'}), 401
+    return None
+
+def analyze_emotion(text):
+    """分析文本情绪"""
+    emotion_scores = {emotion: 0 for emotion in EMOTION_KEYWORDS.keys()}
+    
+    for emotion, keywords in EMOTION_KEYWORDS.items():
+        for keyword in keywords:
+            if keyword in text:
+                emotion_scores[emotion] += 1
+    
+    # 找到得分最高的情绪
+    max_emotion = max(emotion_scores, key=emotion_scores.get)
+    max_score = emotion_scores[max_emotion]
+    
+    # 如果没有匹配到关键词，返回neutral
+    if max_score == 0:
+        return 'neutral', 0.1
+    
+    # 计算置信度
+    total_score = sum(emotion_scores.values())
     confidence = max_score / total_score if total_score > 0 else 0
     
     return max_emotion, confidence
 
-def record_emotion(user_message, bot_response):
-    """记录对话的情绪数据"""
+class EmotionRingBuffer:
+    """基于内存映射文件的定长情绪记录环形缓冲区
+
+    文件由64字节文件头和capacity+slack条定长二进制记录组成，
+    记录按写入序号取模存放，文件头保存累计写入数；
+    追加只写一条记录和文件头，尾部读取直接从映射内存解包，进程重启后数据仍在。
+
+    shared为True时支持同一台机器上的多个进程共用：追加时用flock跨进程互斥，
+    读取前从文件头刷新写入数，并由后台线程跟进其他进程写入的记录、调用本进程的监听器。
+    超出容量的slack个槽位保证跟进时仍能读到被淘汰的记录。
+    """
+
+    MAGIC = b'XBEMORNG'
+    VERSION = 1
+    HEADER = struct.Struct('<8sIIIQ')  # magic, version, record_size, capacity, total_written
+    HEADER_SIZE = 64
+    # timestamp, user_emotion_id, bot_emotion_id, 保留, user_confidence, bot_confidence, user_length, bot_length
+    RECORD = struct.Struct('<dBBHffII')
+    EMOTION_IDS = list(EMOTION_KEYWORDS.keys())
+
+    def __init__(self, path, capacity, slack=EMOTION_RING_SLACK, shared=False):
+        self.path = path
+        self.capacity = capacity
+        self.slots = capacity + slack  # 文件中的实际槽位数
+        self.shared = shared
+        self._mmap = None
+        self._file = None
+        self._lock_file = None
+        self._pid = None
+        self._total = 0
+        self._dispatched = 0  # 本进程已通知监听器的写入数
+        self.lost_evictions = 0  # 跟进过慢、被淘汰记录已被覆盖的次数
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """注册追加回调 listener(record, evicted)，evicted为被覆盖的旧记录或None"""
+        self._listeners.append(listener)
+
+    def _file_size(self, slots):
+        return self.HEADER_SIZE + slots * self.RECORD.size
+
+    @contextmanager
+    def _process_lock(self, exclusive=True):
+        """跨进程锁（shared为False时不加锁）"""
+        if not self.shared:
+            yield
+            return
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _ensure_open(self):
+        """首次使用（或fork后的子进程首次使用）时打开或创建映射文件（调用方需持有锁）"""
+        if self._mmap is not None and self._pid == os.getpid():
+            return
+        if self._mmap is not None:
+            # fork继承的映射和文件锁不能跨进程共用，重新打开
+            self._close_files()
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        if self.shared:
+            self._lock_file = open(self.path + '.lock', 'a+b')
+        
+        with self._process_lock():
+            migrated = []
+            if os.path.exists(self.path) and os.path.getsize(self.path) < self.HEADER_SIZE:
+                # 创建过程中崩溃留下的不完整文件
+                log_event(logging.WARNING, '情绪记录文件不完整，重新创建', file=self.path)
+                os.remove(self.path)
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
+                    magic, version, record_size, slots, total = self.HEADER.unpack_from(f.read(self.HEADER_SIZE))
+                if (magic, version, record_size) != (self.MAGIC, self.VERSION, self.RECORD.size) or slots < 1:
+                    log_event(logging.WARNING, '情绪记录文件格式不兼容，重新创建', file=self.path)
+                    os.remove(self.path)
+                elif os.path.getsize(self.path) < self._file_size(slots):
+                    # 文件被截断时补齐长度，缺失的槽位读出为空记录
+                    log_event(logging.WARNING, '情绪记录文件长度不足，补齐到预期大小', file=self.path,
+                              size=os.path.getsize(self.path), expected=self._file_size(slots))
+                    os.truncate(self.path, self._file_size(slots))
+                if os.path.exists(self.path) and slots != self.slots:
+                    # 容量变化时保留最新的记录
+                    old = EmotionRingBuffer(self.path, slots, slack=0)
+                    migrated = old.tail(min(self.capacity, slots))
+                    old.close()
+                    os.remove(self.path)
+            
+            exists = os.path.exists(self.path)
+            self._file = open(self.path, 'r+b' if exists else 'w+b')
+            if not exists:
+                self._file.truncate(self._file_size(self.slots))
+            self._mmap = mmap.mmap(self._file.fileno(), self._file_size(self.slots))
+            self._pid = os.getpid()
+            if exists:
+                self._total = self.HEADER.unpack_from(self._mmap, 0)[4]
+            else:
+                self._total = 0
+                self._write_header()
+            for record in migrated:
+                self._write_record(record)
+            self._dispatched = self._total
+        
+        if self.shared:
+            threading.Thread(target=self._follow, daemon=True).start()
+
+    def _refresh_locked(self):
+        """共享模式下从文件头读取其他进程写入后的最新写入数"""
+        if self.shared:
+            self._total = self.HEADER.unpack_from(self._mmap, 0)[4]
+
+    def _write_header(self):
+        self.HEADER.pack_into(self._mmap, 0, self.MAGIC, self.VERSION,
+                              self.RECORD.size, self.slots, self._total)
+
+    def _emotion_id(self, emotion):
+        try:
+            return self.EMOTION_IDS.index(emotion)
+        except ValueError:
+            return self.EMOTION_IDS.index('neutral')
+
+    def _write_record(self, record):
+        """写入一条记录并更新文件头，返回其写入序号（调用方需持有锁）"""
+        timestamp = record['timestamp']
+        if isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp).timestamp()
+        offset = self.HEADER_SIZE + (self._total % self.slots) * self.RECORD.size
+        self.RECORD.pack_into(
+            self._mmap, offset, timestamp,
+            self._emotion_id(record['user_emotion']), self._emotion_id(record['bot_emotion']), 0,
+            record['user_confidence'], record['bot_confidence'],
+            record['user_message_length'], record['bot_message_length'])
+        self._total += 1
+        self._write_header()
+        return self._total - 1
+
+    def _dispatch_locked(self):
+        """把本进程尚未通知过的记录（含其他进程写入的）依次交给监听器"""
+        for seq in range(max(self._dispatched, self._total - self.capacity), self._total):
+            record = self._read_locked(seq)
+            record['timestamp'] = datetime.fromisoformat(record['timestamp']).timestamp()
+            evicted = None
+            if seq >= self.capacity:
+                if seq - self.capacity >= self._total - self.slots:
+                    evicted = self._read_locked(seq - self.capacity)
+                else:
+                    self.lost_evictions += 1
+            for listener in self._listeners:
+                listener(record, evicted)
+        self._dispatched = self._total
+
+    def _follow(self):
+        """后台跟进其他进程写入的记录"""
+        pid = os.getpid()
+        while True:
+            time.sleep(SHARED_STATE_POLL_INTERVAL)
+            with self._lock:
+                if self._mmap is None or self._pid != pid:
+                    return
+                with self._process_lock(exclusive=False):
+                    self._refresh_locked()
+                    if self._total != self._dispatched:
+                        try:
+                            self._dispatch_locked()
+                        except Exception as e:
+                            log_event(logging.WARNING, '跟进情绪记录失败', error=str(e))
+
+    def _append_locked(self, record):
+        if self.shared:
+            self._refresh_locked()
+            seq = self._write_record(record)
+            self._dispatch_locked()
+            return seq
+        
+        timestamp = record['timestamp']
+        if isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp).timestamp()
+        evicted = None
+        if self._listeners and self._total >= self.capacity:
+            evicted = self._read_locked(self._total - self.capacity)
+        seq = self._write_record(record)
+        self._dispatched = self._total
+        if self._listeners:
+            # 监听器拿到的是写入后的存储值，与之后被淘汰时读出的值完全一致
+            stored = {**self._read_locked(seq), 'timestamp': timestamp}
+            for listener in self._listeners:
+                listener(stored, evicted)
+        return seq
+
+    def _read_locked(self, seq):
+        offset = self.HEADER_SIZE + (seq % self.slots) * self.RECORD.size
+        (timestamp, user_id, bot_id, _, user_confidence, bot_confidence,
+         user_length, bot_length) = self.RECORD.unpack_from(self._mmap, offset)
+        return {
+            'seq': seq,
+            'timestamp': datetime.fromtimestamp(timestamp).isoformat(),
+            'user_emotion': self.EMOTION_IDS[user_id] if user_id < len(self.EMOTION_IDS) else 'neutral',
+            'user_confidence': round(user_confidence, 4),
+            'bot_emotion': self.EMOTION_IDS[bot_id] if bot_id < len(self.EMOTION_IDS) else 'neutral',
+            'bot_confidence': round(bot_confidence, 4),
+            'user_message_length': user_length,
+            'bot_message_length': bot_length
+        }
+
+    def append(self, record):
+        """追加一条情绪记录，返回其写入序号"""
+        with self._lock:
+            self._ensure_open()
+            with self._process_lock():
+                return self._append_locked(record)
+
+    def since(self, seq, limit=None):
+        """返回写入序号不小于seq且仍在缓冲区中的记录（按时间顺序），最多limit条"""
+        with self._lock:
+            self._ensure_open()
+            self._refresh_locked()
+            start = max(seq, self._total - self.capacity, 0)
+            if limit is not None:
+                start = max(start, self._total - limit)
+            return [self._read_locked(i) for i in range(start, self._total)]
+
+    def iter_records(self, seq=0, chunk_size=1000):
+        """按时间顺序分批遍历序号不小于seq的记录，避免一次性解包整个缓冲区"""
+        while True:
+            with self._lock:
+                self._ensure_open()
+                self._refresh_locked()
+                start = max(seq, self._total - self.capacity, 0)
+                stop = min(start + chunk_size, self._total)
+                chunk = [self._read_locked(i) for i in range(start, stop)]
+            if not chunk:
+                return
+            yield from chunk
+            seq = stop
+
+    def tail(self, n):
+        """返回最近n条记录（按时间顺序）"""
+        with self._lock:
+            self._ensure_open()
+            self._refresh_locked()
+            start = max(self._total - min(n, self.capacity), 0)
+            return [self._read_locked(i) for i in range(start, self._total)]
+
+    def latest(self):
+        records = self.tail(1)
+        return records[0] if records else None
+
+    @property
+    def total_written(self):
+        """累计写入的记录数（含已被覆盖的）"""
+        with self._lock:
+            self._ensure_open()
+            self._refresh_locked()
+            return self._total
+
+    def __len__(self):
+        with self._lock:
+            self._ensure_open()
+            self._refresh_locked()
+            return min(self._total, self.capacity)
+
+    def flush(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.flush()
+
+    def _close_files(self):
+        self._mmap.close()
+        self._file.close()
+        if self._lock_file is not None:
+            self._lock_file.close()
+        self._mmap = None
+        self._file = None
+        self._lock_file = None
+
+    def close(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._close_files()
+
+
+EMOTION_HISTORY = EmotionRingBuffer(EMOTION_RING_FILE, EMOTION_RING_CAPACITY, shared=SHARED_STATE_ENABLED)
+
+def new_emotion_bucket():
+    """创建空的情绪统计桶"""
+    return {
+        'count': 0,
+        'user_emotions': {},
+        'bot_emotions': {},
+        'user_confidence': {},
+        'bot_confidence': {},
+        'user_length_sum': 0,
+        'bot_length_sum': 0
+    }
+
+def add_to_emotion_bucket(bucket, record, sign=1):
+    """把一条情绪记录计入（sign=-1时移出）统计桶"""
+    bucket['count'] += sign
+    for side in ('user', 'bot'):
+        emotion = record[f'{side}_emotion']
+        counts = bucket[f'{side}_emotions']
+        confidences = bucket[f'{side}_confidence']
+        counts[emotion] = counts.get(emotion, 0) + sign
+        confidences[emotion] = confidences.get(emotion, 0) + sign * round(record[f'{side}_confidence'] * CONFIDENCE_SCALE)
+        if counts[emotion] <= 0:
+            del counts[emotion]
+            del confidences[emotion]
+        bucket[f'{side}_length_sum'] += sign * record[f'{side}_message_length']
+
+def summarize_emotion_bucket(bucket):
+    """把统计桶转换为各情绪的次数和平均置信度"""
+    emotion_stats = {}
+    for emotion in set(bucket['user_emotions']) | set(bucket['bot_emotions']):
+        user_count = bucket['user_emotions'].get(emotion, 0)
+        bot_count = bucket['bot_emotions'].get(emotion, 0)
+        emotion_stats[emotion] = {
+            'user_count': user_count,
+            'bot_count': bot_count,
+            'user_avg_confidence': round(bucket['user_confidence'].get(emotion, 0) / CONFIDENCE_SCALE / user_count, 3) if user_count > 0 else 0,
+            'bot_avg_confidence': round(bucket['bot_confidence'].get(emotion, 0) / CONFIDENCE_SCALE / bot_count, 3) if bot_count > 0 else 0
+        }
+    return emotion_stats
+
+def merge_emotion_buckets(target, bucket):
+    """把bucket累加到target"""
+    target['count'] += bucket['count']
+    for key in ('user_emotions', 'bot_emotions', 'user_confidence', 'bot_confidence'):
+        for emotion, value in bucket[key].items():
+            target[key][emotion] = target[key].get(emotion, 0) + value
+    target['user_length_sum'] += bucket['user_length_sum']
+    target['bot_length_sum'] += bucket['bot_length_sum']
+
+
+class EmotionRollup:
+    """固定分辨率的情绪汇总桶，按本地时间对齐，超出保留期的桶自动淘汰"""
+
+    def __init__(self, resolution_seconds, retention_buckets):
+        self.resolution_seconds = resolution_seconds
+        self.retention_buckets = retention_buckets
+        self._buckets = {}
+        self._oldest = deque()  # 按创建顺序排列的桶起点，用于淘汰
+        self._changed = set()  # 上次take_changes以来新建或更新过的桶起点
+
+    def align(self, timestamp):
+        """返回timestamp所在桶的起始时间戳"""
+        offset = time.localtime(timestamp).tm_gmtoff
+        return (int(timestamp) + offset) // self.resolution_seconds * self.resolution_seconds - offset
+
+    def add(self, record):
+        start = self.align(record['timestamp'])
+        bucket = self._buckets.get(start)
+        if bucket is None:
+            bucket = self._buckets[start] = new_emotion_bucket()
+            self._oldest.append(start)
+            cutoff = start - self.resolution_seconds * self.retention_buckets
+            while self._oldest and self._oldest[0] <= cutoff:
+                self._buckets.pop(self._oldest.popleft(), None)
+        add_to_emotion_bucket(bucket, record)
+        self._changed.add(start)
+
+    def bucket_starts(self, start, end):
+        """生成[start, end)区间内每个桶的起始时间戳"""
+        bucket_start = self.align(start)
+        while bucket_start < end:
+            yield bucket_start
+            # 跨夏令时切换时按半个桶宽校正对齐
+            bucket_start = self.align(bucket_start + self.resolution_seconds * 3 // 2)
+
+    def query(self, start, end):
+        """返回区间内非空桶的(起始时间戳, 统计桶)列表"""
+        return [(bucket_start, self._buckets[bucket_start])
+                for bucket_start in self.bucket_starts(start, end)
+                if bucket_start in self._buckets]
+
+    def take_changes(self):
+        """返回(变化过的桶的副本, 当前保留的全部桶起点)，并清空变化记录
+
+        调用方在锁内取出，在锁外合并和序列化，写盘不阻塞情绪记录的追加。
+        """
+        changed = {start: {key: dict(value) if isinstance(value, dict) else value
+                           for key, value in self._buckets[start].items()}
+                   for start in self._changed if start in self._buckets}
+        self._changed.clear()
+        return changed, list(self._buckets)
+
+    def load(self, buckets):
+        """从dump()的结果恢复，丢弃已超出保留期的桶"""
+        starts = sorted(int(start) for start in buckets)
+        cutoff = (starts[-1] if starts else 0) - self.resolution_seconds * self.retention_buckets
+        self._buckets = {start: buckets[str(start)] for start in starts if start > cutoff}
+        self._oldest = deque(start for start in starts if start > cutoff)
+        self._changed = set(self._buckets)
+
+
+class EmotionAggregates:
+    """随情绪记录追加增量维护的统计
+
+    包括环形缓冲区内全部记录的总计、最近N条记录的主导情绪，
+    以及分钟/小时/天三级汇总；查询无需重新扫描情绪记录。
+    """
+
+    def __init__(self, trend_size=10, path=None, save_interval=EMOTION_ROLLUP_SAVE_INTERVAL):
+        self._lock = threading.Lock()
+        self.retained = new_emotion_bucket()
+        self._trend = deque(maxlen=trend_size)
+        self._trend_counts = {'user': Counter(), 'bot': Counter()}
+        self.rollups = {name: EmotionRollup(resolution, retention)
+                        for name, (resolution, retention) in EMOTION_ROLLUPS.items()}
+        self.path = path
+        self.save_interval = save_interval
+        self._rollup_seq = -1  # 已计入汇总桶的最大写入序号
+        self._saved_seq = -1  # 已写入文件的最大写入序号
+        self._persisted = {name: {} for name in self.rollups}  # 写盘用的汇总桶副本，只在保存时合并变化
+        self._save_lock = threading.Lock()
+        self._saver_pid = None
+
+    def on_append(self, record, evicted=None, rollup=True):
+        """计入一条记录；rollup为False时只更新保留区统计和趋势（汇总桶已从文件恢复）"""
+        with self._lock:
+            add_to_emotion_bucket(self.retained, record)
+            if evicted is not None:
+                add_to_emotion_bucket(self.retained, evicted, -1)
+            if len(self._trend) == self._trend.maxlen:
+                oldest = self._trend[0]
+                self._trend_counts['user'][oldest[0]] -= 1
+                self._trend_counts['bot'][oldest[1]] -= 1
+            self._trend.append((record['user_emotion'], record['bot_emotion']))
+            self._trend_counts['user'][record['user_emotion']] += 1
+            self._trend_counts['bot'][record['bot_emotion']] += 1
+            if rollup:
+                for resolution in self.rollups.values():
+                    resolution.add(record)
+                self._rollup_seq = max(self._rollup_seq, record.get('seq', -1))
+        if self._saver_pid != os.getpid():
+            self.start()
+
+    def start(self):
+        """启动定期保存汇总桶的后台线程（重复调用无副作用，fork出的进程各自启动）"""
+        if self.path is None:
+            return
+        with self._save_lock:
+            if self._saver_pid == os.getpid():
+                return
+            self._saver_pid = os.getpid()
+        threading.Thread(target=self._run_saver, daemon=True).start()
+
+    def _run_saver(self):
+        while True:
+            time.sleep(self.save_interval)
+            self.save()
+
+    def save(self):
+        """把汇总桶原子写入文件，重启后天级等长周期的统计不依赖环形缓冲区中的记录（没有新记录时不写）
+
+        由后台线程和退出时调用；锁内只取出变化过的桶，合并、序列化和写文件都在锁外进行。
+        """
+        if self.path is None:
+            return
+        with self._save_lock:
+            with self._lock:
+                if self._rollup_seq <= self._saved_seq:
+                    return
+                seq = self._rollup_seq
+                changes = {name: rollup.take_changes() for name, rollup in self.rollups.items()}
+            for name, (changed, starts) in changes.items():
+                persisted = self._persisted[name]
+                persisted.update(changed)
+                for start in persisted.keys() - set(starts):  # 已淘汰的桶
+                    del persisted[start]
+            snapshot = json.dumps({
+                'seq': seq,
+                'rollups': {name: {str(start): bucket for start, bucket in persisted.items()}
+                            for name, persisted in self._persisted.items()}
+            }, ensure_ascii=False)
+            temp_file = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(temp_file, 'w', encoding='utf-8') as f:
+                    f.write(snapshot)
+                os.replace(temp_file, self.path)
+            except OSError as e:
+                log_event(logging.WARNING, '保存情绪汇总失败', error=str(e))
+                return
+            with self._lock:
+                self._saved_seq = seq
+
+    def load(self):
+        """从文件恢复汇总桶，返回其中已计入的最大写入序号（无文件时为-1）"""
+        if self.path is None or not os.path.exists(self.path):
+            return -1
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+            with self._lock:
+                for name, buckets in saved['rollups'].items():
+                    if name in self.rollups:
+                        self.rollups[name].load(buckets)
+                self._rollup_seq = self._saved_seq = saved['seq']
+            return saved['seq']
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log_event(logging.WARNING, '读取情绪汇总文件失败，从情绪记录重建', error=str(e))
+            return -1
+
+    def statistics(self):
+        """返回缓冲区内全部记录的情绪分布和平均置信度"""
+        with self._lock:
+            return summarize_emotion_bucket(self.retained)
+
+    def recent_trend(self):
+        """返回最近N条记录中用户和机器人的主导情绪"""
+        with self._lock:
+            user_trend = +self._trend_counts['user']
+            bot_trend = +self._trend_counts['bot']
+            return {
+                'user_dominant_emotion': user_trend.most_common(1)[0][0] if user_trend else 'neutral',
+                'bot_dominant_emotion': bot_trend.most_common(1)[0][0] if bot_trend else 'neutral',
+                'sample_size': len(self._trend)
+            }
+
+    def range_query(self, start, end, resolution):
+        """从指定分辨率的汇总桶中查询[start, end)区间的情绪趋势"""
+        rollup = self.rollups[resolution]
+        totals = new_emotion_bucket()
+        buckets = []
+        with self._lock:
+            for bucket_start, bucket in rollup.query(start, end):
+                merge_emotion_buckets(totals, bucket)
+                buckets.append({
+                    'start': datetime.fromtimestamp(bucket_start).isoformat(),
+                    'count': bucket['count'],
+                    'user_emotions': dict(bucket['user_emotions']),
+                    'bot_emotions': dict(bucket['bot_emotions']),
+                    'avg_user_message_length': round(bucket['user_length_sum'] / bucket['count'], 1) if bucket['count'] else 0,
+                    'avg_bot_message_length': round(bucket['bot_length_sum'] / bucket['count'], 1) if bucket['count'] else 0
+                })
+        return {
+            'buckets': buckets,
+            'total_records': totals['count'],
+            'emotion_statistics': summarize_emotion_bucket(totals)
+        }
+
+
+EMOTION_AGGREGATES = EmotionAggregates(path=EMOTION_ROLLUP_FILE)
+EMOTION_HISTORY.add_listener(EMOTION_AGGREGATES.on_append)
+atexit.register(EMOTION_AGGREGATES.save)
+
+def restore_emotion_state():
+    """从持久化记录和汇总文件重建统计，并预热全局情感窗口，避免重启后冷启动"""
+    try:
+        rollup_seq = EMOTION_AGGREGATES.load()
+        if rollup_seq >= EMOTION_HISTORY.total_written:
+            # 情绪记录文件被重建过，序号从头开始，其中的记录都还没计入汇总
+            rollup_seq = -1
+        for record in EMOTION_HISTORY.iter_records():
+            record['timestamp'] = datetime.fromisoformat(record['timestamp']).timestamp()
+            EMOTION_AGGREGATES.on_append(record, rollup=record['seq'] > rollup_seq)
+        with GLOBAL_EMOTION_LOCK:
+            for record in EMOTION_HISTORY.tail(GLOBAL_EMOTION.sentiment.size):
+                GLOBAL_EMOTION.sentiment.add(record['user_emotion'])
+    except Exception as e:
+        log_event(logging.WARNING, '恢复情绪历史失败', error=str(e))
+
+restore_emotion_state()
+
+def update_global_sentiment(record, evicted=None):
+    """情绪记录追加时更新全局情感窗口（共享模式下也包括其他进程写入的记录）"""
+    with GLOBAL_EMOTION_LOCK:
+        GLOBAL_EMOTION.sentiment.add(record['user_emotion'])
+        GLOBAL_EMOTION.version += 1
+
+EMOTION_HISTORY.add_listener(update_global_sentiment)
+
+def record_emotion(user_message, bot_response, client_id=None):
+    """记录对话的情绪数据，同时更新全局和客户端的情绪分片"""
     user_emotion, user_confidence = analyze_emotion(user_message)
     bot_emotion, bot_confidence = analyze_emotion(bot_response)
     
+    now = time.time()
     emotion_record = {
-        'timestamp': datetime.now().isoformat(),
+        'timestamp': datetime.fromtimestamp(now).isoformat(),
         'user_emotion': user_emotion,
         'user_confidence': user_confidence,
         'bot_emotion': bot_emotion,
@@ -777,32 +3038,35 @@ def record_emotion(user_message, bot_response):
         'bot_message_length': len(bot_response)
     }
     
-    EMOTION_HISTORY.append(emotion_record)
+    emotion_record['seq'] = EMOTION_HISTORY.append({**emotion_record, 'timestamp': now})
+    if client_id:
+        EMOTION_SHARDS.update(client_id, lambda shard: shard.sentiment.add(user_emotion))
     return emotion_record
 
 def load_global_memory():
     """加载全局记忆文件"""
     try:
-        if os.path.exists(GLOBAL_MEMORY_FILE):
-            with open(GLOBAL_MEMORY_FILE, 'r', encoding='utf-8') as f:
-                return f.read().strip()
+        with trace_span('load_global_memory'):
+            if os.path.exists(GLOBAL_MEMORY_FILE):
+                with open(GLOBAL_MEMORY_FILE, 'r', encoding='utf-8') as f:
+                    return f.read().strip()
         return ""
     except Exception as e:
-        print(f"加载全局记忆文件失败: {e}")
+        log_event(logging.WARNING, '加载全局记忆文件失败', error=str(e))
         return ""
 
 def get_client_id():
     """获取客户端唯一标识"""
-    user_agent = request.headers.get('User-Agent', '')
-    client_ip = request.remote_addr
-    accept_language = request.headers.get('Accept-Language', '')
-    accept_encoding = request.headers.get('Accept-Encoding', '')
-    
+    return compute_client_id(request.remote_addr,
+                             request.headers.get('User-Agent', ''),
+                             request.headers.get('Accept-Language', ''),
+                             request.headers.get('Accept-Encoding', ''))
+
+def compute_client_id(client_ip, user_agent, accept_language, accept_encoding):
+    """根据客户端IP和请求头计算唯一标识（WSGI和ASGI模式共用）"""
     # 创建基于多个因素的唯一标识
     client_string = f"{client_ip}:{user_agent}:{accept_language}:{accept_encoding}"
-    client_id = hashlib.md5(client_string.encode()).hexdigest()
-    
-    return client_id
+    return hashlib.md5(client_string.encode()).hexdigest()
 
 def get_data_file(client_id):
     """根据客户端ID获取对应的数据文件路径"""
@@ -818,10 +3082,12 @@ def load_data(client_id):
     return {'context': [], 'history': []}
 
 def save_data(client_id, data):
-    """保存指定客户端的数据"""
+    """保存指定客户端的数据（先写临时文件再原子替换，其他进程不会读到写了一半的文件）"""
     data_file = get_data_file(client_id)
-    with open(data_file, 'w', encoding='utf-8') as f:
+    temp_file = f"{data_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(temp_file, data_file)
 
 def calculate_context_length(context, global_memory=""):
     """计算上下文总长度"""
@@ -840,7 +3106,7 @@ def trim_context(context, global_memory=""):
     
     # 如果可用长度太小，直接清空上下文
     if available_length < 500:
-        print(f"可用上下文长度太小({available_length}字符)，清空上下文")
+        log_event(logging.INFO, '可用上下文长度太小，清空上下文', available_length=available_length)
         return []
     
     # 从最新的对话开始，逐步添加直到达到长度限制
@@ -869,66 +3135,567 @@ def trim_context(context, global_memory=""):
     
     if len(trimmed_context) < len(context):
         removed_count = len(context) - len(trimmed_context)
-        print(f"上下文修剪：移除了{removed_count}条早期对话，保留{len(trimmed_context)}条")
+        log_event(logging.DEBUG, '上下文修剪', removed=removed_count, kept=len(trimmed_context))
     
     return trimmed_context
 
-def call_claude(message, context):
-    try:
-        # 加载全局记忆
-        global_memory = load_global_memory()
-        
-        # 获取当前情绪状态
-        emotion_state = calculate_xiaobu_emotion()
-        
-        # 修剪上下文以适应长度限制
+def build_claude_prompt(message, context, client_id=None):
+    """构建发送给Claude的完整prompt，返回(prompt, 情绪状态, 是否长消息)"""
+    # 加载全局记忆
+    global_memory = load_global_memory()
+    
+    # 获取当前情绪状态
+    with chat_stage('emotion'):
+        emotion_state = calculate_xiaobu_emotion(client_id)
+    
+    # 修剪上下文以适应长度限制
+    with chat_stage('trim_prompt'):
         trimmed_context = trim_context(context, global_memory)
-        
-        # 构建完整的prompt
-        prompt_parts = []
-        
-        # 添加全局记忆作为系统提示
-        if global_memory:
-            prompt_parts.append(f"# 系统提示\n{global_memory}")
-        
-        # 添加对话上下文
-        if trimmed_context:
-            prompt_parts.append(f"# 对话上下文\n{chr(10).join(trimmed_context)}")
-        
-        # 添加当前情绪状态，判断是否为长文回复
-        is_long_message = len(message) > 50
-        emotion_prompt = generate_emotion_prompt(emotion_state, is_long_message)
-        prompt_parts.append(f"# 当前情绪状态\n{emotion_prompt}")
-        
-        # 添加用户消息
-        prompt_parts.append(f"# 用户消息\n{message}")
-        
-        # 组合完整prompt
-        full_prompt = '\n\n'.join(prompt_parts)
-        
-        # 打印调试信息
-        total_length = len(full_prompt)
-        print(f"完整prompt长度: {total_length}字符")
-        print(f"用户输入: {message[:100]}{'...' if len(message) > 100 else ''}")
-        print(f"用户消息长度: {len(message)}字符，{'允许长回复' if is_long_message else '简短回复模式'}")
-        print(f"当前情绪: {emotion_state['emoji']} {emotion_state['emotion_type']} - {emotion_state['reason']}")
-        
-        result = subprocess.run(
-            ['claude', '-p', full_prompt],
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
-        
-        if result.returncode == 0:
-            response = result.stdout.strip()
-            print(f"Bot回复: {response[:100]}{'...' if len(response) > 100 else ''}")
-            return response, None
-        else:
-            error = result.stderr.strip()
-            print(f"错误信息: {error}")
-            return None, error
+    
+    # 构建完整的prompt
+    prompt_parts = []
+    
+    # 添加全局记忆作为系统提示
+    if global_memory:
+        prompt_parts.append(f"# 系统提示\n{global_memory}")
+    
+    # 添加对话上下文
+    if trimmed_context:
+        prompt_parts.append(f"# 对话上下文\n{chr(10).join(trimmed_context)}")
+    
+    # 添加当前情绪状态，判断是否为长文回复
+    is_long_message = len(message) > 50
+    emotion_prompt = generate_emotion_prompt(emotion_state, is_long_message)
+    prompt_parts.append(f"# 当前情绪状态\n{emotion_prompt}")
+    
+    # 添加用户消息
+    prompt_parts.append(f"# 用户消息\n{message}")
+    
+    # 组合完整prompt
+    return '\n\n'.join(prompt_parts), emotion_state, is_long_message
+
+class SlotRequest:
+    """一个等待Claude调用名额的请求"""
+
+    __slots__ = ('client_id', 'weight', 'notify', 'enqueued_at', 'granted', 'rejected')
+
+    def __init__(self, client_id, weight, notify):
+        self.client_id = client_id
+        self.weight = weight
+        self.notify = notify
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.rejected = False
+
+
+class FairSlotScheduler:
+    """按客户端加权公平分配Claude调用名额（差额轮询）
+
+    名额不足时请求进入各自客户端的队列，名额释放后在有排队的客户端之间轮流分配，
+    每轮客户端按权重获得额度，而不是按到达顺序先到先得；单个客户端排队过多时直接拒绝。
+    notify在名额分配给请求时被调用（持有内部锁，不能阻塞），同步和异步调用方都可使用。
+    """
+
+    def __init__(self, slots, max_queued_per_client=LLM_MAX_QUEUED_PER_CLIENT, max_clients=MAX_TRACKED_CLIENTS):
+        self.slots = slots
+        self.max_queued_per_client = max_queued_per_client
+        self.max_clients = max_clients
+        self.in_use = 0
+        self._queues = OrderedDict()  # 有排队的客户端（轮询顺序） -> deque[SlotRequest]
+        self._deficits = {}
+        self._clients = OrderedDict()  # 客户端统计，按最近使用淘汰
+        self._totals = Counter()
+        self._lock = threading.Lock()
+
+    def _client_stats(self, client_id):
+        stats = self._clients.pop(client_id, None) or Counter()
+        self._clients[client_id] = stats
+        if len(self._clients) > self.max_clients:
+            self._clients.popitem(last=False)
+        return stats
+
+    def _grant(self, slot_request):
+        self.in_use += 1
+        slot_request.granted = True
+        wait = time.monotonic() - slot_request.enqueued_at
+        stats = self._client_stats(slot_request.client_id)
+        stats['granted'] += 1
+        stats['wait_ms'] += wait * 1000
+        stats['max_wait_ms'] = max(stats['max_wait_ms'], wait * 1000)
+        CHAT_STAGE_SECONDS.observe(wait, stage='llm_queue')
+        self._totals['granted'] += 1
+        self._totals['wait_ms'] += wait * 1000
+        slot_request.notify()
+
+    def _dispatch(self):
+        while self.in_use < self.slots and self._queues:
+            client_id, queue = next(iter(self._queues.items()))
+            deficit = self._deficits.get(client_id, 0)
+            if deficit < 1:
+                deficit += queue[0].weight  # 轮到该客户端时按权重补充额度
+                if deficit < 1:
+                    self._deficits[client_id] = deficit
+                    self._queues.move_to_end(client_id)
+                    continue
+            self._deficits[client_id] = deficit - 1
+            self._grant(queue.popleft())
+            if not queue:
+                del self._queues[client_id]
+                self._deficits.pop(client_id, None)
+            elif self._deficits[client_id] < 1:
+                self._queues.move_to_end(client_id)  # 本轮额度用完，轮到下一个客户端
+
+    def enqueue(self, client_id, notify, weight=1):
+        """申请名额，返回SlotRequest；有空闲名额时立即分配，单客户端排队过多时标记rejected"""
+        slot_request = SlotRequest(client_id, weight, notify)
+        with self._lock:
+            self._totals['requests'] += 1
+            queue = self._queues.get(client_id)
+            if queue is not None and len(queue) >= self.max_queued_per_client:
+                slot_request.rejected = True
+                self._client_stats(client_id)['rejected'] += 1
+                self._totals['rejected'] += 1
+                return slot_request
+            if self.in_use < self.slots and not self._queues:
+                self._grant(slot_request)
+            else:
+                self._queues.setdefault(client_id, deque()).append(slot_request)
+                self._client_stats(client_id)['queued'] += 1
+                self._totals['queued'] += 1
+        return slot_request
+
+    def withdraw(self, slot_request, reason='timeouts'):
+        """放弃排队（超时或取消），返回请求是否已经获得名额（已获得时调用方仍需release）"""
+        with self._lock:
+            if slot_request.granted or slot_request.rejected:
+                return slot_request.granted
+            queue = self._queues.get(slot_request.client_id)
+            if queue is not None and slot_request in queue:
+                queue.remove(slot_request)
+                if not queue:
+                    del self._queues[slot_request.client_id]
+                    self._deficits.pop(slot_request.client_id, None)
+            slot_request.rejected = True
+            self._client_stats(slot_request.client_id)[reason] += 1
+            self._totals[reason] += 1
+            return False
+
+    def release(self, slot_request):
+        with self._lock:
+            if not slot_request.granted:
+                return
+            slot_request.granted = False
+            self.in_use -= 1
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, client_id, timeout=LLM_QUEUE_TIMEOUT, weight=1, cancel_token=None):
+        """同步获取名额，产出是否获得名额；排队期间请求被取消时立即放弃排队"""
+        granted = threading.Event()
+        slot_request = self.enqueue(client_id, granted.set, weight)
+        acquired = slot_request.granted
+        if not slot_request.rejected and not acquired:
+            with trace_span('llm_queue') as span:
+                deadline = time.monotonic() + timeout
+                if cancel_token:
+                    cancel_token.add_callback(granted.set)
+                try:
+                    while not granted.is_set() and time.monotonic() < deadline:
+                        granted.wait(min(DISCONNECT_CHECK_INTERVAL, max(0, deadline - time.monotonic())))
+                        if cancel_token and cancel_token.check():
+                            break
+                finally:
+                    if cancel_token:
+                        cancel_token.remove_callback(granted.set)
+                # 已获得名额时withdraw直接返回True，否则按取消或超时退出队列
+                cancelled = cancel_token is not None and cancel_token.cancelled
+                acquired = self.withdraw(slot_request, 'cancelled' if cancelled else 'timeouts')
+                if span:
+                    span.set(granted=acquired)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.release(slot_request)
+
+    def stats(self, top=10):
+        with self._lock:
+            granted = self._totals['granted']
+            busiest = sorted(self._clients.items(), key=lambda item: item[1]['wait_ms'], reverse=True)[:top]
+            return {
+                'slots': self.slots,
+                'in_use': self.in_use,
+                'queued_now': sum(len(queue) for queue in self._queues.values()),
+                'waiting_clients': len(self._queues),
+                'requests': self._totals['requests'],
+                'granted': granted,
+                'queued': self._totals['queued'],
+                'rejected': self._totals['rejected'],
+                'timeouts': self._totals['timeouts'],
+                'cancelled': self._totals['cancelled'],
+                'avg_wait_ms': round(self._totals['wait_ms'] / granted, 1) if granted else 0,
+                'clients': [{
+                    'client_id': client_id[:8],
+                    'granted': stats['granted'],
+                    'queued': stats['queued'],
+                    'rejected': stats['rejected'],
+                    'timeouts': stats['timeouts'],
+                    'avg_wait_ms': round(stats['wait_ms'] / stats['granted'], 1) if stats['granted'] else 0,
+                    'max_wait_ms': round(stats['max_wait_ms'], 1)
+                } for client_id, stats in busiest]
+            }
+
+
+LLM_SCHEDULER = FairSlotScheduler(LLM_SLOTS)
+LLM_BUSY_ERROR = "小布现在忙不过来，请稍后再试"
+CHAT_CANCELLED_ERROR = "请求已取消"
+
+
+class ChatCancelled(Exception):
+    """聊天请求已被取消（用户停止或客户端断开）"""
+
+
+class CancelToken:
+    """绑定到一个进行中聊天请求的取消令牌
+
+    cancel可在任意线程调用，注册的回调（结束子进程、唤醒排队等待等）随即执行；
+    传入disconnect_probe时，check会定期探测客户端连接，断开后自动取消。
+    """
+
+    def __init__(self, client_id=None, request_id=None, disconnect_probe=None):
+        self.client_id = client_id
+        self.request_id = request_id
+        self.reason = None
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._probe = disconnect_probe
+        self._last_probe = 0
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason='client'):
+        """取消请求，返回是否由本次调用取消"""
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback()
+        return True
+
+    def add_callback(self, callback):
+        """注册取消回调，已取消时立即执行"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def check(self):
+        """返回是否已取消；有断线探测时按间隔探测客户端连接"""
+        if self._probe is not None and not self._event.is_set():
+            now = time.monotonic()
+            if now - self._last_probe >= DISCONNECT_CHECK_INTERVAL:
+                self._last_probe = now
+                if self._probe():
+                    self.cancel('disconnect')
+        return self._event.is_set()
+
+
+class CancelRegistry:
+    """进行中聊天请求的取消令牌表，并统计取消回收的Claude调用容量
+
+    回收量按已完成调用的平均耗时估算：被结束的子进程节省平均耗时减去已运行时长，
+    排队中取消和跳过的重试各节省一次完整调用。
+
+    传入shared（多worker部署）时，本进程找不到的请求把取消命令写入共享数据库，
+    各进程有进行中的请求时由后台线程定期读取，取消属于自己的请求。
+    """
+
+    def __init__(self, shared=None):
+        self.shared = shared
+        self._tokens = {}  # (client_id, request_id) -> CancelToken
+        self._stats = Counter()
+        self._lock = threading.Lock()
+        self._poller_pid = None
+
+    def register(self, client_id, request_id=None, disconnect_probe=None):
+        token = CancelToken(client_id, request_id or uuid.uuid4().hex, disconnect_probe)
+        with self._lock:
+            self._tokens[(client_id, token.request_id)] = token
+            if self.shared is not None and self._poller_pid != os.getpid():
+                self._poller_pid = os.getpid()
+                threading.Thread(target=self._poll_forwarded, daemon=True).start()
+        return token
+
+    def unregister(self, token):
+        with self._lock:
+            if self._tokens.get((token.client_id, token.request_id)) is token:
+                del self._tokens[(token.client_id, token.request_id)]
+            if token.cancelled:
+                self._stats[f'cancelled_{token.reason}'] += 1
+
+    @contextmanager
+    def track(self, client_id, request_id=None, disconnect_probe=None):
+        token = self.register(client_id, request_id, disconnect_probe)
+        try:
+            yield token
+        finally:
+            self.unregister(token)
+
+    def cancel(self, client_id, request_id, reason='client'):
+        """取消客户端自己的进行中请求，返回是否找到该请求"""
+        with self._lock:
+            token = self._tokens.get((client_id, request_id))
+        if token is None:
+            return False
+        token.cancel(reason)
+        return True
+
+    def forward(self, client_id, request_id, reason='client'):
+        """把取消命令写入共享数据库，交给处理该请求的进程（请求可能还没开始）"""
+        now = time.time()
+        with self.shared.transaction() as conn:
+            conn.execute('DELETE FROM cancels WHERE created < ?', (now - CANCEL_FORWARD_TTL,))
+            conn.execute('INSERT OR REPLACE INTO cancels (client_id, request_id, reason, created) VALUES (?, ?, ?, ?)',
+                         (client_id, request_id, reason, now))
+        with self._lock:
+            self._stats['forwarded_cancels'] += 1
+
+    def _poll_forwarded(self):
+        """后台读取其他进程转来的取消命令（本进程没有进行中的请求时不查询）"""
+        pid = os.getpid()
+        while self._poller_pid == pid:
+            time.sleep(CANCEL_POLL_INTERVAL)
+            with self._lock:
+                keys = set(self._tokens)
+            if not keys:
+                continue
+            try:
+                conn = self.shared.connection()
+                rows = conn.execute('SELECT client_id, request_id, reason FROM cancels').fetchall()
+                for client_id, request_id, reason in rows:
+                    if (client_id, request_id) in keys:
+                        conn.execute('DELETE FROM cancels WHERE client_id = ? AND request_id = ?',
+                                     (client_id, request_id))
+                        self.cancel(client_id, request_id, reason)
+            except sqlite3.Error as e:
+                log_event(logging.WARNING, '读取转发的取消命令失败', error=str(e))
+
+    def _avg_call_seconds(self):
+        calls = self._stats['completed_calls']
+        return self._stats['completed_call_seconds'] / calls if calls else CLAUDE_TIMEOUT
+
+    def record_call(self, seconds):
+        with self._lock:
+            self._stats['completed_calls'] += 1
+            self._stats['completed_call_seconds'] += seconds
+
+    def record_kill(self, elapsed):
+        with self._lock:
+            self._stats['killed_processes'] += 1
+            self._stats['killed_after_seconds'] += elapsed
+            self._stats['reclaimed_slot_seconds'] += max(0, self._avg_call_seconds() - elapsed)
+
+    def record_avoided_call(self, kind):
+        """kind: avoided_calls（开始调用前已取消）或skipped_retries（取消后不再重试）"""
+        with self._lock:
+            self._stats[kind] += 1
+            self._stats['reclaimed_slot_seconds'] += self._avg_call_seconds()
+
+    def stats(self):
+        with self._lock:
+            stats = self._stats
+            return {
+                'in_flight': len(self._tokens),
+                'cancelled_by_client': stats['cancelled_client'],
+                'cancelled_by_disconnect': stats['cancelled_disconnect'],
+                'forwarded_cancels': stats['forwarded_cancels'],
+                'killed_processes': stats['killed_processes'],
+                'avoided_calls': stats['avoided_calls'],
+                'skipped_retries': stats['skipped_retries'],
+                'avg_call_seconds': round(self._avg_call_seconds(), 2),
+                'killed_after_seconds': round(stats['killed_after_seconds'], 2),
+                'reclaimed_slot_seconds': round(stats['reclaimed_slot_seconds'], 2)
+            }
+
+
+CANCEL_TOKENS = CancelRegistry(SHARED_STATE)
+
+def connection_closed_probe(environ):
+    """返回探测客户端是否已断开的函数；服务器未提供底层连接时返回None"""
+    conn = environ.get('werkzeug.socket')
+    if conn is None:
+        return None
+    
+    def closed():
+        try:
+            # 请求体已读完，对端关闭后窥探读取会立即返回空
+            return conn.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+        except (BlockingIOError, InterruptedError, ValueError):
+            return False
+        except OSError:
+            return True
+    return closed
+
+def kill_process_group(process):
+    """结束子进程及其派生的整个进程组"""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def wait_with_rusage(process, timeout=None):
+    """等待子进程退出并通过wait4取得它（含已回收的后代进程）的资源用量；超时抛出TimeoutExpired"""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        pid, status, usage = os.wait4(process.pid, 0 if deadline is None else os.WNOHANG)
+        if pid:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            return usage
+        if time.monotonic() >= deadline:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        time.sleep(0.01)
+
+
+class ChildUsageSampler:
+    """用psutil定期读取子进程的CPU时间和内存峰值
+
+    子进程由asyncio负责回收、拿不到wait4结果时使用，CPU时间取最后一次采样值，略低于实际。
+    """
+
+    def __init__(self, pid):
+        try:
+            self._process = psutil.Process(pid)
+        except psutil.Error:
+            self._process = None
+        self.cpu_seconds = 0.0
+        self.max_rss_kb = 0
+
+    def sample(self):
+        if self._process is None:
+            return
+        try:
+            with self._process.oneshot():
+                times = self._process.cpu_times()
+                rss = self._process.memory_info().rss
+        except psutil.Error:
+            self._process = None
+            return
+        self.cpu_seconds = max(self.cpu_seconds,
+                               times.user + times.system + times.children_user + times.children_system)
+        self.max_rss_kb = max(self.max_rss_kb, rss // 1024)
+
+
+def run_claude_process(prompt, timeout, on_chunk=None, cancel_token=None, purpose='chat', client_id=None):
+    """运行claude命令并流式读取输出，返回(returncode, stdout, stderr)
+
+    on_chunk在每次读到新的标准输出文本时被调用；超时会结束子进程组并抛出TimeoutExpired，
+    cancel_token被取消时结束子进程组并抛出ChatCancelled。每次调用（包括被结束的）按purpose记入费用账本。
+    """
+    if cancel_token and cancel_token.check():
+        raise ChatCancelled(cancel_token.reason)
+    kind = 'privacy' if purpose == 'privacy' else 'chat'
+    # 子进程放在独立的进程组中，结束时连同它派生的进程一起结束
+    process = subprocess.Popen(['claude', '-p', prompt],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+    LLM_PROCESSES_IN_FLIGHT.inc(kind=kind)
+    started = time.monotonic()
+    usage = None
+    deadline = started + timeout
+    stdout_fd, stderr_fd = process.stdout.fileno(), process.stderr.fileno()
+    chunks = {stdout_fd: [], stderr_fd: []}
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    open_fds = [stdout_fd, stderr_fd]
+    try:
+        while open_fds:
+            if cancel_token and cancel_token.check():
+                raise ChatCancelled(cancel_token.reason)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(process.args, timeout)
+            ready, _, _ = select.select(open_fds, [], [], min(remaining, 0.1))
+            for fd in ready:
+                data = os.read(fd, 65536)
+                if not data:
+                    open_fds.remove(fd)
+                    continue
+                chunks[fd].append(data)
+                if fd == stdout_fd and on_chunk:
+                    text = decoder.decode(data)
+                    if text:
+                        on_chunk(text)
+        usage = wait_with_rusage(process, max(0, deadline - time.monotonic()))
+    except BaseException as e:
+        kill_process_group(process)
+        if process.returncode is None:
+            usage = wait_with_rusage(process)
+        if isinstance(e, ChatCancelled):
+            CANCEL_TOKENS.record_kill(time.monotonic() - started)
+        raise
+    finally:
+        process.stdout.close()
+        process.stderr.close()
+        elapsed = time.monotonic() - started
+        stdout = b''.join(chunks[stdout_fd]).decode('utf-8', errors='replace')
+        LLM_PROCESSES_IN_FLIGHT.dec(kind=kind)
+        if kind == 'chat':
+            CHAT_STAGE_SECONDS.observe(elapsed, stage='llm')
+        COST_LEDGER.record(client_id, purpose, len(prompt), len(stdout), elapsed,
+                           usage.ru_utime + usage.ru_stime if usage else 0.0,
+                           usage.ru_maxrss if usage else 0,
+                           failed=process.returncode != 0)
+    
+    if kind == 'chat':
+        CANCEL_TOKENS.record_call(elapsed)
+    return (process.returncode, stdout,
+            b''.join(chunks[stderr_fd]).decode('utf-8', errors='replace'))
+
+def prepare_claude_prompt(message, context, client_id=None):
+    """构建prompt并打印调试信息"""
+    with chat_stage('prompt'):
+        full_prompt, emotion_state, is_long_message = build_claude_prompt(message, context, client_id)
+    
+    log_event(logging.DEBUG, 'prompt已构建', client_id,
+              prompt_length=len(full_prompt),
+              message=redact(message),
+              long_reply=is_long_message,
+              emotion=emotion_state['emotion_type'],
+              emotion_reason=emotion_state['reason'])
+    return full_prompt
+
+def parse_claude_result(returncode, stdout, stderr):
+    """把claude进程的输出转换为(回复, 错误)"""
+    if returncode == 0:
+        response = stdout.strip()
+        log_event(logging.DEBUG, 'Claude回复', response=redact(response))
+        return response, None
+    else:
+        error = stderr.strip()
+        log_event(logging.WARNING, 'Claude调用失败', returncode=returncode, error=error[:500])
+        return None, error
+
+def call_claude(message, context, client_id=None, on_chunk=None, cancel_token=None, purpose='chat'):
+    try:
+        full_prompt = prepare_claude_prompt(message, context, client_id)
+        with trace_span('claude_process', prompt_length=len(full_prompt)):
+            result = run_claude_process(full_prompt, CLAUDE_TIMEOUT, on_chunk, cancel_token, purpose, client_id)
+        return parse_claude_result(*result)
+    except ChatCancelled:
+        log_event(logging.INFO, '请求已取消，Claude进程已结束', client_id, reason=cancel_token.reason)
+        return None, CHAT_CANCELLED_ERROR
     except subprocess.TimeoutExpired:
+        LLM_TIMEOUTS_TOTAL.inc()
         return None, "请求超时"
     except FileNotFoundError:
         return None, "Claude 命令未找到"
@@ -1010,15 +3777,13 @@ PERSONA_KEYWORDS = [
 FILE_LOCKS = {}
 
 def get_file_lock(file_path):
-    """获取文件锁，确保并发安全"""
-    if file_path not in FILE_LOCKS:
-        FILE_LOCKS[file_path] = threading.Lock()
-    return FILE_LOCKS[file_path]
+    """获取进程内的文件锁（跨进程由写入时的flock保证）"""
+    return FILE_LOCKS.setdefault(file_path, threading.Lock())
 
 def safe_append_to_file(file_path, content):
     """并发安全地追加内容到文件"""
     lock = get_file_lock(file_path)
-    with lock:
+    with trace_span('append_file', file=file_path), lock:
         try:
             with open(file_path, 'a', encoding='utf-8') as f:
                 fcntl.flock(f.fileno(), fcntl.LOCK_EX)
@@ -1026,7 +3791,7 @@ def safe_append_to_file(file_path, content):
                 fcntl.flock(f.fileno(), fcntl.LOCK_UN)
             return True
         except Exception as e:
-            print(f"写入文件失败: {e}")
+            log_event(logging.ERROR, '写入文件失败', file=file_path, error=str(e))
             return False
 
 def detect_privacy_issues(message):
@@ -1122,7 +3887,7 @@ def process_persona_questions(message, persona_keywords, is_question):
     if not persona_keywords or not is_question:
         return
     
-    print(f"检测到人设问题: {persona_keywords}")
+    log_event(logging.INFO, '检测到人设问题', keywords=persona_keywords)
     
     # 提取问句
     question = extract_persona_question(message)
@@ -1136,11 +3901,11 @@ def process_persona_questions(message, persona_keywords, is_question):
     # 安全地写入question.md文件
     success = safe_append_to_file(PERSONA_QUESTION_FILE, record_content)
     if success:
-        print(f"人设问题已记录到 {PERSONA_QUESTION_FILE}: {question}")
+        log_event(logging.INFO, '人设问题已记录', file=PERSONA_QUESTION_FILE, question=redact(question))
     else:
-        print("人设问题记录失败")
+        log_event(logging.ERROR, '人设问题记录失败', file=PERSONA_QUESTION_FILE)
 
-def call_claude_for_privacy_analysis(message, privacy_issues):
+def call_claude_for_privacy_analysis(message, privacy_issues, client_id=None):
     """调用Claude分析和拆解隐私问题"""
     analysis_prompt = f"""
 请分析以下消息中的隐私问题，并将其拆解为具体的隐私关注点：
@@ -1165,29 +3930,34 @@ def call_claude_for_privacy_analysis(message, privacy_issues):
 """
     
     try:
-        result = subprocess.run(
-            ['claude', '-p', analysis_prompt],
-            capture_output=True,
-            text=True,
-            timeout=15
-        )
+        # 与聊天共用Claude调用名额，排队超时或队列已满时跳过分析，不额外启动进程
+        with LLM_SCHEDULER.slot(PRIVACY_ANALYSIS_QUEUE, weight=PRIVACY_ANALYSIS_WEIGHT) as acquired:
+            if not acquired:
+                PRIVACY_ANALYSIS_TOTAL.inc(result='skipped')
+                return "分析跳过: Claude调用名额已满"
+            with chat_stage('privacy_analysis'):
+                returncode, stdout, stderr = run_claude_process(analysis_prompt, 15, purpose='privacy',
+                                                                client_id=client_id)
         
-        if result.returncode == 0:
-            return result.stdout.strip()
+        if returncode == 0:
+            PRIVACY_ANALYSIS_TOTAL.inc(result='ok')
+            return stdout.strip()
         else:
-            return f"分析失败: {result.stderr.strip()}"
+            PRIVACY_ANALYSIS_TOTAL.inc(result='error')
+            return f"分析失败: {stderr.strip()}"
     except Exception as e:
+        PRIVACY_ANALYSIS_TOTAL.inc(result='timeout' if isinstance(e, subprocess.TimeoutExpired) else 'error')
         return f"分析异常: {str(e)}"
 
-def process_privacy_issues(message, privacy_issues):
+def process_privacy_issues(message, privacy_issues, client_id=None):
     """处理检测到的安全问题"""
     if not privacy_issues:
         return
     
-    print(f"检测到安全问题: {privacy_issues}")
+    log_event(logging.INFO, '检测到安全问题', keywords=privacy_issues)
     
     # 使用Claude分析安全问题
-    analysis_result = call_claude_for_privacy_analysis(message, privacy_issues)
+    analysis_result = call_claude_for_privacy_analysis(message, privacy_issues, client_id)
     
     # 生成记录内容
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -1203,9 +3973,9 @@ def process_privacy_issues(message, privacy_issues):
     # 安全地写入security.md文件
     success = safe_append_to_file(QUESTION_FILE, record_content)
     if success:
-        print(f"安全问题已记录到 {QUESTION_FILE}")
+        log_event(logging.INFO, '安全问题已记录', file=QUESTION_FILE)
     else:
-        print("安全问题记录失败")
+        log_event(logging.ERROR, '安全问题记录失败', file=QUESTION_FILE)
 
 def generate_emotion_prompt(emotion_state, is_long_message=False):
     """生成基于当前情绪的prompt指令"""
@@ -1360,9 +4130,548 @@ def generate_emotion_prompt(emotion_state, is_long_message=False):
     
     return prompt
 
+class Subscriber:
+    """单个实时推送连接的有界事件队列，队列元素为(事件ID, 事件)"""
+
+    def __init__(self, topic, maxsize=SSE_SUBSCRIBER_BUFFER):
+        self.topic = topic
+        self.maxsize = maxsize
+        self.closed = False
+        self.dropped = False  # 是否因积压过多被断开
+        self.resumed = False  # 是否从Last-Event-ID续传
+        self.start_id = None  # 订阅时主题的最新事件ID
+        self.waker = None  # 有新事件或关闭时调用，供asyncio等非线程等待方使用
+        self._events = deque()
+        self._preloaded = 0  # 队首尚未取出的补发事件数，不计入积压
+        self._cond = threading.Condition()
+
+    def _wake(self):
+        if self.waker:
+            self.waker()
+
+    def preload(self, events):
+        """预先放入重连期间错过的事件（不计入积压上限，最多为重放缓冲区大小）"""
+        with self._cond:
+            self._events.extend(events)
+            self._preloaded += len(events)
+            self.resumed = True
+
+    def offer(self, event):
+        """投递事件，积压超过上限时关闭订阅并返回False"""
+        with self._cond:
+            if self.closed:
+                return False
+            if len(self._events) - self._preloaded >= self.maxsize:
+                self.closed = True
+                self.dropped = True
+                self._cond.notify_all()
+                self._wake()
+                return False
+            self._events.append(event)
+            self._cond.notify()
+            self._wake()
+            return True
+
+    def get(self, timeout=None):
+        """取出下一个(事件ID, 事件)，超时或队列已取空且订阅已关闭时返回None
+
+        积压过多被断开时仍先取完已入队的事件（都在被丢弃的事件之前），客户端据此用最后的ID续传。
+        """
+        with self._cond:
+            if not self._events and not self.closed:
+                self._cond.wait(timeout)
+            if self._events:
+                if self._preloaded:
+                    self._preloaded -= 1
+                return self._events.popleft()
+            return None
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+            self._wake()
+
+
+_SSE_STREAM_EPOCH = (None, None)  # (进程ID, 事件ID前缀)
+
+def sse_stream_epoch():
+    """本进程的事件ID前缀
+
+    每个进程（包括预加载后fork出的worker）各自生成随机前缀，事件序号只在本进程内有效；
+    服务重启或重连落到其他worker时旧ID对不上前缀，退回完整初始化而不是补发错误的事件。
+    """
+    global _SSE_STREAM_EPOCH
+    pid, epoch = _SSE_STREAM_EPOCH
+    if pid != os.getpid():
+        pid, epoch = _SSE_STREAM_EPOCH = os.getpid(), uuid.uuid4().hex[:8]
+    return epoch
+
+
+class BroadcastTopic:
+    """广播主题：事件只序列化一次，再扇出到所有订阅者的队列
+
+    每个事件分配单调递增的ID，最近的事件保存在有界重放缓冲区中，
+    断线重连时只补发Last-Event-ID之后错过的事件。
+    """
+
+    def __init__(self, name, producer=None, interval=None, replay_size=SSE_REPLAY_BUFFER):
+        self.name = name
+        self.producer = producer  # 定时生产者，返回要广播的数据，返回None时跳过
+        self.interval = interval
+        self.last_event = None
+        self.last_seq = 0
+        self.published_count = 0
+        self.dropped_count = 0
+        self.replayed_count = 0
+        self.reset_count = 0  # 无法续传、退回完整初始化的重连次数
+        self._replay = deque(maxlen=replay_size)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._producer_thread = None
+
+    @staticmethod
+    def event_id(seq):
+        return f'{sse_stream_epoch()}-{seq}'
+
+    @staticmethod
+    def parse_event_id(event_id):
+        """解析事件ID，不属于本次运行或格式错误时返回None"""
+        epoch, _, seq = (event_id or '').strip().rpartition('-')
+        if epoch != sse_stream_epoch() or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def current_id(self):
+        with self._lock:
+            return self.event_id(self.last_seq)
+
+    def _missed_events(self, seq):
+        """返回seq之后错过的事件，无法续传时返回None；调用方需持有锁"""
+        if seq is None or seq > self.last_seq:
+            return None
+        missed = self.last_seq - seq
+        if missed > len(self._replay):
+            return None  # 错过的事件已移出重放缓冲区
+        # 事件ID连续，直接按位置从缓冲区尾部取出，开销只与错过的事件数有关
+        return [self._replay[i] for i in range(len(self._replay) - missed, len(self._replay))]
+
+    def can_resume(self, last_event_id):
+        with self._lock:
+            return self._missed_events(self.parse_event_id(last_event_id)) is not None
+
+    def _run_producer(self):
+        """单一生产者线程，没有订阅者时退出"""
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._producer_thread = None
+                    return
+            try:
+                data = self.producer()
+                if data is not None:  # 生产者返回None表示没有变化
+                    self.publish(data)
+            except Exception as e:
+                log_event(logging.ERROR, '实时推送生产者错误', topic=self.name, error=str(e))
+            time.sleep(self.interval)
+
+    def subscribe(self, maxsize=SSE_SUBSCRIBER_BUFFER, last_event_id=None):
+        """订阅主题；提供last_event_id且仍在重放缓冲区内时，先补发错过的事件"""
+        subscriber = Subscriber(self.name, maxsize)
+        with self._lock:
+            if last_event_id:
+                missed = self._missed_events(self.parse_event_id(last_event_id))
+                if missed is None:
+                    self.reset_count += 1
+                else:
+                    subscriber.preload(missed)
+                    self.replayed_count += len(missed)
+            subscriber.start_id = self.event_id(self.last_seq)
+            self._subscribers.add(subscriber)
+            if self.producer and self._producer_thread is None:
+                self._producer_thread = threading.Thread(target=self._run_producer, daemon=True)
+                self._producer_thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        subscriber.close()
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, data):
+        """广播一条数据（只序列化一次），丢弃处理不过来的订阅者"""
+        event = json.dumps(data, ensure_ascii=False)
+        with self._lock:
+            self.last_seq += 1
+            item = (self.event_id(self.last_seq), event)
+            self._replay.append(item)
+            self.last_event = event
+            self.published_count += 1
+            subscribers = list(self._subscribers)
+        slow = [subscriber for subscriber in subscribers if not subscriber.offer(item)]
+        if slow:
+            with self._lock:
+                for subscriber in slow:
+                    if subscriber in self._subscribers:
+                        self._subscribers.discard(subscriber)
+                        self.dropped_count += subscriber.dropped
+        return len(subscribers) - len(slow)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'subscribers': len(self._subscribers),
+                'published': self.published_count,
+                'last_event_id': self.event_id(self.last_seq),
+                'replay_buffered': len(self._replay),
+                'replayed_events': self.replayed_count,
+                'resume_resets': self.reset_count,
+                'dropped_subscribers': self.dropped_count,
+                'producer_running': self._producer_thread is not None
+            }
+
+
+class BroadcastHub:
+    """按主题组织的实时推送广播中心"""
+
+    def __init__(self):
+        self.topics = {}
+
+    def register(self, name, producer=None, interval=None, replay_size=SSE_REPLAY_BUFFER):
+        self.topics[name] = BroadcastTopic(name, producer, interval, replay_size)
+        return self.topics[name]
+
+    def subscribe(self, name, last_event_id=None):
+        return self.topics[name].subscribe(last_event_id=last_event_id)
+
+    def unsubscribe(self, subscriber):
+        self.topics[subscriber.topic].unsubscribe(subscriber)
+
+    def publish(self, name, data):
+        return self.topics[name].publish(data)
+
+    def stats(self):
+        return {name: topic.stats() for name, topic in self.topics.items()}
+
+
+def build_status_event():
+    """构建服务状态推送数据"""
+    update_system_metrics()
+    request_count, error_count, error_rate = request_counts()
+    return {
+        'timestamp': datetime.now().isoformat(),
+        'cpu_usage': SERVICE_STATUS['cpu_usage'],
+        'memory_usage': SERVICE_STATUS['memory_usage'],
+        'disk_usage': SERVICE_STATUS['disk_usage'],
+        'request_count': request_count,
+        'error_count': error_count,
+        'error_rate': error_rate
+    }
+
+def publish_emotion_record(record, evicted=None):
+    """情绪记录追加时直接广播给订阅者"""
+    HUB.publish('emotions', {
+        'timestamp': datetime.now().isoformat(),
+        'new_emotions': [{**record, 'timestamp': datetime.fromtimestamp(record['timestamp']).isoformat()}],
+        'total_count': record['seq'] + 1
+    })
+
+
+class EmotionSnapshotPublisher:
+    """维护小布情绪快照及其版本号，心情变化时只推送变化的字段
+
+    只比较稳定的心情字段；情绪值、青春期随机波动、时间等每次计算都会变化，
+    单独变化时不算心情变化，随下一次心情变化一并推送。
+    """
+
+    MOOD_FIELDS = ('emotion', 'emoji', 'reason', 'stress_level', 'weather')  # 参与变化判断的字段
+    IGNORED_FIELDS = ('timestamp',)  # 不放进增量的字段
+
+    def __init__(self):
+        self.version = 0
+        self._snapshot = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """重新计算情绪快照，返回增量事件；没有变化时返回None"""
+        payload = build_xiaobu_emotion_payload(update_state=False)
+        with self._lock:
+            if all(self._snapshot.get(key) == payload[key] for key in self.MOOD_FIELDS):
+                return None
+            changes = {key: value for key, value in payload.items()
+                       if key not in self.IGNORED_FIELDS and self._snapshot.get(key) != value}
+            self._snapshot = payload
+            self.version += 1
+            return {
+                'type': 'delta',
+                'version': self.version,
+                'timestamp': payload['timestamp'],
+                'changes': changes
+            }
+
+    def snapshot_event(self):
+        """返回完整快照事件，供新连接初始化"""
+        with self._lock:
+            if self._snapshot:
+                return {'type': 'snapshot', 'version': self.version, 'data': self._snapshot}
+        self.refresh_and_publish()
+        with self._lock:
+            return {'type': 'snapshot', 'version': self.version, 'data': self._snapshot}
+
+    def refresh_and_publish(self):
+        """在推送线程之外刷新快照，有变化时同样推送给订阅者"""
+        delta = self.refresh()
+        if delta is not None:
+            HUB.publish('xiaobu_emotion', delta)
+
+
+EMOTION_PUBLISHER = EmotionSnapshotPublisher()
+HUB = BroadcastHub()
+HUB.register('status', producer=build_status_event, interval=STATUS_PUSH_INTERVAL,
+             replay_size=1)  # 状态只需最新一条
+HUB.register('emotions')
+HUB.register('xiaobu_emotion', producer=EMOTION_PUBLISHER.refresh, interval=EMOTION_PUSH_INTERVAL)
+EMOTION_HISTORY.add_listener(publish_emotion_record)
+
+def status_initial_events():
+    last_event = HUB.topics['status'].last_event
+    return [last_event] if last_event else []
+
+def emotions_initial_events():
+    # 新连接先推送最近100条，之后只推送新增记录；重连只补发错过的记录
+    recent_records = EMOTION_HISTORY.tail(100)
+    if not recent_records:
+        return []
+    data = {
+        'timestamp': datetime.now().isoformat(),
+        'new_emotions': recent_records,
+        'total_count': recent_records[-1]['seq'] + 1
+    }
+    return [json.dumps(data, ensure_ascii=False)]
+
+def xiaobu_emotion_initial_events():
+    return [json.dumps(EMOTION_PUBLISHER.snapshot_event(), ensure_ascii=False)]
+
+# SSE路径 -> (主题, 初始事件函数)，ASGI模式按此表原生处理
+SSE_ROUTES = {
+    '/api/realtime/status': ('status', status_initial_events),
+    '/api/realtime/emotions': ('emotions', emotions_initial_events),
+    '/api/realtime/xiaobu-emotion': ('xiaobu_emotion', xiaobu_emotion_initial_events),
+}
+
+def open_sse_subscription(topic, last_event_id=None, initial_events=None):
+    """订阅主题，返回(订阅者, 需先发送的(事件ID, 事件)列表)；WSGI和ASGI模式共用"""
+    resumable = bool(last_event_id) and HUB.topics[topic].can_resume(last_event_id)
+    
+    # 初始事件在订阅前生成，标记为生成前的最新ID，续传时宁可重复也不遗漏
+    events = []
+    start_id = HUB.topics[topic].current_id()
+    if not resumable and initial_events:
+        events = initial_events()
+    subscriber = HUB.subscribe(topic, last_event_id)
+    if resumable and not subscriber.resumed and initial_events:
+        events = initial_events()  # 检查后缓冲区已滚动，退回完整初始化
+    return subscriber, [(start_id, event) for event in events]
+
+def format_sse_event(event_id, event):
+    return f"id: {event_id}\ndata: {event}\n\n"
+
+def sse_response(topic, initial_events=None):
+    """订阅主题并返回SSE响应，连接断开时自动退订
+
+    initial_events为返回初始事件（已序列化的JSON字符串）列表的函数，只在新连接或无法续传时调用；
+    重连请求带Last-Event-ID头（或lastEventId参数）且错过的事件仍在重放缓冲区内时，只补发错过的事件。
+    """
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+    subscriber, events = open_sse_subscription(topic, last_event_id, initial_events)
+    
+    def generate():
+        try:
+            for item in events:
+                yield format_sse_event(*item)
+            while True:
+                item = subscriber.get(timeout=SSE_HEARTBEAT_INTERVAL)
+                if item is not None:
+                    yield format_sse_event(*item)
+                elif subscriber.closed:
+                    break
+                else:
+                    yield ": heartbeat\n\n"
+        finally:
+            HUB.unsubscribe(subscriber)
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+class HttpCacheStats:
+    """统计条件请求（304）和压缩节省的带宽与CPU"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._compression = {'responses': 0, 'precompressed': 0, 'original_bytes': 0,
+                             'compressed_bytes': 0, 'seconds': 0.0}
+
+    def _endpoint(self, name):
+        return self._endpoints.setdefault(name, {'full': 0, 'not_modified': 0, 'bytes': 0, 'seconds': 0.0})
+
+    def record_full(self, endpoint, size, seconds):
+        with self._lock:
+            stats = self._endpoint(endpoint)
+            stats['full'] += 1
+            stats['bytes'] += size
+            stats['seconds'] += seconds
+
+    def record_not_modified(self, endpoint):
+        with self._lock:
+            self._endpoint(endpoint)['not_modified'] += 1
+
+    def record_compression(self, original_size, compressed_size, seconds, precompressed=False):
+        with self._lock:
+            self._compression['responses'] += 1
+            self._compression['precompressed'] += precompressed
+            self._compression['original_bytes'] += original_size
+            self._compression['compressed_bytes'] += compressed_size
+            self._compression['seconds'] += seconds
+
+    def snapshot(self):
+        """按接口估算：304节省的字节和CPU按该接口完整响应的平均大小和生成耗时计算"""
+        with self._lock:
+            endpoints = {}
+            for name, stats in self._endpoints.items():
+                requests_total = stats['full'] + stats['not_modified']
+                avg_bytes = stats['bytes'] / stats['full'] if stats['full'] else 0
+                avg_ms = stats['seconds'] * 1000 / stats['full'] if stats['full'] else 0
+                endpoints[name] = {
+                    'requests': requests_total,
+                    'not_modified': stats['not_modified'],
+                    'hit_rate': round(stats['not_modified'] / requests_total, 3) if requests_total else 0,
+                    'avg_full_bytes': round(avg_bytes),
+                    'avg_build_ms': round(avg_ms, 3),
+                    'bytes_saved': round(avg_bytes * stats['not_modified']),
+                    'cpu_ms_saved': round(avg_ms * stats['not_modified'], 3),
+                    'bytes_saved_per_request': round(avg_bytes * stats['not_modified'] / requests_total) if requests_total else 0,
+                    'cpu_ms_saved_per_request': round(avg_ms * stats['not_modified'] / requests_total, 3) if requests_total else 0
+                }
+            compression = self._compression
+            responses = compression['responses']
+            return {
+                'endpoints': endpoints,
+                'compression': {
+                    **compression,
+                    'seconds': round(compression['seconds'], 4),
+                    'bytes_saved': compression['original_bytes'] - compression['compressed_bytes'],
+                    'ratio': round(compression['compressed_bytes'] / compression['original_bytes'], 3) if compression['original_bytes'] else 1,
+                    'bytes_saved_per_response': round((compression['original_bytes'] - compression['compressed_bytes']) / responses) if responses else 0,
+                    'cpu_ms_per_response': round(compression['seconds'] * 1000 / responses, 3) if responses else 0,
+                    'brotli_available': brotli is not None
+                }
+            }
+
+
+HTTP_CACHE_STATS = HttpCacheStats()
+
+def file_version(path):
+    """由inode、修改时间和大小组成的文件版本标识，文件不存在时为'0'（无需读取内容）"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return '0'
+    return f'{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}'
+
+def conditional_response(etag, build):
+    """条件GET：If-None-Match命中版本ETag时直接返回304，不调用build加载和序列化数据"""
+    endpoint = request.endpoint
+    if request.if_none_match.contains_weak(etag):
+        HTTP_CACHE_STATS.record_not_modified(endpoint)
+        response = Response(status=304)
+    else:
+        started = time.perf_counter()
+        response = app.make_response(build())
+        if response.status_code != 200:
+            return response
+        HTTP_CACHE_STATS.record_full(endpoint, len(response.get_data()), time.perf_counter() - started)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'  # 浏览器每次带ETag重新验证
+    return response
+
+def choose_encoding(accept_encodings):
+    """按客户端支持选择压缩方式，优先brotli"""
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def compress_bytes(data, encoding, best=False):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if best else 5)
+    return gzip.compress(data, compresslevel=9 if best else COMPRESS_LEVEL)
+
+@app.after_request
+def compress_response(response):
+    """压缩较大的文本响应；流式响应（SSE）和已编码的响应不处理"""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    
+    started = time.perf_counter()
+    compressed = compress_bytes(data, encoding)
+    HTTP_CACHE_STATS.record_compression(len(data), len(compressed), time.perf_counter() - started)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+class StaticPageCache:
+    """预压缩的静态页面：模板文件变化时重新渲染，并一次性生成gzip/brotli版本"""
+
+    def __init__(self, template_name):
+        self.template_name = template_name
+        self._version = None
+        self._page = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        path = os.path.join(app.root_path, app.template_folder, self.template_name)
+        version = file_version(path)
+        with self._lock:
+            if version != self._version:
+                body = render_template(self.template_name).encode('utf-8')
+                variants = {None: body, 'gzip': compress_bytes(body, 'gzip', best=True)}
+                if brotli is not None:
+                    variants['br'] = compress_bytes(body, 'br', best=True)
+                self._page = {
+                    'etag': 'page-' + hashlib.md5(body).hexdigest()[:16],
+                    'variants': variants
+                }
+                self._version = version
+            return self._page
+
+
+INDEX_PAGE = StaticPageCache('index.html')
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    page = INDEX_PAGE.get()
+    return conditional_response(page['etag'], lambda: precompressed_page_response(page))
+
+def precompressed_page_response(page):
+    encoding = choose_encoding(request.accept_encodings)
+    body = page['variants'][None]
+    response = Response(page['variants'].get(encoding, body), mimetype='text/html')
+    if encoding in page['variants']:
+        response.headers['Content-Encoding'] = encoding
+        HTTP_CACHE_STATS.record_compression(len(body), len(response.get_data()), 0, precompressed=True)
+    response.vary.add('Accept-Encoding')
+    return response
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
@@ -1370,37 +4679,124 @@ def chat():
     data = request.json
     message = data.get('message', '').strip()
     
+    limited = check_rate_limit(client_id)
+    if limited:
+        response = jsonify(limited[0])
+        response.headers['Retry-After'] = str(limited[0]['retry_after'])
+        return response, limited[1]
+    
+    # 用户点击停止（/api/chat/cancel）或断开连接时取消请求并结束Claude进程
+    with CANCEL_TOKENS.track(client_id, data.get('request_id'),
+                             connection_closed_probe(request.environ)) as cancel_token:
+        payload, status_code = process_chat(client_id, message, cancel_token=cancel_token)
+    return jsonify(payload), status_code
+
+@app.route('/api/chat/cancel', methods=['POST'])
+def cancel_chat():
+    """取消当前客户端进行中的聊天请求
+
+    多worker部署时请求可能在其他进程中处理，本进程找不到时转发给所有进程，返回202。
+    """
+    client_id = get_client_id()
+    request_id = str((request.json or {}).get('request_id') or '')
+    if not request_id:
+        return jsonify({'request_id': request_id, 'cancelled': False}), 404
+    if CANCEL_TOKENS.cancel(client_id, request_id):
+        return jsonify({'request_id': request_id, 'cancelled': True}), 200
+    if SHARED_STATE is not None:
+        CANCEL_TOKENS.forward(client_id, request_id)
+        return jsonify({'request_id': request_id, 'cancelled': False, 'forwarded': True}), 202
+    return jsonify({'request_id': request_id, 'cancelled': False}), 404
+
+def process_chat(client_id, message, on_chunk=None, cancel_token=None, on_retry=None):
+    """处理一条聊天消息，返回(响应数据, HTTP状态码)；HTTP和WebSocket通道共用
+
+    Claude调用（含失败重试）前先向公平调度器申请名额，排队超时按调用失败处理；
+    cancel_token被取消时结束进行中的Claude进程并立即释放名额。
+    重试开始前调用on_retry(attempt)，流式输出的调用方据此丢弃上一次调用已输出的片段。
+    """
+    cancel_token = cancel_token or CancelToken()
+    started = time.perf_counter()
+    with start_trace('chat', client_id=client_id[:8], message_length=len(message)) as trace:
+        steps = chat_steps(client_id, message, cancel_token)
+        try:
+            call = next(steps)
+            with LLM_SCHEDULER.slot(client_id, cancel_token=cancel_token) as acquired:
+                for attempt in itertools.count(1):
+                    with trace_span('call_claude', attempt=attempt) as span:
+                        if cancel_token.check():
+                            CANCEL_TOKENS.record_avoided_call('avoided_calls')
+                            result = None, CHAT_CANCELLED_ERROR
+                        elif acquired:
+                            if attempt > 1 and on_retry:
+                                on_retry(attempt)
+                            result = call_claude(*call, client_id=client_id, on_chunk=on_chunk, cancel_token=cancel_token,
+                                                 purpose='chat' if attempt == 1 else 'retry')
+                        else:
+                            result = None, LLM_BUSY_ERROR
+                        if span and result[1]:
+                            span.set(error=result[1])
+                    call = steps.send(result)
+        except StopIteration as done:
+            record_chat_request(done.value[1], time.perf_counter() - started)
+            if trace:
+                trace.root.set(status=done.value[1])
+            return done.value
+
+def finish_cancelled_chat(client_id, chat_data, cancel_token):
+    """记录已取消的对话（保留用户消息，不计为错误）"""
+    reason = '连接已断开' if cancel_token.reason == 'disconnect' else '已停止回复'
+    log_event(logging.INFO, '对话已取消', client_id, reason=cancel_token.reason)
+    chat_data['history'].append({
+        'type': 'system',
+        'content': reason,
+        'timestamp': datetime.now().isoformat()
+    })
+    with chat_stage('save_data'):
+        save_data(client_id, chat_data)
+    return {
+        'error': CHAT_CANCELLED_ERROR,
+        'cancelled': True,
+        'history': chat_data['history'][-42:]
+    }, 409
+
+def chat_steps(client_id, message, cancel_token=None):
+    """聊天处理流程生成器
+
+    需要调用Claude时yield (message, context)，调用方以同步或异步方式执行后send回(回复, 错误)；
+    流程结束时通过StopIteration返回(响应数据, HTTP状态码)。请求已取消时不再重试。
+    """
+    cancel_token = cancel_token or CancelToken()
     # 更新服务状态
-    SERVICE_STATUS['request_count'] += 1
+    COUNTERS.incr('request_count')
     SERVICE_STATUS['last_request_time'] = datetime.now().isoformat()
     
     # 记录聊天时间用于负载计算
-    record_chat_time()
+    record_chat_time(client_id)
     
-    print(f"\n=== 新对话请求 ===")
-    print(f"客户端ID: {client_id[:8]}...")
-    print(f"请求时间: {datetime.now().strftime('%H:%M:%S')}")
+    log_event(logging.INFO, '新对话请求', client_id, message=redact(message))
     
     if not message:
-        SERVICE_STATUS['error_count'] += 1
-        return jsonify({'error': '消息不能为空'}), 400
+        COUNTERS.incr('error_count')
+        return {'error': '消息不能为空'}, 400
     
-    chat_data = load_data(client_id)
+    with chat_stage('load_data'):
+        chat_data = load_data(client_id)
     
     if message == '/clear':
-        print(f"执行清空上下文命令")
         chat_data['context'] = []
         chat_data['history'].append({
             'type': 'system',
             'content': '脑袋已清空',
             'timestamp': datetime.now().isoformat()
         })
-        save_data(client_id, chat_data)
-        print(f"上下文已清空，历史记录保留 {len(chat_data['history'])} 条")
-        return jsonify({
+        with chat_stage('save_data'):
+            save_data(client_id, chat_data)
+        log_event(logging.INFO, '上下文已清空', client_id, history=len(chat_data['history']))
+        return {
             'message': '脑袋已清空',
             'history': chat_data['history'][-42:]
-        })
+        }, 200
     
     chat_data['history'].append({
         'type': 'user',
@@ -1408,53 +4804,57 @@ def chat():
         'timestamp': datetime.now().isoformat()
     })
     
-    # 检测安全问题
-    privacy_issues = detect_privacy_issues(message)
+    # 检测安全问题和人设个性化问题
+    with chat_stage('detectors'):
+        privacy_issues = detect_privacy_issues(message)
+        persona_keywords, is_question = detect_persona_questions(message)
+    
     if privacy_issues:
         # 异步处理安全问题，不阻塞主流程
-        threading.Thread(
-            target=process_privacy_issues,
-            args=(message, privacy_issues),
-            daemon=True
-        ).start()
-    
-    # 检测人设个性化问题
-    persona_keywords, is_question = detect_persona_questions(message)
+        start_traced_thread('privacy_task', process_privacy_issues, message, privacy_issues, client_id)
+    
     if persona_keywords and is_question:
         # 异步处理人设问题，不阻塞主流程
-        threading.Thread(
-            target=process_persona_questions,
-            args=(message, persona_keywords, is_question),
-            daemon=True
-        ).start()
+        start_traced_thread('persona_task', process_persona_questions, message, persona_keywords, is_question)
     
-    response, error = call_claude(message, chat_data['context'])
+    response, error = yield message, chat_data['context']
+    
+    if error and cancel_token.cancelled:
+        CANCEL_TOKENS.record_avoided_call('skipped_retries')
+        return finish_cancelled_chat(client_id, chat_data, cancel_token)
     
     if error:
-        response, error = call_claude(message, chat_data['context'])
+        LLM_RETRIES_TOTAL.inc()
+        response, error = yield message, chat_data['context']
+    
+    if error and cancel_token.cancelled:
+        return finish_cancelled_chat(client_id, chat_data, cancel_token)
     
     if error:
-        SERVICE_STATUS['error_count'] += 1
+        COUNTERS.incr('error_count')
         chat_data['history'].append({
             'type': 'error',
             'content': f'错误: {error}',
             'timestamp': datetime.now().isoformat()
         })
-        save_data(client_id, chat_data)
-        return jsonify({
+        with chat_stage('save_data'):
+            save_data(client_id, chat_data)
+        return {
             'error': error,
             'history': chat_data['history'][-42:]
-        }), 500
+        }, 500
     
     chat_data['context'].append(f"用户: {message}")
     chat_data['context'].append(f"助手: {response}")
     
     # 记录情绪数据
-    emotion_record = record_emotion(message, response)
+    with chat_stage('record_emotion'):
+        emotion_record = record_emotion(message, response, client_id)
     
     # 修剪上下文
     global_memory = load_global_memory()
-    chat_data['context'] = trim_context(chat_data['context'], global_memory)
+    with chat_stage('trim_context'):
+        chat_data['context'] = trim_context(chat_data['context'], global_memory)
     
     chat_data['history'].append({
         'type': 'bot',
@@ -1463,22 +4863,84 @@ def chat():
         'emotion': emotion_record
     })
     
-    save_data(client_id, chat_data)
+    with chat_stage('save_data'):
+        save_data(client_id, chat_data)
     
-    print(f"上下文条目数: {len(chat_data['context'])}")
-    print(f"历史记录数: {len(chat_data['history'])}")
-    print(f"=== 对话完成 ===\n")
+    log_event(logging.INFO, '对话完成', client_id,
+              context=len(chat_data['context']),
+              history=len(chat_data['history']),
+              response=redact(response))
     
-    return jsonify({
+    return {
         'message': response,
         'history': chat_data['history'][-42:]
-    })
+    }, 200
 
 @app.route('/api/history', methods=['GET'])
 def get_history():
     client_id = get_client_id()
-    chat_data = load_data(client_id)
-    return jsonify({'history': chat_data['history'][-42:]})
+    etag = f"history-{client_id[:12]}-{file_version(get_data_file(client_id))}"
+    return conditional_response(etag, lambda: jsonify({'history': load_data(client_id)['history'][-42:]}))
+
+@app.route('/api/debug/traces', methods=['GET'])
+def get_debug_traces():
+    """获取最近和最慢的聊天请求追踪；format=chrome时导出Chrome trace-event JSON"""
+    denied = check_admin_token()
+    if denied:
+        return denied
+    if request.args.get('format') == 'chrome':
+        trace_id = request.args.get('trace_id')
+        traces = [TRACES.get(trace_id)] if trace_id else TRACES.all()
+        events = [event for trace in traces if trace for event in trace.chrome_events()]
+        response = jsonify({'traceEvents': events, 'displayTimeUnit': 'ms'})
+        response.headers['Content-Disposition'] = 'attachment; filename=xiaobu-traces.json'
+        return response
+    
+    return jsonify({
+        'enabled': TRACING_ENABLED,
+        'recent': [trace.summary() for trace in TRACES.recent()],
+        'slowest': [trace.summary() for trace in TRACES.slowest()]
+    })
+
+@app.route('/api/debug/traces/<trace_id>', methods=['GET'])
+def get_debug_trace(trace_id):
+    """获取单条追踪的全部span"""
+    denied = check_admin_token()
+    if denied:
+        return denied
+    trace = TRACES.get(trace_id)
+    if trace is None:
+        return jsonify({'error': '追踪不存在或已被淘汰'}), 404
+    return jsonify(trace.to_dict())
+
+@app.route('/api/debug/profile', methods=['GET'])
+def get_debug_profile():
+    """采样分析所有线程：?seconds=5&rate=100&mode=cpu|wall&format=json|collapsed"""
+    denied = check_admin_token()
+    if denied:
+        return denied
+    try:
+        seconds = float(request.args.get('seconds', PROFILE_DEFAULT_SECONDS))
+        rate = int(request.args.get('rate', PROFILE_DEFAULT_RATE))
+    except ValueError:
+        return jsonify({'error': 'seconds和rate必须是数字'}), 400
+    if not math.isfinite(seconds):
+        return jsonify({'error': 'seconds必须是有限的数字'}), 400
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+    rate = min(max(rate, 1), PROFILE_MAX_RATE)
+    mode = request.args.get('mode', 'cpu')
+    if mode not in ('cpu', 'wall'):
+        return jsonify({'error': 'mode只能是cpu或wall'}), 400
+    
+    log_event(logging.INFO, '开始采样分析', seconds=seconds, rate=rate, mode=mode)
+    result = PROFILER.profile(seconds, rate, mode)
+    if result is None:
+        return jsonify({'error': '已有采样任务在运行'}), 409
+    log_event(logging.INFO, '采样分析完成', samples=result['samples'],
+              overhead_percent=result['overhead_percent'])
+    if request.args.get('format') == 'collapsed':
+        return Response(result['collapsed'] + '\n', mimetype='text/plain')
+    return jsonify(result)
 
 @app.route('/api/client-info', methods=['GET'])
 def get_client_info():
@@ -1524,7 +4986,11 @@ def update_global_memory():
 
 @app.route('/api/security-questions', methods=['GET'])
 def get_security_questions():
-    """获取安全问题记录"""
+    """获取安全问题记录（文件未变化时返回304）"""
+    etag = f"security-{file_version(QUESTION_FILE)}-{datetime.now():%Y%m%d}"
+    return conditional_response(etag, build_security_questions)
+
+def build_security_questions():
     try:
         if os.path.exists(QUESTION_FILE):
             with open(QUESTION_FILE, 'r', encoding='utf-8') as f:
@@ -1548,7 +5014,11 @@ def get_security_questions():
 
 @app.route('/api/persona-questions', methods=['GET'])
 def get_persona_questions():
-    """获取人设问题记录"""
+    """获取人设问题记录（文件未变化时返回304）"""
+    etag = f"persona-{file_version(PERSONA_QUESTION_FILE)}-{datetime.now():%Y%m%d}"
+    return conditional_response(etag, build_persona_questions)
+
+def build_persona_questions():
     try:
         if os.path.exists(PERSONA_QUESTION_FILE):
             with open(PERSONA_QUESTION_FILE, 'r', encoding='utf-8') as f:
@@ -1591,7 +5061,12 @@ def get_context_info():
 
 @app.route('/api/service-status', methods=['GET'])
 def get_service_status():
-    """获取服务状态信息"""
+    """获取服务状态信息（同一采样周期内请求数和错误数未变化时返回304）"""
+    request_count, error_count, _ = request_counts()
+    etag = f"status-{METRICS.snapshot()['timestamp']}-{request_count}-{error_count}"
+    return conditional_response(etag, build_service_status)
+
+def build_service_status():
     # 更新系统指标
     update_system_metrics()
     
@@ -1600,16 +5075,32 @@ def get_service_status():
     uptime_seconds = (datetime.now() - start_time).total_seconds()
     uptime_hours = uptime_seconds / 3600
     
-    # 计算错误率
-    error_rate = 0
-    if SERVICE_STATUS['request_count'] > 0:
-        error_rate = (SERVICE_STATUS['error_count'] / SERVICE_STATUS['request_count']) * 100
+    # 计算错误率；开启共享状态时计数器是跨重启的累计值，速率按累计时长而不是本进程运行时长计算
+    request_count, error_count, error_rate = request_counts()
+    counters_since = COUNTERS.since()
+    counted_hours = max(time.time() - counters_since, 1) / 3600
     
     status_info = {
         **SERVICE_STATUS,
+        'request_count': request_count,
+        'error_count': error_count,
+        'counters_scope': COUNTERS.scope,
+        'counters_since': datetime.fromtimestamp(counters_since).isoformat(),
+        'requests_per_hour': round(request_count / counted_hours, 2),
         'uptime_hours': round(uptime_hours, 2),
         'uptime_seconds': int(uptime_seconds),
         'error_rate': round(error_rate, 2),
+        'chat_rate': CHAT_RATE.snapshot(),
+        'emotion_shards': len(EMOTION_SHARDS),
+        'weather': WEATHER.status(),
+        'realtime': HUB.stats(),
+        'system_metrics': METRICS.snapshot(),
+        'shared_state': SHARED_STATE.stats() if SHARED_STATE else {'enabled': False},
+        'rate_limit': RATE_LIMITER.stats(top=3),
+        'llm_scheduler': {key: value for key, value in LLM_SCHEDULER.stats().items() if key != 'clients'},
+        'cancellation': CANCEL_TOKENS.stats(),
+        'logging': LOG_HANDLER.stats(),
+        'http_cache': HTTP_CACHE_STATS.snapshot(),
         'system_info': {
             'python_version': os.sys.version,
             'platform': os.name,
@@ -1619,102 +5110,178 @@ def get_service_status():
     
     return jsonify(status_info)
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus文本格式的指标（本进程），抓取时用Authorization: Bearer携带管理口令"""
+    denied = check_admin_token()
+    if denied:
+        return denied
+    return Response(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/chat-rate', methods=['GET'])
+def get_chat_rate():
+    """获取全局及当前客户端的聊天频率统计；查看其他客户端（client_id参数）需要管理口令"""
+    client_id = request.args.get('client_id')
+    if client_id:
+        denied = check_admin_token()
+        if denied:
+            return denied
+    else:
+        client_id = get_client_id()
+    
+    return jsonify({
+        'timestamp': datetime.now().isoformat(),
+        'global': CHAT_RATE.snapshot(),
+        'client': {
+            'client_id': client_id,
+            **CHAT_RATE.snapshot(client_id)
+        },
+        'tracked_clients': CHAT_RATE.tracked_clients()
+    })
+
+@app.route('/api/llm-capacity', methods=['GET'])
+def get_llm_capacity():
+    """获取限流和Claude调用名额调度统计（按客户端的拒绝次数和排队等待）"""
+    return jsonify({
+        'timestamp': datetime.now().isoformat(),
+        'rate_limit': RATE_LIMITER.stats(),
+        'scheduler': LLM_SCHEDULER.stats(),
+        'cancellation': CANCEL_TOKENS.stats()
+    })
+
+@app.route('/api/cost-ledger', methods=['GET'])
+def get_cost_ledger():
+    """按客户端、小时和用途汇总Claude调用的资源用量：?hours=24&group_by=client,purpose&client_id=&purpose=&limit=100"""
+    denied = check_admin_token()
+    if denied:
+        return denied
+    try:
+        hours = int(request.args.get('hours', 24))
+        limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+    except ValueError:
+        return jsonify({'error': 'hours和limit必须是整数'}), 400
+    group_by = [name for name in request.args.get('group_by', 'client').split(',') if name]
+    if any(name not in CostLedger.GROUP_COLUMNS for name in group_by):
+        return jsonify({'error': 'group_by只能是hour、client、purpose的组合'}), 400
+    purpose = request.args.get('purpose')
+    if purpose and purpose not in CostLedger.PURPOSES:
+        return jsonify({'error': f"purpose只能是{'、'.join(CostLedger.PURPOSES)}"}), 400
+    
+    # 超出保留期的小时行已被清理，查询范围不必更长（过大的hours会让timedelta溢出）
+    hours = min(max(hours, 1), COST_LEDGER_RETENTION_DAYS * 24)
+    since = (datetime.now() - timedelta(hours=hours - 1)).strftime('%Y-%m-%dT%H')
+    rows = COST_LEDGER.query(since, group_by, request.args.get('client_id'), purpose, limit)
+    totals = COST_LEDGER.query(since, (), request.args.get('client_id'), purpose)
+    return jsonify({
+        'since_hour': since,
+        'group_by': group_by,
+        'rows': rows,
+        'totals': totals[0] if totals else None,
+        'write_errors': COST_LEDGER.write_errors
+    })
+
 @app.route('/api/emotions', methods=['GET'])
 def get_emotions():
     """获取情绪分析数据"""
     limit = request.args.get('limit', 50, type=int)
     
     # 获取最近的情绪记录
-    recent_emotions = list(EMOTION_HISTORY)[-limit:]
-    
-    # 统计情绪分布
-    emotion_counts = {}
-    total_confidence = {}
+    recent_emotions = EMOTION_HISTORY.tail(max(0, limit))
+    total_records = len(EMOTION_HISTORY)
     
+    # 统计返回的这些记录的情绪分布
+    recent_bucket = new_emotion_bucket()
     for record in recent_emotions:
-        user_emotion = record['user_emotion']
-        bot_emotion = record['bot_emotion']
-        
-        # 统计用户情绪
-        if user_emotion not in emotion_counts:
-            emotion_counts[user_emotion] = {'user': 0, 'bot': 0}
-            total_confidence[user_emotion] = {'user': 0, 'bot': 0}
-        
-        emotion_counts[user_emotion]['user'] += 1
-        total_confidence[user_emotion]['user'] += record['user_confidence']
-        
-        # 统计机器人情绪
-        if bot_emotion not in emotion_counts:
-            emotion_counts[bot_emotion] = {'user': 0, 'bot': 0}
-            total_confidence[bot_emotion] = {'user': 0, 'bot': 0}
-        
-        emotion_counts[bot_emotion]['bot'] += 1
-        total_confidence[bot_emotion]['bot'] += record['bot_confidence']
-    
-    # 计算平均置信度
-    emotion_stats = {}
-    for emotion in emotion_counts:
-        user_count = emotion_counts[emotion]['user']
-        bot_count = emotion_counts[emotion]['bot']
-        
-        emotion_stats[emotion] = {
-            'user_count': user_count,
-            'bot_count': bot_count,
-            'user_avg_confidence': round(total_confidence[emotion]['user'] / user_count, 3) if user_count > 0 else 0,
-            'bot_avg_confidence': round(total_confidence[emotion]['bot'] / bot_count, 3) if bot_count > 0 else 0
-        }
+        add_to_emotion_bucket(recent_bucket, record)
     
     return jsonify({
         'recent_emotions': recent_emotions,
-        'emotion_statistics': emotion_stats,
-        'total_records': len(EMOTION_HISTORY),
+        'emotion_statistics': summarize_emotion_bucket(recent_bucket),
+        # 缓冲区内全部记录的分布，由追加时增量维护
+        'retained_emotion_statistics': EMOTION_AGGREGATES.statistics(),
+        'total_records': total_records,
         'returned_records': len(recent_emotions)
     })
 
 @app.route('/api/emotions/summary', methods=['GET'])
 def get_emotion_summary():
     """获取情绪摘要统计"""
-    if not EMOTION_HISTORY:
+    total_conversations = len(EMOTION_HISTORY)
+    
+    if not total_conversations:
         return jsonify({
             'message': '暂无情绪数据',
             'total_conversations': 0
         })
     
     # 最近的情绪记录
-    latest_record = EMOTION_HISTORY[-1] if EMOTION_HISTORY else None
-    
-    # 统计最近10条记录的情绪趋势
-    recent_10 = list(EMOTION_HISTORY)[-10:]
-    user_emotions = [r['user_emotion'] for r in recent_10]
-    bot_emotions = [r['bot_emotion'] for r in recent_10]
-    
-    # 计算主导情绪
-    from collections import Counter
-    user_emotion_trend = Counter(user_emotions).most_common(1)
-    bot_emotion_trend = Counter(bot_emotions).most_common(1)
+    latest_record = EMOTION_HISTORY.latest()
     
     return jsonify({
         'latest_emotion': latest_record,
-        'total_conversations': len(EMOTION_HISTORY),
-        'recent_trend': {
-            'user_dominant_emotion': user_emotion_trend[0][0] if user_emotion_trend else 'neutral',
-            'bot_dominant_emotion': bot_emotion_trend[0][0] if bot_emotion_trend else 'neutral',
-            'sample_size': len(recent_10)
-        },
+        'total_conversations': total_conversations,
+        'recent_trend': EMOTION_AGGREGATES.recent_trend(),
         'available_emotions': list(EMOTION_KEYWORDS.keys())
     })
 
-@app.route('/api/xiaobu/emotion', methods=['GET'])
-def get_xiaobu_emotion():
-    """获取小布的当前情绪状态"""
-    emotion_state = calculate_xiaobu_emotion()
+def parse_time_param(value, default):
+    """解析时间查询参数，支持Unix时间戳和ISO格式"""
+    if not value:
+        return default
+    try:
+        timestamp = float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+    if not math.isfinite(timestamp):
+        raise ValueError(f'无效的时间戳: {value}')
+    try:
+        datetime.fromtimestamp(timestamp)
+    except (OverflowError, OSError) as e:
+        raise ValueError(f'时间戳超出范围: {value}') from e
+    return timestamp
+
+@app.route('/api/emotions/range', methods=['GET'])
+def get_emotion_range():
+    """按时间区间和分辨率查询情绪趋势（从汇总桶读取）"""
+    resolution = request.args.get('resolution', 'hour')
+    if resolution not in EMOTION_ROLLUPS:
+        return jsonify({
+            'error': f'不支持的分辨率: {resolution}',
+            'available_resolutions': list(EMOTION_ROLLUPS.keys())
+        }), 400
+    
+    bucket_seconds, retention_buckets = EMOTION_ROLLUPS[resolution]
+    try:
+        end = parse_time_param(request.args.get('to'), time.time())
+        start = parse_time_param(request.args.get('from'), end - bucket_seconds * 24)
+    except ValueError:
+        return jsonify({'error': '时间格式错误，请使用Unix时间戳或ISO格式'}), 400
+    
+    if start >= end:
+        return jsonify({'error': 'from必须早于to'}), 400
+    if (end - start) / bucket_seconds > MAX_RANGE_BUCKETS:
+        return jsonify({'error': f'查询区间超过{MAX_RANGE_BUCKETS}个桶，请使用更粗的分辨率'}), 400
+    
+    result = EMOTION_AGGREGATES.range_query(start, end, resolution)
+    
+    return jsonify({
+        'resolution': resolution,
+        'from': datetime.fromtimestamp(start).isoformat(),
+        'to': datetime.fromtimestamp(end).isoformat(),
+        'retention': f"{retention_buckets}个{resolution}桶",
+        **result
+    })
+
+def build_xiaobu_emotion_payload(client_id=None, update_state=True):
+    """构建小布当前情绪状态的完整数据"""
+    emotion_state = calculate_xiaobu_emotion(client_id, update_state)
     weather_data = get_wuhan_weather()
     
     # 获取当前时间信息
     now = datetime.now()
     activity, is_weekend, holiday_type, holiday_name = get_current_time_period()
     
-    return jsonify({
+    return {
         'timestamp': now.isoformat(),
         'emotion': emotion_state['emotion_type'],
         'emoji': emotion_state['emoji'],
@@ -1735,98 +5302,280 @@ def get_xiaobu_emotion():
             'weekday': now.weekday(),
             'current_activity': activity
         },
-        'chat_frequency_recent': len([t for t in XIAOBU_STATE['chat_frequency'] 
-                                    if (now - t).total_seconds() < 600]),
-        'total_chats_today': len(XIAOBU_STATE['chat_frequency'])
-    })
+        'chat_frequency_recent': CHAT_RATE.count(600),
+        'total_chats_today': CHAT_RATE.count(86400)
+    }
+
+@app.route('/api/xiaobu/emotion', methods=['GET'])
+def get_xiaobu_emotion():
+    """获取小布的当前情绪状态（情绪计算的输入未变化时返回304，不重新计算）"""
+    client_id = get_client_id()
+    etag = f"emotion-{client_id[:12]}-{emotion_inputs_key(client_id)}"
+    return conditional_response(etag, lambda: jsonify(build_xiaobu_emotion_payload(client_id)))
 
 @app.route('/api/xiaobu/schedule', methods=['GET'])
 def get_xiaobu_schedule():
-    """获取小布的作息时间表"""
-    now = datetime.now()
-    is_weekend = now.weekday() >= 5
-    current_schedule = DAILY_SCHEDULE['weekend' if is_weekend else 'weekday']
+    """获取小布的作息时间表（作息类型和当前活动未变化时返回304，响应中不含会过期的时间戳）"""
+    is_weekend = datetime.now().weekday() >= 5
+    current_activity = get_current_time_period()[0]
     
-    return jsonify({
-        'timestamp': now.isoformat(),
-        'is_weekend': is_weekend,
-        'current_schedule': current_schedule,
-        'adolescent_moods': ADOLESCENT_MOODS,
-        'current_activity': get_current_time_period()[0]
-    })
+    def build():
+        return jsonify({
+            'is_weekend': is_weekend,
+            'current_schedule': DAILY_SCHEDULE['weekend' if is_weekend else 'weekday'],
+            'adolescent_moods': ADOLESCENT_MOODS,
+            'current_activity': current_activity
+        })
+    
+    return conditional_response(f"schedule-{int(is_weekend)}-{current_activity}", build)
 
 @app.route('/api/realtime/status')
 def realtime_status():
-    """Server-Sent Events实时推送服务状态"""
-    def generate():
+    """Server-Sent Events实时推送服务状态（所有连接共享同一个采样生产者）"""
+    return sse_response('status', status_initial_events)
+
+@app.route('/api/realtime/emotions')
+def realtime_emotions():
+    """Server-Sent Events实时推送情绪数据（情绪记录写入时直接广播）"""
+    return sse_response('emotions', emotions_initial_events)
+
+@app.route('/api/realtime/xiaobu-emotion')
+def realtime_xiaobu_emotion():
+    """Server-Sent Events推送小布情绪：先发完整快照，之后只发带版本号的变化字段"""
+    return sse_response('xiaobu_emotion', xiaobu_emotion_initial_events)
+
+class ChatChannel:
+    """单个WebSocket连接上的多路复用通道
+
+    同一条连接上收发聊天消息、流式回复片段、输入状态、订阅的推送主题和取消命令，
+    消息均为带type字段的JSON文本帧。
+    """
+
+    def __init__(self, ws, client_id):
+        self.ws = ws
+        self.client_id = client_id
+        self.closed = False
+        self.subscriptions = {}
+        self.pending = {}  # 进行中的聊天请求: request_id -> 状态
+        self.overflowed = False  # 是否因发送积压过多被断开
+        self._lock = threading.Lock()  # 保护subscriptions
+        # 发送队列：文本帧，或有新推送事件的订阅者；由写线程按顺序发出，None表示结束
+        self._outbox = queue.Queue(maxsize=WS_OUTBOX_SIZE)
+        self._scheduled = set()  # 已在发送队列中等待转发的订阅者，每个最多排队一次
+        self._scheduled_lock = threading.Lock()
+
+    def send(self, message_type, **fields):
+        self.send_text(json.dumps({'type': message_type, **fields}, ensure_ascii=False))
+
+    def send_text(self, text):
+        if not self.closed:
+            self._enqueue(text)
+
+    def _enqueue(self, item):
+        """放入发送队列，客户端读得太慢导致积压超过上限时断开连接（与SSE慢消费者的处理一致）"""
+        try:
+            self._outbox.put_nowait(item)
+        except queue.Full:
+            if not self.closed:
+                log_event(logging.WARNING, 'WebSocket发送积压过多，断开连接', self.client_id, limit=WS_OUTBOX_SIZE)
+                self.overflowed = True
+                self.close()
+
+    def _schedule(self, subscriber):
+        """订阅者有新事件时排入发送队列（已在队列中时不重复放入）"""
+        with self._scheduled_lock:
+            if subscriber in self._scheduled:
+                return
+            self._scheduled.add(subscriber)
+        self._enqueue(subscriber)
+
+    def send_event(self, topic, event):
+        # 推送事件已是序列化好的JSON，直接拼接避免重复序列化
+        self.send_text(f'{{"type": "event", "topic": {json.dumps(topic)}, "data": {event}}}')
+
+    def run(self):
+        """读线程阻塞在receive上处理客户端消息，发送全部交给写线程"""
+        writer = threading.Thread(target=self._write_loop, name='ws-writer', daemon=True)
+        writer.start()
+        try:
+            while not self.closed:
+                raw = self.ws.receive()
+                if raw is not None:
+                    self.handle(raw)
+        except ConnectionClosed:
+            pass
+        finally:
+            self.close()
+            writer.join(timeout=1)
+
+    def _write_loop(self):
         while True:
+            item = self._outbox.get()
+            if item is None or self.overflowed:
+                break
+            if isinstance(item, Subscriber):
+                with self._scheduled_lock:
+                    self._scheduled.discard(item)
+                self.forward_events(item)
+                continue
             try:
-                # 更新系统指标
-                update_system_metrics()
-                
-                # 构建状态数据
-                data = {
-                    'timestamp': datetime.now().isoformat(),
-                    'cpu_usage': SERVICE_STATUS['cpu_usage'],
-                    'memory_usage': SERVICE_STATUS['memory_usage'],
-                    'disk_usage': SERVICE_STATUS['disk_usage'],
-                    'request_count': SERVICE_STATUS['request_count'],
-                    'error_count': SERVICE_STATUS['error_count'],
-                    'error_rate': (SERVICE_STATUS['error_count'] / SERVICE_STATUS['request_count'] * 100) if SERVICE_STATUS['request_count'] > 0 else 0
-                }
-                
-                yield f"data: {json.dumps(data)}\n\n"
-                time.sleep(5)  # 每5秒推送一次
-            except Exception as e:
-                print(f"SSE错误: {e}")
+                self.ws.send(item)
+            except ConnectionClosed:
+                self.closed = True
+                return
+        if self.overflowed:
+            # 由写线程发出关闭帧（只有它向连接写数据），读线程随之收到ConnectionClosed退出
+            try:
+                self.ws.close(reason=1013, message='发送积压过多')
+            except ConnectionClosed:
+                pass
+
+    def handle(self, raw):
+        try:
+            message = json.loads(raw)
+        except ValueError:
+            self.send('error', message='消息格式错误')
+            return
+        if not isinstance(message, dict):
+            self.send('error', message='消息必须是JSON对象')
+            return
+        
+        message_type = message.get('type')
+        if message_type in ('chat', 'cancel') and not isinstance(message.get('id') or '', str):
+            self.send('error', message='id必须是字符串')
+        elif message_type == 'chat':
+            if not isinstance(message.get('message') or '', str):
+                self.send('error', message='message必须是字符串')
+                return
+            self.start_chat(message)
+        elif message_type in ('subscribe', 'unsubscribe'):
+            topics = message.get('topics', [])
+            if not isinstance(topics, list) or not all(isinstance(topic, str) for topic in topics):
+                self.send('error', message='topics必须是字符串列表')
+                return
+            for topic in topics:
+                if message_type == 'subscribe':
+                    self.subscribe(topic)
+                else:
+                    self.unsubscribe(topic)
+        elif message_type == 'cancel':
+            self.cancel(message.get('id'))
+        elif message_type == 'ping':
+            self.send('pong')
+        else:
+            self.send('error', message=f'未知消息类型: {message_type}')
+
+    def subscribe(self, topic):
+        with self._lock:
+            if topic not in HUB.topics or topic in self.subscriptions:
+                return
+            # 订阅前先发送当前状态，快照之后的变化由订阅推送
+            if topic == 'xiaobu_emotion':
+                self.send_event(topic, json.dumps(EMOTION_PUBLISHER.snapshot_event(), ensure_ascii=False))
+            elif topic == 'status' and HUB.topics[topic].last_event:
+                self.send_event(topic, HUB.topics[topic].last_event)
+            subscriber = HUB.subscribe(topic)
+            # 有新事件时把订阅者放进发送队列，由写线程取出事件，不需要轮询
+            subscriber.waker = lambda: self._schedule(subscriber)
+            self.subscriptions[topic] = subscriber
+            self._schedule(subscriber)
+
+    def unsubscribe(self, topic):
+        with self._lock:
+            subscriber = self.subscriptions.pop(topic, None)
+        if subscriber:
+            HUB.unsubscribe(subscriber)
+
+    def forward_events(self, subscriber):
+        """在写线程中发出订阅者积压的事件"""
+        while True:
+            item = subscriber.get(timeout=0)
+            if item is None:
                 break
-    
-    return Response(generate(), mimetype='text/event-stream')
+            self.send_event(subscriber.topic, item[1])
+        if subscriber.dropped and not self.closed:
+            with self._lock:
+                current = self.subscriptions.get(subscriber.topic) is subscriber
+                if current:
+                    del self.subscriptions[subscriber.topic]
+            if current:
+                # 积压过多被断开，通知客户端后重新订阅
+                self.send('dropped', topic=subscriber.topic)
+                self.subscribe(subscriber.topic)
 
-@app.route('/api/realtime/emotions')
-def realtime_emotions():
-    """Server-Sent Events实时推送情绪数据"""
-    def generate():
-        last_count = 0
+    def start_chat(self, message):
+        request_id = str(message.get('id') or uuid.uuid4().hex)
+        text = (message.get('message') or '').strip()
+        limited = check_rate_limit(self.client_id)
+        if limited:
+            self.send('result', id=request_id, status=limited[1], data=limited[0])
+            return
+        cancel_token = CANCEL_TOKENS.register(self.client_id, request_id)
+        self.pending[request_id] = cancel_token
+        self.send('ack', id=request_id)
+        self.send('typing', id=request_id, state=True)
+        CHAT_EXECUTOR.submit(self._run_chat, request_id, text, cancel_token)
+
+    def _run_chat(self, request_id, text, cancel_token):
+        def on_chunk(chunk):
+            if not cancel_token.cancelled:
+                self.send('token', id=request_id, text=chunk)
+        
+        def on_retry(attempt):
+            # 失败的上一次调用已推送的片段作废，客户端收到reset后清空气泡
+            self.send('reset', id=request_id, attempt=attempt)
+        
+        try:
+            payload, status_code = process_chat(self.client_id, text, on_chunk, cancel_token, on_retry)
+        except Exception as e:
+            payload, status_code = {'error': str(e)}, 500
+        finally:
+            self.pending.pop(request_id, None)
+            CANCEL_TOKENS.unregister(cancel_token)
+        
+        if cancel_token.cancelled:
+            return
+        self.send('typing', id=request_id, state=False)
+        self.send('result', id=request_id, status=status_code, data=payload)
+
+    def cancel(self, request_id):
+        cancel_token = self.pending.get(request_id)
+        if cancel_token and cancel_token.cancel('client'):
+            self.send('cancelled', id=request_id)
+
+    def close(self):
+        self.closed = True
+        # 队列已满时丢弃最早的待发送帧给结束标记腾出位置，连接正在关闭，这些帧不再需要
         while True:
             try:
-                current_count = len(EMOTION_HISTORY)
-                
-                # 只在有新数据时推送
-                if current_count > last_count:
-                    # 获取最新的情绪记录
-                    new_records = list(EMOTION_HISTORY)[last_count:]
-                    
-                    data = {
-                        'timestamp': datetime.now().isoformat(),
-                        'new_emotions': new_records,
-                        'total_count': current_count
-                    }
-                    
-                    yield f"data: {json.dumps(data)}\n\n"
-                    last_count = current_count
-                
-                time.sleep(2)  # 每2秒检查一次
-            except Exception as e:
-                print(f"SSE情绪推送错误: {e}")
+                self._outbox.put_nowait(None)
                 break
-    
-    return Response(generate(), mimetype='text/event-stream')
+            except queue.Full:
+                try:
+                    self._outbox.get_nowait()
+                except queue.Empty:
+                    pass
+        for cancel_token in list(self.pending.values()):
+            cancel_token.cancel('disconnect')
+        with self._lock:
+            subscribers = list(self.subscriptions.values())
+            self.subscriptions.clear()
+        for subscriber in subscribers:
+            HUB.unsubscribe(subscriber)
+
+
+CHAT_EXECUTOR = ThreadPoolExecutor(max_workers=WS_CHAT_WORKERS, thread_name_prefix='ws-chat')
+
+if sock is not None:
+    @sock.route('/ws')
+    def chat_socket(ws):
+        """WebSocket多路复用通道：聊天、流式回复、实时推送和取消命令"""
+        ChatChannel(ws, get_client_id()).run()
 
 def start_background_monitoring():
     """启动后台监控线程"""
-    def monitor():
-        while True:
-            try:
-                update_system_metrics()
-                time.sleep(30)  # 每30秒更新一次系统指标
-            except Exception as e:
-                print(f"后台监控错误: {e}")
-                time.sleep(60)
-    
-    monitor_thread = threading.Thread(target=monitor, daemon=True)
-    monitor_thread.start()
-    print("后台监控线程已启动")
+    METRICS.start()
+    log_event(logging.INFO, '后台监控线程已启动')
 
 if __name__ == '__main__':
     print("启动小布智能情绪聊天机器人...")
@@ -1843,14 +5592,24 @@ if __name__ == '__main__':
     
     print("\nAPI端点:")
     print("- GET  /api/service-status     - 获取服务状态")
+    print("- GET  /metrics                - Prometheus指标")
+    print("- GET  /api/debug/traces       - 聊天请求分阶段追踪(format=chrome导出)")
+    print("- GET  /api/debug/profile      - 所有线程的采样分析(需管理口令)")
+    print("- GET  /api/chat-rate          - 获取聊天频率统计")
+    print("- GET  /api/llm-capacity       - 获取限流与Claude调用调度统计")
+    print("- GET  /api/cost-ledger        - Claude调用资源账本(需管理口令)")
     print("- GET  /api/emotions           - 获取情绪分析数据")
     print("- GET  /api/emotions/summary   - 获取情绪摘要")
+    print("- GET  /api/emotions/range     - 按时间区间查询情绪趋势")
     print("- GET  /api/xiaobu/emotion     - 获取小布当前情绪状态")
     print("- GET  /api/xiaobu/schedule    - 获取小布作息时间表")
     print("- GET  /api/security-questions  - 获取安全问题记录")
     print("- GET  /api/persona-questions   - 获取人设问题记录")
     print("- GET  /api/realtime/status    - 实时服务状态推送(SSE)")
     print("- GET  /api/realtime/emotions  - 实时情绪数据推送(SSE)")
+    print("- GET  /api/realtime/xiaobu-emotion - 小布情绪增量推送(SSE)")
+    if sock is not None:
+        print("- WS   /ws                     - 聊天与实时推送多路复用通道(WebSocket)")
     print("\n🕐 当前状态:")
     
     # 显示当前情绪状态
@@ -1865,7 +5624,8 @@ if __name__ == '__main__':
     except Exception as e:
         print(f"- 情绪系统初始化中... ({e})")
     
-    # 启动后台监控
+    # 启动后台监控和天气刷新
     start_background_monitoring()
+    WEATHER.start()
     
     app.run(debug=True, host='0.0.0.0', port=8080)
\ No newline at end of file
@@ -0,0 +1,467 @@
+"""小布聊天机器人的ASGI异步服务模式
+
+聊天接口的Claude调用使用asyncio子进程并流式读取输出，SSE推送使用异步生成器，
+等待中的连接和进行中的Claude调用都不占用线程；聊天流程中读写文件、检测和构建prompt等同步步骤
+在线程池中执行，不阻塞事件循环；其余接口转交Flask应用在线程池中处理。
+WebSocket通道只在线程模式(app.py)下提供，前端会自动退回HTTP和SSE。
+
+运行: uvicorn asgi:application --host 0.0.0.0 --port 8080
+"""
+import asyncio
+import codecs
+import contextvars
+import io
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import app as core
+
+# 转交Flask处理普通接口的线程数
+WSGI_WORKERS = int(os.environ.get('XIAOBU_ASGI_WSGI_WORKERS', 16))
+# 执行聊天流程中同步步骤（读写聊天记录、检测、构建prompt、写SQLite）的线程数
+CHAT_STEP_WORKERS = int(os.environ.get('XIAOBU_ASGI_CHAT_WORKERS', 16))
+MAX_REQUEST_BODY = 1024 * 1024  # 请求体上限（字节）
+
+WSGI_EXECUTOR = ThreadPoolExecutor(max_workers=WSGI_WORKERS, thread_name_prefix='asgi-wsgi')
+CHAT_STEP_EXECUTOR = ThreadPoolExecutor(max_workers=CHAT_STEP_WORKERS, thread_name_prefix='asgi-chat')
+
+
+async def run_sync(func, *args):
+    """在线程池中执行同步步骤，带上当前的contextvars，追踪span仍记在本请求下"""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(CHAT_STEP_EXECUTOR, context.run, func, *args)
+
+
+def advance_steps(steps, value):
+    """推进聊天流程生成器，返回(是否结束, 下一个Claude调用或最终结果)
+
+    StopIteration不能跨线程池的Future传递，在这里转换为返回值。
+    """
+    try:
+        return False, steps.send(value)
+    except StopIteration as done:
+        return True, done.value
+
+
+async def run_claude_process_async(prompt, timeout, on_chunk=None, cancel_token=None, purpose='chat',
+                                   client_id=None):
+    """异步运行claude命令并流式读取输出，返回(returncode, stdout, stderr)
+
+    与app.run_claude_process行为一致：超时会结束子进程组并抛出TimeoutExpired，
+    cancel_token被取消时立即结束子进程组并抛出ChatCancelled。子进程由asyncio回收，
+    记入费用账本的CPU时间和内存峰值来自运行期间的psutil采样。
+    """
+    cancel_token = cancel_token or core.CancelToken()
+    if cancel_token.cancelled:
+        raise core.ChatCancelled(cancel_token.reason)
+    process = await asyncio.create_subprocess_exec(
+        'claude', '-p', prompt,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True)
+    core.LLM_PROCESSES_IN_FLIGHT.inc(kind='chat')
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    kill = lambda: loop.call_soon_threadsafe(core.kill_process_group, process)
+    cancel_token.add_callback(kill)
+    usage = core.ChildUsageSampler(process.pid)
+
+    async def sample_usage():
+        while True:
+            usage.sample()
+            await asyncio.sleep(core.COST_USAGE_SAMPLE_INTERVAL)
+
+    sampler = asyncio.ensure_future(sample_usage())
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    stdout_chunks = []
+
+    async def read_stdout():
+        while True:
+            data = await process.stdout.read(65536)
+            if not data:
+                return
+            stdout_chunks.append(data)
+            if on_chunk:
+                text = decoder.decode(data)
+                if text:
+                    on_chunk(text)
+
+    async def communicate():
+        _, stderr = await asyncio.gather(read_stdout(), process.stderr.read())
+        usage.sample()
+        await process.wait()
+        return stderr
+
+    try:
+        stderr = await asyncio.wait_for(communicate(), timeout)
+    except BaseException as e:
+        if process.returncode is None:
+            core.kill_process_group(process)
+            await process.wait()
+        if isinstance(e, asyncio.TimeoutError):
+            raise subprocess.TimeoutExpired(['claude', '-p', prompt], timeout) from None
+        raise
+    finally:
+        sampler.cancel()
+        cancel_token.remove_callback(kill)
+        elapsed = loop.time() - started
+        stdout = b''.join(stdout_chunks).decode('utf-8', errors='replace')
+        core.LLM_PROCESSES_IN_FLIGHT.dec(kind='chat')
+        core.CHAT_STAGE_SECONDS.observe(elapsed, stage='llm')
+        # 账本写入是SQLite事务（可能等待其他进程的写锁），放到线程池中执行，不阻塞事件循环
+        await run_sync(core.COST_LEDGER.record, client_id, purpose, len(prompt), len(stdout), elapsed,
+                       usage.cpu_seconds, usage.max_rss_kb, process.returncode != 0)
+
+    if cancel_token.cancelled and process.returncode != 0:
+        core.CANCEL_TOKENS.record_kill(elapsed)
+        raise core.ChatCancelled(cancel_token.reason)
+    core.CANCEL_TOKENS.record_call(elapsed)
+    return process.returncode, stdout, stderr.decode('utf-8', errors='replace')
+
+
+async def call_claude_async(message, context, client_id=None, on_chunk=None, cancel_token=None, purpose='chat'):
+    """call_claude的异步版本，返回(回复, 错误)"""
+    try:
+        full_prompt = await run_sync(core.prepare_claude_prompt, message, context, client_id)
+        with core.trace_span('claude_process', prompt_length=len(full_prompt)):
+            result = await run_claude_process_async(full_prompt, core.CLAUDE_TIMEOUT, on_chunk, cancel_token,
+                                                    purpose, client_id)
+        return core.parse_claude_result(*result)
+    except core.ChatCancelled:
+        core.log_event(logging.INFO, '请求已取消，Claude进程已结束', client_id, reason=cancel_token.reason)
+        return None, core.CHAT_CANCELLED_ERROR
+    except subprocess.TimeoutExpired:
+        core.LLM_TIMEOUTS_TOTAL.inc()
+        return None, "请求超时"
+    except FileNotFoundError:
+        return None, "Claude 命令未找到"
+    except Exception as e:
+        return None, str(e)
+
+
+async def acquire_llm_slot(client_id, cancel_token, timeout=core.LLM_QUEUE_TIMEOUT):
+    """异步等待公平调度器分配Claude调用名额，返回SlotRequest（未获得名额时granted为False）
+
+    排队期间请求被取消时立即放弃排队。
+    """
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+    notify = lambda: loop.call_soon_threadsafe(wake.set)
+    slot_request = core.LLM_SCHEDULER.enqueue(client_id, notify)
+    if slot_request.rejected or slot_request.granted:
+        return slot_request
+    cancel_token.add_callback(notify)
+    try:
+        await asyncio.wait_for(wake.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    except BaseException:
+        if core.LLM_SCHEDULER.withdraw(slot_request, 'cancelled'):
+            core.LLM_SCHEDULER.release(slot_request)
+        raise
+    finally:
+        cancel_token.remove_callback(notify)
+    # 已获得名额时withdraw直接返回，否则按取消或超时退出队列
+    core.LLM_SCHEDULER.withdraw(slot_request, 'cancelled' if cancel_token.cancelled else 'timeouts')
+    return slot_request
+
+
+async def process_chat_async(client_id, message, on_chunk=None, cancel_token=None):
+    """process_chat的异步版本：沿用同一聊天流程
+
+    流程生成器的每一步都在线程池中推进，事件循环上只等待Claude子进程和调度名额。
+    """
+    cancel_token = cancel_token or core.CancelToken()
+    started = asyncio.get_running_loop().time()
+    with core.start_trace('chat', client_id=client_id[:8], message_length=len(message), mode='async') as trace:
+        steps = core.chat_steps(client_id, message, cancel_token)
+        finished, value = await run_sync(advance_steps, steps, None)
+        if not finished:
+            with core.trace_span('llm_queue'):
+                slot_request = await acquire_llm_slot(client_id, cancel_token)
+            try:
+                for attempt in itertools.count(1):
+                    with core.trace_span('call_claude', attempt=attempt) as span:
+                        if cancel_token.cancelled:
+                            core.CANCEL_TOKENS.record_avoided_call('avoided_calls')
+                            result = None, core.CHAT_CANCELLED_ERROR
+                        elif slot_request.granted:
+                            result = await call_claude_async(*value, client_id=client_id, on_chunk=on_chunk,
+                                                             cancel_token=cancel_token,
+                                                             purpose='chat' if attempt == 1 else 'retry')
+                        else:
+                            result = None, core.LLM_BUSY_ERROR
+                        if span and result[1]:
+                            span.set(error=result[1])
+                    finished, value = await run_sync(advance_steps, steps, result)
+                    if finished:
+                        break
+            finally:
+                core.LLM_SCHEDULER.release(slot_request)
+        core.record_chat_request(value[1], asyncio.get_running_loop().time() - started)
+        if trace:
+            trace.root.set(status=value[1])
+        return value
+
+
+def get_headers(scope):
+    """把ASGI请求头转换为小写键的字典，重复的头用逗号合并"""
+    headers = {}
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1').lower(), value.decode('latin-1')
+        headers[name] = f"{headers[name]},{value}" if name in headers else value
+    return headers
+
+
+def get_client_ip(scope):
+    client = scope.get('client')
+    return client[0] if client else None
+
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body.extend(message.get('body', b''))
+        if len(body) > MAX_REQUEST_BODY:
+            raise ValueError('请求体过大')
+        if not message.get('more_body'):
+            return bytes(body)
+
+
+async def send_response(send, status, body, content_type='application/json', headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode('latin-1')),
+                    (b'content-length', str(len(body)).encode('latin-1')),
+                    *headers]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, payload, status=200):
+    await send_response(send, status, json.dumps(payload).encode('utf-8'))
+
+
+async def handle_chat(scope, receive, send):
+    """POST /api/chat：Claude调用期间不占用线程"""
+    try:
+        body = await read_body(receive)
+        if body is None:
+            return
+        data = json.loads(body or b'{}')
+        message = (data.get('message') or '').strip()
+    except (ValueError, AttributeError):
+        await send_json(send, {'error': '请求格式错误'}, 400)
+        return
+
+    headers = get_headers(scope)
+    client_id = core.compute_client_id(get_client_ip(scope),
+                                       headers.get('user-agent', ''),
+                                       headers.get('accept-language', ''),
+                                       headers.get('accept-encoding', ''))
+    request_id = data.get('request_id')
+    limited = await run_sync(core.check_rate_limit, client_id)
+    if limited:
+        payload, status_code = limited
+        await send_response(send, status_code, json.dumps(payload).encode('utf-8'),
+                            headers=[(b'retry-after', str(payload['retry_after']).encode('latin-1'))])
+        return
+    # 用户点击停止（/api/chat/cancel）或断开连接时取消请求并结束Claude进程
+    with core.CANCEL_TOKENS.track(client_id, request_id) as cancel_token:
+        async def cancel_on_disconnect():
+            await wait_for_disconnect(receive)
+            cancel_token.cancel('disconnect')
+
+        watcher = asyncio.ensure_future(cancel_on_disconnect())
+        try:
+            payload, status_code = await process_chat_async(client_id, message, cancel_token=cancel_token)
+        finally:
+            watcher.cancel()
+    if cancel_token.reason != 'disconnect':
+        await send_json(send, payload, status_code)
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def handle_sse(scope, receive, send, topic, initial_events):
+    """SSE推送：订阅者有新事件时由生产者线程唤醒，等待期间不占用线程"""
+    headers = get_headers(scope)
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    last_event_id = headers.get('last-event-id') or query.get('lastEventId', [None])[0]
+    subscriber, events = core.open_sse_subscription(topic, last_event_id, initial_events)
+
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+    subscriber.waker = lambda: loop.call_soon_threadsafe(wake.set)
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+
+    async def send_text(text, more_body=True):
+        await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': more_body})
+
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                        (b'cache-control', b'no-cache'),
+                        (b'x-accel-buffering', b'no')]
+        })
+        for item in events:
+            await send_text(core.format_sse_event(*item))
+
+        while True:
+            # 先清除唤醒标记再取事件，避免取完到等待之间到达的事件丢失唤醒
+            wake.clear()
+            item = subscriber.get(timeout=0)
+            while item is not None:
+                await send_text(core.format_sse_event(*item))
+                item = subscriber.get(timeout=0)
+            if subscriber.closed:
+                await send_text('', more_body=False)
+                break
+
+            waiter = asyncio.ensure_future(wake.wait())
+            done, _ = await asyncio.wait({waiter, disconnect}, timeout=core.SSE_HEARTBEAT_INTERVAL,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if waiter not in done:
+                waiter.cancel()
+            if disconnect in done:
+                break
+            if not done:
+                await send_text(": heartbeat\n\n")
+    finally:
+        disconnect.cancel()
+        core.HUB.unsubscribe(subscriber)
+
+
+def build_environ(scope, body):
+    """根据ASGI请求构建WSGI environ"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': get_client_ip(scope) or '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in get_headers(scope).items():
+        key = name.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = f'HTTP_{key}'
+        if key != 'CONTENT_LENGTH':
+            environ[key] = value
+    return environ
+
+
+def run_wsgi(environ):
+    """在线程池中调用Flask应用，返回(状态码, 响应头, 响应体)"""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = headers
+
+    result = core.app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], response['headers'], body
+
+
+async def handle_wsgi(scope, receive, send):
+    """其余接口交给Flask处理（响应整体缓冲后发送）"""
+    try:
+        body = await read_body(receive)
+    except ValueError:
+        await send_json(send, {'error': '请求体过大'}, 413)
+        return
+    if body is None:
+        return
+
+    loop = asyncio.get_running_loop()
+    status, headers, content = await loop.run_in_executor(WSGI_EXECUTOR, run_wsgi, build_environ(scope, body))
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+    })
+    await send({'type': 'http.response.body', 'body': content})
+
+
+def start_services():
+    """初始化数据文件并启动后台采样和天气刷新"""
+    core.ensure_data_dir()
+    core.ensure_question_file()
+    core.ensure_persona_question_file()
+    core.start_background_monitoring()
+    core.WEATHER.start()
+
+
+async def handle_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            start_services()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            WSGI_EXECUTOR.shutdown(wait=False)
+            CHAT_STEP_EXECUTOR.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGI入口：聊天和SSE接口原生异步处理，其余接口转交Flask"""
+    if scope['type'] == 'lifespan':
+        await handle_lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        # WebSocket通道只在线程模式下提供，拒绝后前端退回HTTP和SSE
+        await send({'type': 'websocket.close', 'code': 1000})
+        return
+
+    method, path = scope['method'], scope['path']
+    if method == 'POST' and path == '/api/chat':
+        await handle_chat(scope, receive, send)
+    elif method == 'GET' and path in core.SSE_ROUTES:
+        topic, initial_events = core.SSE_ROUTES[path]
+        await handle_sse(scope, receive, send, topic, initial_events)
+    else:
+        await handle_wsgi(scope, receive, send)
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        print("异步模式需要uvicorn，请先执行: pip install uvicorn")
+        sys.exit(1)
+
+    print("启动小布智能情绪聊天机器人（异步模式）...")
+    uvicorn.run(application, host='0.0.0.0', port=8080)
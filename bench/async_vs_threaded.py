@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""对比线程模式(app.py)与异步模式(asgi.py)的并发能力
+
+先建立一批SSE长连接，再在连接保持期间发起一批并发聊天请求（Claude由bench/fake_claude.py模拟），
+统计聊天延迟、成功数、长连接存活数，以及服务进程的峰值线程数和内存。
+
+用法:
+    python bench/async_vs_threaded.py --streams 1000 --chats 200 --latency 2
+    python bench/async_vs_threaded.py --mode async --json
+
+异步模式需要安装uvicorn。服务在临时目录中运行，不会改动仓库里的数据。
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import psutil
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_CLAUDE = os.path.join(ROOT, 'bench', 'fake_claude.py')
+HOST = '127.0.0.1'
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def serve(mode, port):
+    """在当前进程中启动服务（由基准进程以子进程方式调用）"""
+    raise_fd_limit()
+    sys.path.insert(0, ROOT)
+    if mode == 'threaded':
+        from werkzeug.serving import make_server
+        import app
+        app.start_background_monitoring()
+        server = make_server(HOST, port, app.app, threaded=True)
+        server.socket.listen(1024)
+        server.serve_forever()
+    else:
+        import uvicorn
+        import asgi
+        uvicorn.run(asgi.application, host=HOST, port=port, log_level='warning', backlog=1024)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+
+def start_server(mode, workdir, latency, extra_env=None):
+    """在临时目录中启动服务，PATH中的claude指向模拟脚本；extra_env覆盖服务和模拟脚本的环境变量"""
+    bin_dir = os.path.join(workdir, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    wrapper = os.path.join(bin_dir, 'claude')
+    with open(wrapper, 'w') as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_CLAUDE}" "$@"\n')
+    os.chmod(wrapper, 0o755)
+    for name in ('xiaobu.md', 'weather_stub.json'):
+        if os.path.exists(os.path.join(ROOT, name)):
+            shutil.copy(os.path.join(ROOT, name), workdir)
+
+    env = dict(os.environ, PATH=f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}",
+               FAKE_CLAUDE_LATENCY=str(latency), **(extra_env or {}))
+    port = free_port()
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', mode, '--port', str(port)],
+                               cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return process, port
+
+
+async def request(port, method, path, body=b'', headers=None, timeout=120):
+    """发送一个HTTP/1.1请求并读取完整响应，返回(状态码, 响应体)"""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(HOST, port), timeout)
+    try:
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {HOST}:{port}', 'Connection: close',
+                 f'Content-Length: {len(body)}']
+        lines += [f'{name}: {value}' for name, value in (headers or {}).items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+    head, _, content = response.partition(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1]) if head else 0
+    return status, content
+
+
+async def wait_until_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            status, _ = await request(port, 'GET', '/api/history', timeout=5)
+            if status == 200:
+                return
+        except OSError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError('服务启动超时')
+
+
+async def hold_stream(port, opened, stop):
+    """建立一条SSE长连接并持续读取，直到stop被设置；返回连接是否一直保持"""
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(HOST, port), 30)
+        writer.write(f'GET /api/realtime/status HTTP/1.1\r\nHost: {HOST}:{port}\r\n'
+                     f'Accept: text/event-stream\r\n\r\n'.encode())
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), 30)
+    except (OSError, asyncio.TimeoutError):
+        opened.append(False)
+        return False
+    opened.append(status_line.split(b' ')[1:2] == [b'200'])
+
+    alive = True
+    read = asyncio.ensure_future(reader.read(65536))
+    waiter = asyncio.ensure_future(stop.wait())
+    try:
+        while alive:
+            done, _ = await asyncio.wait({read, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            if waiter in done:
+                break
+            alive = bool(read.result())
+            read = asyncio.ensure_future(reader.read(65536))
+    except OSError:
+        alive = False
+    finally:
+        read.cancel()
+        waiter.cancel()
+        writer.close()
+    return alive and opened[-1]
+
+
+async def chat(port, index):
+    body = json.dumps({'message': f'今天过得怎么样{index}'}).encode()
+    headers = {'Content-Type': 'application/json', 'User-Agent': f'bench-client-{index}'}
+    start = time.perf_counter()
+    try:
+        status, _ = await request(port, 'POST', '/api/chat', body, headers)
+    except (OSError, asyncio.TimeoutError):
+        status = 0
+    return status, time.perf_counter() - start
+
+
+async def sample_process(pid, stop, peaks):
+    """定期采样服务进程的线程数和内存，记录峰值"""
+    process = psutil.Process(pid)
+    while not stop.is_set():
+        try:
+            peaks['threads'] = max(peaks['threads'], process.num_threads())
+            peaks['rss_mb'] = max(peaks['rss_mb'], process.memory_info().rss / 1024 / 1024)
+        except psutil.Error:
+            return
+        await asyncio.sleep(0.2)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run_mode(mode, args):
+    workdir = tempfile.mkdtemp(prefix=f'xiaobu-bench-{mode}-')
+    # 对比的是并发承载能力，放开限流和Claude调用名额
+    process, port = start_server(mode, workdir, args.latency,
+                                 {'XIAOBU_LLM_SLOTS': '100000', 'XIAOBU_RATE_LIMIT_BURST': '0'})
+    try:
+        await wait_until_ready(port)
+        peaks = {'threads': 0, 'rss_mb': 0.0}
+        stop_sampling = asyncio.Event()
+        sampler = asyncio.ensure_future(sample_process(process.pid, stop_sampling, peaks))
+
+        # 分批建立SSE长连接，避免瞬间压满监听队列
+        stop_streams = asyncio.Event()
+        opened = []
+        streams = []
+        for start in range(0, args.streams, 100):
+            batch = [asyncio.ensure_future(hold_stream(port, opened, stop_streams))
+                     for _ in range(start, min(start + 100, args.streams))]
+            streams.extend(batch)
+            while len(opened) < len(streams):
+                await asyncio.sleep(0.01)
+        idle = psutil.Process(process.pid)
+        idle_threads, idle_rss = idle.num_threads(), idle.memory_info().rss / 1024 / 1024
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(chat(port, i) for i in range(args.chats)))
+        elapsed = time.perf_counter() - start
+
+        stop_streams.set()
+        alive = sum(await asyncio.gather(*streams))
+        stop_sampling.set()
+        await sampler
+
+        latencies = [latency for status, latency in results if status == 200]
+        return {
+            'mode': mode,
+            'streams_requested': args.streams,
+            'streams_opened': sum(opened),
+            'streams_alive': alive,
+            'chats': args.chats,
+            'chats_ok': len(latencies),
+            'chat_errors': args.chats - len(latencies),
+            'chat_wall_seconds': round(elapsed, 3),
+            'chat_latency_p50': round(percentile(latencies, 0.5), 3) if latencies else None,
+            'chat_latency_p95': round(percentile(latencies, 0.95), 3) if latencies else None,
+            'chat_latency_max': round(max(latencies), 3) if latencies else None,
+            'chat_latency_mean': round(statistics.mean(latencies), 3) if latencies else None,
+            'threads_with_streams': idle_threads,
+            'rss_mb_with_streams': round(idle_rss, 1),
+            'peak_threads': peaks['threads'],
+            'peak_rss_mb': round(peaks['rss_mb'], 1),
+        }
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='线程模式与异步模式并发对比')
+    parser.add_argument('--mode', choices=['both', 'threaded', 'async'], default='both')
+    parser.add_argument('--streams', type=int, default=500, help='保持的SSE长连接数')
+    parser.add_argument('--chats', type=int, default=100, help='并发聊天请求数')
+    parser.add_argument('--latency', type=float, default=2.0, help='模拟Claude调用耗时（秒）')
+    parser.add_argument('--json', action='store_true', help='以JSON输出结果')
+    parser.add_argument('--serve', choices=['threaded', 'async'], help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port)
+        return
+
+    raise_fd_limit()
+    modes = ['threaded', 'async'] if args.mode == 'both' else [args.mode]
+    reports = [asyncio.run(run_mode(mode, args)) for mode in modes]
+
+    if args.json:
+        print(json.dumps(reports, ensure_ascii=False, indent=2))
+        return
+    for report in reports:
+        print(f"\n[{report['mode']}]")
+        for key, value in report.items():
+            if key != 'mode':
+                print(f"  {key:<22} {value}")
+
+
+if __name__ == '__main__':
+    main()
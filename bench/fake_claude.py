@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""模拟claude命令行，用于压测时替代真实的Claude调用
+
+用法与claude相同（claude -p <prompt>），回复分几段输出以模拟流式生成。
+FAKE_CLAUDE_LATENCY       总耗时（秒），默认2
+FAKE_CLAUDE_JITTER        耗时在±该值内均匀抖动（秒），默认0
+FAKE_CLAUDE_FAILURE_RATE  以该概率在输出一半后失败退出（退出码1），默认0
+"""
+import os
+import random
+import sys
+import time
+
+REPLY = "哈哈，今天还行吧，就是作业有点多"
+
+
+def main():
+    latency = float(os.environ.get('FAKE_CLAUDE_LATENCY', 2))
+    jitter = float(os.environ.get('FAKE_CLAUDE_JITTER', 0))
+    failure_rate = float(os.environ.get('FAKE_CLAUDE_FAILURE_RATE', 0))
+    latency = max(0.0, latency + random.uniform(-jitter, jitter))
+    fail_after = 2 if random.random() < failure_rate else None
+    parts = 4
+    for i in range(parts):
+        if i == fail_after:
+            sys.stderr.write('Error: simulated API failure\n')
+            sys.exit(1)
+        time.sleep(latency / parts)
+        sys.stdout.write(REPLY[i * len(REPLY) // parts:(i + 1) * len(REPLY) // parts])
+        sys.stdout.flush()
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""端到端压测：在模拟Claude下测出服务的吞吐上限
+
+在临时目录中启动服务（Claude由bench/fake_claude.py模拟，可配置耗时、抖动和失败率），
+用一批模拟客户端按泊松到达过程发送聊天消息。消息取自真实的chat_data对话记录（--replay），
+或使用内置语料生成的合成对话。每个模拟客户端使用不同的User-Agent，因此对应不同的客户端ID，
+同一客户端在上一条回复返回前不会发送下一条。
+
+报告为JSON：延迟p50/p95/p99、吞吐、错误率和状态码分布，以及按采样间隔记录的服务进程CPU、RSS、线程数和进行中的请求数。
+
+用法:
+    python bench/loadtest.py --clients 200 --rate 20 --duration 60
+    python bench/loadtest.py --replay chat_data --latency 2 --jitter 1 --failure-rate 0.05 --report report.json
+    python bench/loadtest.py --mode async --server-env XIAOBU_LLM_SLOTS=16
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import psutil
+
+from async_vs_threaded import percentile, raise_fd_limit, request, start_server, wait_until_ready
+
+# 合成对话语料：日常闲聊为主，混入会触发隐私检测和人设问题检测的消息
+SYNTHETIC_MESSAGES = [
+    '今天过得怎么样', '作业写完了吗', '周末想去哪里玩', '我今天考试考砸了，好难过', '你喜欢什么颜色',
+    '推荐一本书吧', '最近好累啊', '明天要下雨吗', '你最喜欢的动漫是什么', '我们班今天换座位了',
+    '晚饭吃什么好呢', '你几点睡觉', '数学题好难，帮我想想思路', '我和朋友吵架了', '放假了好开心',
+    '你多大了', '你是哪里人', '你有兄弟姐妹吗', '你在哪个学校上学',
+    '我的手机号是13800138000', '我家住在幸福路18号', '我的身份证号能告诉你吗',
+    '给我讲个笑话', '今天体育课跑了八百米', '你会弹钢琴吗', '我想养一只猫',
+]
+
+
+def load_replay_conversations(directory):
+    """从chat_data目录读取每个客户端的用户消息序列"""
+    conversations = []
+    for path in sorted(glob.glob(os.path.join(directory, 'chat_*.json'))):
+        try:
+            with open(path, encoding='utf-8') as f:
+                history = json.load(f).get('history', [])
+        except (OSError, ValueError):
+            continue
+        messages = [item['content'] for item in history if item.get('type') == 'user' and item.get('content')]
+        if messages:
+            conversations.append(messages)
+    return conversations
+
+
+def synthetic_conversations(count, rng):
+    """生成count段合成对话，长度服从几何分布（多数很短，少数很长）"""
+    conversations = []
+    for _ in range(count):
+        length = 1
+        while rng.random() < 0.85 and length < 200:
+            length += 1
+        conversations.append([rng.choice(SYNTHETIC_MESSAGES) for _ in range(length)])
+    return conversations
+
+
+class SimulatedClient:
+    """一个模拟客户端：循环发送分配给它的对话"""
+
+    def __init__(self, index, conversation):
+        self.index = index
+        self.conversation = conversation
+        self.position = 0
+        self.busy = False
+
+    def next_message(self):
+        message = self.conversation[self.position % len(self.conversation)]
+        self.position += 1
+        return message
+
+
+async def send_chat(port, client, timeout):
+    body = json.dumps({'message': client.next_message()}, ensure_ascii=False).encode()
+    headers = {'Content-Type': 'application/json', 'User-Agent': f'loadtest-client-{client.index}'}
+    start = time.perf_counter()
+    try:
+        status, _ = await request(port, 'POST', '/api/chat', body, headers, timeout)
+    except (OSError, asyncio.TimeoutError):
+        status = 0
+    return status, time.perf_counter() - start
+
+
+async def sample_server(pid, interval, stop, state, timeline):
+    """按间隔记录服务进程的CPU、RSS、线程数、claude子进程数及这段时间内完成的请求数"""
+    process = psutil.Process(pid)
+    process.cpu_percent(None)
+    started = time.perf_counter()
+    last_completed = last_errors = 0
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            with process.oneshot():
+                cpu = process.cpu_percent(None)
+                rss = process.memory_info().rss / 1024 / 1024
+                threads = process.num_threads()
+            claude_processes = len(process.children(recursive=True))
+        except psutil.Error:
+            return
+        timeline.append({
+            't': round(time.perf_counter() - started, 2),
+            'cpu_percent': cpu,
+            'rss_mb': round(rss, 1),
+            'threads': threads,
+            'claude_processes': claude_processes,
+            'in_flight': state['in_flight'],
+            'completed': state['completed'] - last_completed,
+            'errors': state['errors'] - last_errors,
+        })
+        last_completed, last_errors = state['completed'], state['errors']
+
+
+async def run_load(port, pid, clients, args):
+    rng = random.Random(args.seed)
+    state = {'in_flight': 0, 'completed': 0, 'errors': 0}
+    results = []
+    skipped = 0
+    timeline = []
+    stop = asyncio.Event()
+    sampler = asyncio.ensure_future(sample_server(pid, args.sample_interval, stop, state, timeline))
+
+    async def one_request(client):
+        state['in_flight'] += 1
+        status, latency = await send_chat(port, client, args.timeout)
+        state['in_flight'] -= 1
+        state['completed'] += 1
+        if status != 200:
+            state['errors'] += 1
+        client.busy = False
+        results.append((status, latency))
+
+    tasks = []
+    start = time.perf_counter()
+    next_arrival = start
+    while True:
+        next_arrival += rng.expovariate(args.rate)
+        if next_arrival - start >= args.duration:
+            break
+        await asyncio.sleep(max(0, next_arrival - time.perf_counter()))
+        idle = [client for client in clients if not client.busy]
+        if not idle:
+            # 所有模拟客户端都在等回复，说明客户端数不足以产生设定的到达率
+            skipped += 1
+            continue
+        client = rng.choice(idle)
+        client.busy = True
+        tasks.append(asyncio.ensure_future(one_request(client)))
+    offered_seconds = time.perf_counter() - start
+    await asyncio.gather(*tasks)
+    wall = time.perf_counter() - start
+    stop.set()
+    await sampler
+    return results, skipped, offered_seconds, wall, timeline
+
+
+def summarize(results, skipped, offered_seconds, wall, timeline, args, conversations_source):
+    latencies = [latency for status, latency in results if status == 200]
+    status_counts = {}
+    for status, _ in results:
+        status_counts[str(status)] = status_counts.get(str(status), 0) + 1
+    cpu = [point['cpu_percent'] for point in timeline]
+    rss = [point['rss_mb'] for point in timeline]
+
+    def seconds(value):
+        return round(value, 4) if value is not None else None
+
+    return {
+        'config': {
+            'mode': args.mode,
+            'clients': args.clients,
+            'arrival_rate': args.rate,
+            'duration': args.duration,
+            'conversations': conversations_source,
+            'claude_latency': args.latency,
+            'claude_jitter': args.jitter,
+            'claude_failure_rate': args.failure_rate,
+            'server_env': dict(item.split('=', 1) for item in args.server_env),
+            'seed': args.seed,
+        },
+        'requests': len(results),
+        'ok': len(latencies),
+        'errors': len(results) - len(latencies),
+        'error_rate': round((len(results) - len(latencies)) / len(results), 4) if results else 0,
+        'status_counts': status_counts,
+        'skipped_arrivals': skipped,
+        'offered_rps': round((len(results) + skipped) / offered_seconds, 3) if offered_seconds else 0,
+        'throughput_rps': round(len(latencies) / wall, 3) if wall else 0,
+        'wall_seconds': round(wall, 3),
+        'latency_seconds': {
+            'p50': seconds(percentile(latencies, 0.5)),
+            'p95': seconds(percentile(latencies, 0.95)),
+            'p99': seconds(percentile(latencies, 0.99)),
+            'mean': seconds(statistics.mean(latencies) if latencies else None),
+            'max': seconds(max(latencies) if latencies else None),
+        },
+        'server': {
+            'cpu_percent_mean': round(statistics.mean(cpu), 1) if cpu else None,
+            'cpu_percent_peak': max(cpu) if cpu else None,
+            'rss_mb_peak': max(rss) if rss else None,
+            'threads_peak': max((point['threads'] for point in timeline), default=None),
+        },
+        'timeline': timeline,
+    }
+
+
+async def main_async(args):
+    rng = random.Random(args.seed)
+    if args.replay:
+        conversations = load_replay_conversations(args.replay)
+        if not conversations:
+            raise SystemExit(f'{args.replay} 中没有可回放的对话记录')
+        source = f'replay:{args.replay}'
+    else:
+        conversations = synthetic_conversations(args.clients, rng)
+        source = 'synthetic'
+    clients = [SimulatedClient(i, conversations[i % len(conversations)]) for i in range(args.clients)]
+
+    extra_env = {
+        'FAKE_CLAUDE_JITTER': str(args.jitter),
+        'FAKE_CLAUDE_FAILURE_RATE': str(args.failure_rate),
+        'XIAOBU_LOG_LEVEL': 'WARNING',
+    }
+    extra_env.update(item.split('=', 1) for item in args.server_env)
+    workdir = tempfile.mkdtemp(prefix='xiaobu-loadtest-')
+    process, port = start_server(args.mode, workdir, args.latency, extra_env)
+    try:
+        await wait_until_ready(port)
+        results, skipped, offered_seconds, wall, timeline = await run_load(port, process.pid, clients, args)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return summarize(results, skipped, offered_seconds, wall, timeline, args, source)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='端到端压测（模拟Claude）')
+    parser.add_argument('--mode', choices=['threaded', 'async'], default='threaded')
+    parser.add_argument('--clients', type=int, default=100, help='模拟客户端数（各自独立的客户端ID）')
+    parser.add_argument('--rate', type=float, default=10.0, help='平均到达率（每秒请求数，泊松到达）')
+    parser.add_argument('--duration', type=float, default=30.0, help='发送请求的时长（秒），之后等待进行中的请求完成')
+    parser.add_argument('--replay', help='回放该目录下chat_*.json中的用户消息，不指定时使用合成对话')
+    parser.add_argument('--latency', type=float, default=2.0, help='模拟Claude调用耗时（秒）')
+    parser.add_argument('--jitter', type=float, default=0.0, help='耗时在±该值内均匀抖动（秒）')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='模拟Claude调用失败的概率')
+    parser.add_argument('--server-env', action='append', default=[], metavar='KEY=VALUE',
+                        help='服务进程的环境变量，可重复，如XIAOBU_LLM_SLOTS=16')
+    parser.add_argument('--timeout', type=float, default=180.0, help='单个请求的超时（秒）')
+    parser.add_argument('--sample-interval', type=float, default=1.0, help='服务进程资源采样间隔（秒）')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--report', help='报告写入的JSON文件，不指定时输出到标准输出')
+    args = parser.parse_args()
+    if any('=' not in item for item in args.server_env):
+        parser.error('--server-env 的格式为 KEY=VALUE')
+
+    raise_fd_limit()
+    report = asyncio.run(main_async(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        latency = report['latency_seconds']
+        print(f"{report['ok']}/{report['requests']} ok, {report['throughput_rps']} req/s, "
+              f"p50={latency['p50']} p95={latency['p95']} p99={latency['p99']} -> {args.report}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""热点函数的微基准与回归对比
+
+覆盖上下文修剪与长度计算、隐私/人设检测、情绪分析、小布情绪计算、情绪prompt生成、
+不同历史长度下的load_data/save_data，以及get_client_id。输入由固定种子生成，
+包括短消息、长消息和针对正则回溯的对抗性中文文本。
+
+每项用timeit自动确定循环次数，重复多次取单次调用的最小值（受系统噪声影响最小）作为比较依据。
+
+用法:
+    python bench/micro.py                                   # 运行并打印结果
+    python bench/micro.py --save bench/baseline.json        # 保存为基线
+    python bench/micro.py --compare bench/baseline.json     # 与基线对比，变慢超过阈值时退出码为1
+    python bench/micro.py --filter detect --repeat 7 --threshold 0.1
+
+基准在临时目录中运行，不会改动仓库里的数据。
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEED = 20240601
+
+# 常用汉字和口语片段，用于拼出长度可控的消息
+COMMON_CHARS = '的一是了我不人在他有这个上们来到时大地为子中你说生国年着就那和要她出也得里后自以会家可下而过天去能对小多然于心学么之都好看起发当没成只如事把还用第样道想作种开美总从无情己面最女但现前些所同日手又行意动'
+PHRASES = ['今天', '作业', '考试', '开心', '难过', '朋友', '老师', '周末', '游戏', '生气', '担心', '喜欢', '讨厌',
+           '你觉得', '为什么', '怎么办', '吗?', '呢?', '哈哈', '好累']
+HISTORY_SIZES = (10, 100, 1000, 5000)
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """注册一个基准：被装饰的函数接收输入数据，返回待计时的无参函数"""
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+
+def random_text(rng, length):
+    parts = []
+    size = 0
+    while size < length:
+        part = rng.choice(PHRASES) if rng.random() < 0.3 else ''.join(rng.choices(COMMON_CHARS, k=rng.randint(2, 8)))
+        parts.append(part)
+        size += len(part)
+    return ''.join(parts)[:length]
+
+
+def build_inputs(seed):
+    rng = random.Random(seed)
+    context = []
+    for _ in range(200):
+        context.append(f"用户: {random_text(rng, rng.randint(5, 200))}")
+        context.append(f"助手: {random_text(rng, rng.randint(20, 600))}")
+    return {
+        'short': '今天过得怎么样，作业写完了吗?',
+        'long': random_text(rng, 5000),
+        # 对抗性输入：'你'之后永远等不到结尾的问句模式，以及一长串不构成手机号的数字和汉字
+        'adversarial_question': '你' * 2000,
+        'adversarial_mixed': ''.join(rng.choice(['你', '1234567890', '的市', '老', 'X']) for _ in range(1500)),
+        'context_small': context[:20],
+        'context_full': context[:60],
+        'context_overflow': context,
+        'global_memory': random_text(rng, 3000),
+        'histories': {size: make_chat_data(rng, size) for size in HISTORY_SIZES},
+    }
+
+
+def make_chat_data(rng, size):
+    history = []
+    for i in range(size):
+        kind = 'user' if i % 2 == 0 else 'bot'
+        history.append({'type': kind, 'content': random_text(rng, rng.randint(5, 300)),
+                        'timestamp': f'2024-06-01T12:{i % 60:02d}:00'})
+    context = [f"{'用户' if item['type'] == 'user' else '助手'}: {item['content']}" for item in history[-60:]]
+    return {'context': context, 'history': history}
+
+
+@benchmark('calculate_context_length/full')
+def bench_context_length(app, data):
+    return lambda: app.calculate_context_length(data['context_full'], data['global_memory'])
+
+
+@benchmark('trim_context/small')
+def bench_trim_small(app, data):
+    return lambda: app.trim_context(data['context_small'], data['global_memory'])
+
+
+@benchmark('trim_context/overflow')
+def bench_trim_overflow(app, data):
+    return lambda: app.trim_context(data['context_overflow'], data['global_memory'])
+
+
+for _kind in ('short', 'long', 'adversarial_question', 'adversarial_mixed'):
+    benchmark(f'detect_privacy_issues/{_kind}')(
+        lambda app, data, kind=_kind: lambda: app.detect_privacy_issues(data[kind]))
+    benchmark(f'detect_persona_questions/{_kind}')(
+        lambda app, data, kind=_kind: lambda: app.detect_persona_questions(data[kind]))
+    benchmark(f'analyze_emotion/{_kind}')(
+        lambda app, data, kind=_kind: lambda: app.analyze_emotion(data[kind]))
+
+
+@benchmark('calculate_xiaobu_emotion/global')
+def bench_xiaobu_emotion(app, data):
+    return lambda: app.calculate_xiaobu_emotion()
+
+
+@benchmark('calculate_xiaobu_emotion/client')
+def bench_xiaobu_emotion_client(app, data):
+    return lambda: app.calculate_xiaobu_emotion('micro-bench-client')
+
+
+@benchmark('generate_emotion_prompt')
+def bench_emotion_prompt(app, data):
+    emotion_state = app.calculate_xiaobu_emotion()
+    return lambda: app.generate_emotion_prompt(emotion_state, is_long_message=True)
+
+
+for _size in HISTORY_SIZES:
+    def _setup_save(app, data, size=_size):
+        client_id = f'micro-{size}'
+        return lambda: app.save_data(client_id, data['histories'][size])
+
+    def _setup_load(app, data, size=_size):
+        client_id = f'micro-{size}'
+        app.save_data(client_id, data['histories'][size])
+        return lambda: app.load_data(client_id)
+
+    benchmark(f'save_data/{_size}')(_setup_save)
+    benchmark(f'load_data/{_size}')(_setup_load)
+
+
+@benchmark('get_client_id')
+def bench_client_id(app, data):
+    context = app.app.test_request_context('/api/chat', headers={
+        'User-Agent': 'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148',
+        'Accept-Language': 'zh-CN,zh;q=0.9', 'Accept-Encoding': 'gzip, deflate, br'})
+    context.push()
+    return app.get_client_id
+
+
+def import_app(workdir):
+    """在临时目录中导入app，数据文件都写到临时目录下"""
+    for name in ('xiaobu.md', 'weather_stub.json'):
+        if os.path.exists(os.path.join(ROOT, name)):
+            shutil.copy(os.path.join(ROOT, name), workdir)
+    os.chdir(workdir)
+    os.environ.setdefault('XIAOBU_LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, ROOT)
+    import app
+    app.ensure_data_dir()
+    return app
+
+
+def measure(func, repeat):
+    """返回单次调用耗时（秒）的最小值、中位数及每轮循环次数"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = [elapsed / number for elapsed in timer.repeat(repeat=repeat, number=number)]
+    return {'min': min(times), 'median': statistics.median(times), 'loops': number}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def format_seconds(value):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if value >= scale:
+            return f'{value / scale:.2f}{unit}'
+    return f'{value / 1e-9:.0f}ns'
+
+
+def compare(results, baseline, threshold):
+    """对比两次结果，返回变慢超过阈值的基准名列表"""
+    regressions = []
+    print(f"\n{'benchmark':<44} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, current in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f'{name:<44} {"-":>10} {format_seconds(current["min"]):>10} {"new":>8}')
+            continue
+        change = current['min'] / before['min'] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif change < -threshold:
+            flag = '  faster'
+        print(f'{name:<44} {format_seconds(before["min"]):>10} {format_seconds(current["min"]):>10} '
+              f'{change:>+7.1%}{flag}')
+    for name in baseline:
+        if name not in results:
+            print(f'{name:<44} {format_seconds(baseline[name]["min"]):>10} {"-":>10} {"missing":>8}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='热点函数微基准')
+    parser.add_argument('--filter', help='只运行名称包含该字符串的基准')
+    parser.add_argument('--repeat', type=int, default=5, help='每项重复测量次数')
+    parser.add_argument('--save', help='把结果写入该JSON文件作为基线')
+    parser.add_argument('--compare', help='与该基线JSON文件对比')
+    parser.add_argument('--threshold', type=float, default=0.2, help='判定为回归的变慢比例，默认0.2即20%%')
+    parser.add_argument('--seed', type=int, default=SEED)
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('seed') != args.seed:
+            print(f"警告: 基线使用的种子为{baseline.get('seed')}，输入数据不同", file=sys.stderr)
+    save_path = os.path.abspath(args.save) if args.save else None
+
+    workdir = tempfile.mkdtemp(prefix='xiaobu-micro-')
+    try:
+        app = import_app(workdir)
+        data = build_inputs(args.seed)
+        results = {}
+        for name, setup in BENCHMARKS:
+            if args.filter and args.filter not in name:
+                continue
+            results[name] = measure(setup(app, data), args.repeat)
+            print(f"{name:<44} {format_seconds(results[name]['min']):>10}  "
+                  f"(median {format_seconds(results[name]['median'])}, {results[name]['loops']} loops)")
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if save_path:
+        report = {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'seed': args.seed,
+            'results': results,
+        }
+        with open(save_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        print(f'\n基线已写入 {save_path}')
+
+    if baseline is not None:
+        expected = {name: value for name, value in baseline['results'].items()
+                    if not args.filter or args.filter in name}
+        regressions = compare(results, expected, args.threshold)
+        if regressions:
+            print(f'\n{len(regressions)} 项变慢超过 {args.threshold:.0%}: {", ".join(regressions)}')
+            sys.exit(1)
+        print(f'\n没有变慢超过 {args.threshold:.0%} 的基准')
+
+
+if __name__ == '__main__':
+    main()
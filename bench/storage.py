@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""聊天数据存储的规模基准：上万客户端、长尾历史长度
+
+chat_data/ 下每个客户端一个JSON文件（app.save_data/load_data），文件数和单个文件大小都会无限增长。
+本脚本在临时目录中逐级生成合成语料（客户端数按--clients逐级增加，历史条数服从帕累托长尾分布），
+每一级测量：
+- 每轮对话的读取和保存耗时（load_data + 追加一问一答 + save_data），按历史长度分段统计p50/p95/p99
+- 目录查找开销：get_data_file + 文件存在性检查（命中和未命中）
+- 磁盘占用：逻辑大小、实际分配的块大小、最大文件
+- 内存：读取最大文件时的Python分配峰值（tracemalloc）和进程RSS
+
+每级报告每轮耗时p95是否超出--budget-ms，并给出超出预算的最短历史长度，用于判断在哪个规模、
+哪类用户上这种存储方式不再适用。测量在文件系统缓存已预热的情况下进行。
+
+用法:
+    python bench/storage.py --clients 1000,5000,10000 --turns 500
+    python bench/storage.py --clients 20000 --median-history 40 --max-history 20000 --json > storage.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import psutil
+
+from async_vs_threaded import percentile
+from micro import ROOT, import_app
+
+MESSAGES = ['今天过得怎么样', '作业写完了吗', '我今天考试考砸了，好难过', '周末想去哪里玩', '推荐一本书吧',
+            '最近好累啊，每天都要写到很晚', '你喜欢什么颜色', '我和朋友吵架了，不知道该怎么办']
+REPLIES = ['哈哈，今天还行吧，就是作业有点多', '别难过啦，下次一定可以的！我考砸的时候也会很郁闷，但是过两天就好了',
+           '我最喜欢蓝色，看着就很舒服', '可以试试先冷静一下，然后找个机会好好聊聊，朋友之间误会说开就好了']
+LENGTH_BUCKETS = (10, 100, 1000, 10000)
+
+
+def history_length(rng, median, alpha, maximum):
+    """帕累托分布的历史条数：多数客户端只聊过几轮，少数聊了上千轮"""
+    scale = median / 2 ** (1 / alpha)
+    return max(2, min(maximum, int(scale * rng.paretovariate(alpha))))
+
+
+def make_chat_data(rng, length):
+    history = []
+    for i in range(length):
+        user = i % 2 == 0
+        history.append({'type': 'user' if user else 'bot',
+                        'content': rng.choice(MESSAGES if user else REPLIES),
+                        'timestamp': f'2024-06-{1 + i // 1440 % 28:02d}T{i // 60 % 24:02d}:{i % 60:02d}:00'})
+    context = [f"{'用户' if item['type'] == 'user' else '助手'}: {item['content']}" for item in history[-60:]]
+    return {'context': context, 'history': history}
+
+
+def percentiles(values):
+    """p50/p95/p99（毫秒）和样本数"""
+    if not values:
+        return None
+    return {'p50': round(percentile(values, 0.5) * 1000, 3), 'p95': round(percentile(values, 0.95) * 1000, 3),
+            'p99': round(percentile(values, 0.99) * 1000, 3), 'count': len(values)}
+
+
+def bucket_of(length):
+    for limit in LENGTH_BUCKETS:
+        if length <= limit:
+            return f'<={limit}'
+    return f'>{LENGTH_BUCKETS[-1]}'
+
+
+def grow_corpus(app, clients, target, rng, args):
+    """把语料补充到target个客户端，返回本次生成耗时"""
+    start = time.perf_counter()
+    while len(clients) < target:
+        client_id = f'{len(clients):032x}'
+        length = history_length(rng, args.median_history, args.alpha, args.max_history)
+        app.save_data(client_id, make_chat_data(rng, length))
+        clients.append((client_id, length))
+    return time.perf_counter() - start
+
+
+def measure_turns(app, clients, rng, turns, traffic):
+    """挑选客户端模拟一轮对话，按历史长度分段统计读取、保存和整轮耗时
+
+    traffic为active时按历史条数加权挑选（聊得多的客户端发消息也多），uniform时均匀挑选。
+    """
+    weights = [length for _, length in clients] if traffic == 'active' else None
+    loads, saves, totals = {}, {}, {}
+    for index in rng.choices(range(len(clients)), weights, k=turns):
+        client_id, length = clients[index]
+        start = time.perf_counter()
+        data = app.load_data(client_id)
+        loaded = time.perf_counter()
+        data['history'].append({'type': 'user', 'content': rng.choice(MESSAGES), 'timestamp': '2024-07-01T12:00:00'})
+        data['history'].append({'type': 'bot', 'content': rng.choice(REPLIES), 'timestamp': '2024-07-01T12:00:01'})
+        app.save_data(client_id, data)
+        saved = time.perf_counter()
+        clients[index] = (client_id, length + 2)
+        for series, value in ((loads, loaded - start), (saves, saved - loaded), (totals, saved - start)):
+            series.setdefault('all', []).append(value)
+            series.setdefault(bucket_of(length), []).append(value)
+    return loads, saves, totals
+
+
+def measure_lookup(app, clients, rng, samples=2000):
+    """get_data_file加存在性检查的平均耗时（微秒），分别统计已有客户端和新客户端"""
+    existing = [clients[rng.randrange(len(clients))][0] for _ in range(samples)]
+    missing = [f'{rng.getrandbits(128):032x}' for _ in range(samples)]
+    result = {}
+    for name, ids in (('hit_us', existing), ('miss_us', missing)):
+        start = time.perf_counter()
+        for client_id in ids:
+            os.path.exists(app.get_data_file(client_id))
+        result[name] = round((time.perf_counter() - start) / samples * 1e6, 2)
+    return result
+
+
+def measure_disk(data_dir):
+    logical = allocated = largest = files = 0
+    with os.scandir(data_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith('chat_') and entry.is_file():
+                stat = entry.stat()
+                files += 1
+                logical += stat.st_size
+                allocated += stat.st_blocks * 512
+                largest = max(largest, stat.st_size)
+    start = time.perf_counter()
+    with os.scandir(data_dir) as entries:
+        sum(1 for _ in entries)
+    return {
+        'files': files,
+        'logical_mb': round(logical / 1024 / 1024, 2),
+        'allocated_mb': round(allocated / 1024 / 1024, 2),
+        'largest_file_mb': round(largest / 1024 / 1024, 3),
+        'scan_directory_ms': round((time.perf_counter() - start) * 1000, 3),
+    }
+
+
+def measure_memory(app, clients):
+    """读取历史最长的客户端文件时的Python分配峰值"""
+    client_id, length = max(clients, key=lambda item: item[1])
+    tracemalloc.start()
+    app.load_data(client_id)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'largest_history': length,
+        'load_peak_mb': round(peak / 1024 / 1024, 2),
+        'process_rss_mb': round(psutil.Process().memory_info().rss / 1024 / 1024, 1),
+    }
+
+
+def first_bucket_over_budget(totals, budget_ms):
+    """返回整轮耗时p95超出预算的最短历史长度分段"""
+    for limit in LENGTH_BUCKETS + (None,):
+        bucket = f'<={limit}' if limit is not None else f'>{LENGTH_BUCKETS[-1]}'
+        stats = percentiles(totals.get(bucket, []))
+        if stats and stats['p95'] > budget_ms:
+            return bucket
+    return None
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    steps = sorted(int(value) for value in args.clients.split(','))
+    workdir = os.path.abspath(tempfile.mkdtemp(prefix='xiaobu-storage-', dir=args.dir))
+    try:
+        app = import_app(workdir)
+        clients = []
+        report = {
+            'storage_mode': 'json-per-client',
+            'config': {'clients': steps, 'median_history': args.median_history, 'alpha': args.alpha,
+                       'max_history': args.max_history, 'turns': args.turns, 'traffic': args.traffic,
+                       'budget_ms': args.budget_ms,
+                       'seed': args.seed, 'filesystem_dir': workdir},
+            'steps': [],
+        }
+        for target in steps:
+            generate_seconds = grow_corpus(app, clients, target, rng, args)
+            loads, saves, totals = measure_turns(app, clients, rng, args.turns, args.traffic)
+            turn_p95 = percentiles(totals['all'])['p95']
+            lengths = [length for _, length in clients]
+            report['steps'].append({
+                'clients': target,
+                'history_length': {'median': statistics.median(lengths), 'mean': round(statistics.mean(lengths), 1),
+                                   'max': max(lengths), 'total_entries': sum(lengths)},
+                'generate_seconds': round(generate_seconds, 2),
+                'load_ms': {bucket: percentiles(values) for bucket, values in sorted(loads.items())},
+                'save_ms': {bucket: percentiles(values) for bucket, values in sorted(saves.items())},
+                'turn_ms': {bucket: percentiles(values) for bucket, values in sorted(totals.items())},
+                'lookup': measure_lookup(app, clients, rng),
+                'disk': measure_disk(app.DATA_DIR),
+                'memory': measure_memory(app, clients),
+                'within_budget': turn_p95 <= args.budget_ms,
+                'over_budget_from_history': first_bucket_over_budget(totals, args.budget_ms),
+            })
+            if not args.json:
+                print_step(report['steps'][-1], args.budget_ms)
+        return report
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_step(step, budget_ms):
+    turn = step['turn_ms']['all']
+    print(f"\n[{step['clients']} 个客户端] 历史条数 中位数{step['history_length']['median']} "
+          f"最大{step['history_length']['max']}，生成耗时 {step['generate_seconds']}s")
+    status = f'在{budget_ms}ms预算内' if step['within_budget'] else f'超出{budget_ms}ms预算'
+    print(f"  每轮(读+存) p50={turn['p50']}ms p95={turn['p95']}ms p99={turn['p99']}ms {status}")
+    for bucket, stats in step['turn_ms'].items():
+        if bucket != 'all':
+            print(f"    历史{bucket:<8} p95={stats['p95']}ms  (读 {step['load_ms'][bucket]['p95']}ms, "
+                  f"存 {step['save_ms'][bucket]['p95']}ms, {stats['count']}轮)")
+    if step['over_budget_from_history']:
+        print(f"  历史条数{step['over_budget_from_history']}的客户端每轮p95超出预算")
+    print(f"  目录查找 命中{step['lookup']['hit_us']}us 未命中{step['lookup']['miss_us']}us，"
+          f"扫描目录 {step['disk']['scan_directory_ms']}ms")
+    print(f"  磁盘 {step['disk']['files']}个文件 逻辑{step['disk']['logical_mb']}MB "
+          f"实际占用{step['disk']['allocated_mb']}MB 最大文件{step['disk']['largest_file_mb']}MB")
+    print(f"  内存 读取最长历史({step['memory']['largest_history']}条)峰值{step['memory']['load_peak_mb']}MB，"
+          f"进程RSS {step['memory']['process_rss_mb']}MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='聊天数据存储规模基准')
+    parser.add_argument('--clients', default='1000,5000,10000', help='逐级增加的客户端数，逗号分隔')
+    parser.add_argument('--median-history', type=int, default=20, help='历史条数的中位数')
+    parser.add_argument('--alpha', type=float, default=1.1, help='帕累托分布的形状参数，越小长尾越重')
+    parser.add_argument('--max-history', type=int, default=20000, help='单个客户端历史条数上限')
+    parser.add_argument('--turns', type=int, default=500, help='每级模拟的对话轮数')
+    parser.add_argument('--traffic', choices=['active', 'uniform'], default='active',
+                        help='active按历史条数加权挑选发消息的客户端，uniform均匀挑选')
+    parser.add_argument('--budget-ms', type=float, default=50.0, help='每轮读写耗时p95的预算（毫秒）')
+    parser.add_argument('--dir', help='生成语料的目录（默认系统临时目录），用于测试不同的文件系统')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', action='store_true', help='以JSON输出完整报告')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""对比逐个对象循环的StudentBrain与向量化的BatchStudentBrain
+
+两种引擎用同一份学期作息模拟N个学生，比较耗时，并检查统计上是否一致：
+每个时间点所有学生的平均唤醒度/愉悦度之差是否在抽样误差范围内（逐点z检验），
+以及学期结束时两组唤醒度/愉悦度分布的两样本KS统计量是否低于α=0.01的临界值。
+
+用法:
+    python bench/student_brain.py --students 10000
+    python bench/student_brain.py --students 100000 --loop-students 10000 --json
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import sim
+
+
+def semester_events(weeks):
+    """每周的输入列表：[(周数, [事件字典, ...]), ...]"""
+    return [(week, [event for day in sim.generate_week_schedule(week, None).values() for event in day])
+            for week in range(1, weeks + 1)]
+
+
+def run_loop(students, schedule, seed):
+    """逐个学生调用StudentBrain.step，返回每个时间点的(唤醒度均值, 方差, 愉悦度均值, 方差)和最终状态"""
+    random.seed(seed)
+    brains = [sim.StudentBrain(base_arousal=0.6, base_valence=0.7) for _ in range(students)]
+    moments = []
+    for week, events in schedule:
+        for brain in brains:
+            brain.update_adaptation(week)
+        for event in events:
+            arousal = valence = arousal_sq = valence_sq = 0.0
+            for brain in brains:
+                a, v = brain.step(event)
+                arousal += a
+                valence += v
+                arousal_sq += a * a
+                valence_sq += v * v
+            mean_a, mean_v = arousal / students, valence / students
+            moments.append((mean_a, arousal_sq / students - mean_a ** 2, mean_v, valence_sq / students - mean_v ** 2))
+        for brain in brains:
+            brain.reset_weekly_stress()
+    final = (np.array([brain.arousal for brain in brains]), np.array([brain.valence for brain in brains]))
+    return np.array(moments), final
+
+
+def run_batch(students, schedule, seed):
+    brains = sim.BatchStudentBrain(students, base_arousal=0.6, base_valence=0.7, seed=seed)
+    moments = []
+    for week, events in schedule:
+        brains.update_adaptation(week)
+        for vector in (sim.event_vector(event) for event in events):
+            arousal, valence = brains.step(vector)
+            moments.append((arousal.mean(), arousal.var(), valence.mean(), valence.var()))
+        brains.reset_weekly_stress()
+    return np.array(moments), (brains.arousal.copy(), brains.valence.copy())
+
+
+def ks_statistic(a, b):
+    """两样本Kolmogorov-Smirnov统计量"""
+    a, b = np.sort(a), np.sort(b)
+    values = np.concatenate([a, b])
+    cdf_a = np.searchsorted(a, values, side='right') / len(a)
+    cdf_b = np.searchsorted(b, values, side='right') / len(b)
+    return float(np.max(np.abs(cdf_a - cdf_b)))
+
+
+def compare(loop, batch, loop_n, batch_n):
+    """逐点比较两组均值（z值），并对最终分布做KS检验"""
+    (loop_moments, loop_final), (batch_moments, batch_final) = loop, batch
+    report = {}
+    for name, mean_col, var_col, index in (('arousal', 0, 1, 0), ('valence', 2, 3, 1)):
+        diff = batch_moments[:, mean_col] - loop_moments[:, mean_col]
+        standard_error = np.sqrt(loop_moments[:, var_col] / loop_n + batch_moments[:, var_col] / batch_n)
+        z = np.abs(diff) / np.maximum(standard_error, 1e-12)
+        # 时间点很多，逐点检验按Bonferroni校正取整体α=0.01对应的z阈值
+        z_limit = 4.5 if len(z) > 100 else 3.3
+        ks = ks_statistic(loop_final[index], batch_final[index])
+        ks_limit = 1.628 * math.sqrt((loop_n + batch_n) / (loop_n * batch_n))
+        report[name] = {
+            'max_mean_diff': round(float(np.max(np.abs(diff))), 5),
+            'max_z': round(float(np.max(z)), 2),
+            'z_limit': z_limit,
+            'final_ks': round(ks, 4),
+            'ks_limit': round(ks_limit, 4),
+            'consistent': bool(np.max(z) < z_limit and ks < ks_limit),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='StudentBrain循环与向量化引擎对比')
+    parser.add_argument('--students', type=int, default=10000, help='向量化引擎模拟的学生数')
+    parser.add_argument('--loop-students', type=int, help='循环引擎模拟的学生数（默认与--students相同）')
+    parser.add_argument('--weeks', type=int, default=18)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', action='store_true', help='以JSON输出结果')
+    args = parser.parse_args()
+    loop_n = args.loop_students or args.students
+
+    schedule = semester_events(args.weeks)
+    slots = sum(len(events) for _, events in schedule)
+
+    start = time.perf_counter()
+    loop = run_loop(loop_n, schedule, args.seed)
+    loop_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = run_batch(args.students, schedule, args.seed + 1)
+    batch_seconds = time.perf_counter() - start
+
+    loop_rate = loop_n * slots / loop_seconds
+    batch_rate = args.students * slots / batch_seconds
+    report = {
+        'weeks': args.weeks,
+        'time_slots': slots,
+        'loop': {'students': loop_n, 'seconds': round(loop_seconds, 3), 'student_steps_per_second': round(loop_rate)},
+        'batch': {'students': args.students, 'seconds': round(batch_seconds, 3),
+                  'student_steps_per_second': round(batch_rate)},
+        'speedup': round(batch_rate / loop_rate, 1),
+        'statistics': compare(loop, batch, loop_n, args.students),
+    }
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    print(f"{args.weeks}周 x {slots // args.weeks}个时间点/周")
+    print(f"循环引擎     {loop_n:>7}个学生  {loop_seconds:8.3f}s  {loop_rate:>12,.0f} 学生步/秒")
+    print(f"向量化引擎   {args.students:>7}个学生  {batch_seconds:8.3f}s  {batch_rate:>12,.0f} 学生步/秒")
+    print(f"加速比 {report['speedup']}x")
+    for name, stats in report['statistics'].items():
+        print(f"{name}: 均值最大差 {stats['max_mean_diff']} (max z={stats['max_z']}, 阈值{stats['z_limit']}), "
+              f"最终分布KS={stats['final_ks']} (阈值{stats['ks_limit']}) -> {'一致' if stats['consistent'] else '不一致'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,26 @@
-import matplotlib.pyplot as plt
+"""学生情绪模拟
+
+StudentBrain逐个时间点模拟一名学生的唤醒度和愉悦度，BatchStudentBrain用NumPy同时模拟N名学生。
+simulate()以生成器逐条产出情绪事件，可边生成边写出为CSV或JSON Lines并流式汇总，
+多学期、多学生的长时间模拟内存占用保持不变；matplotlib只在绘图时导入并使用Agg后端。
+
+用法:
+    python sim.py                                        # 模拟一个学期并打印报告
+    python sim.py --semesters 6 --students 100 --output events.csv --plot semester.png
+    python sim.py --output - --format jsonl --seed 1 | head
+"""
+import argparse
+import csv
+import json
 import random
-import matplotlib
+import sys
 import numpy as np
-from datetime import datetime, timedelta
-matplotlib.rcParams['font.sans-serif'] = ['SimHei', 'Arial Unicode MS', 'DejaVu Sans']
-matplotlib.rcParams['axes.unicode_minus'] = False
 
 class StudentBrain:
     """学生大脑情绪模拟器"""
     
-    def __init__(self, base_arousal=0.5, base_valence=0.5):
+    def __init__(self, base_arousal=0.5, base_valence=0.5, rng=None):
+        self.rng = rng or random     # 随机数来源，传入random.Random实例可复现
         self.arousal = base_arousal  # 唤醒度 (0-1)
         self.valence = base_valence  # 愉悦度 (0-1)
         self.stress_level = 0.2     # 压力水平
@@ -55,8 +66,8 @@ class StudentBrain:
         self.valence -= adaptation_effect
         
         # 青春期随机波动
-        self.arousal += random.uniform(-0.05, 0.05)
-        self.valence += random.uniform(-0.05, 0.05)
+        self.arousal += self.rng.uniform(-0.05, 0.05)
+        self.valence += self.rng.uniform(-0.05, 0.05)
         
         # 确保在有效范围内
         self.arousal = max(0, min(1, self.arousal))
@@ -83,6 +94,82 @@ class StudentBrain:
         self.semester_stress = 0.0
         self.adaptation_level = 1.0
 
+# StudentBrain.step读取的输入因子，BatchStudentBrain的输入矩阵按此顺序排列各列
+INPUT_FACTORS = ('task_pressure', 'fatigue', 'dopamine', 'control_sense', 'social_factor',
+                 'achievement', 'weekend_factor', 'season_factor', 'exam_factor', 'holiday_factor')
+
+def event_vector(event):
+    """把StudentBrain使用的输入字典转换为按INPUT_FACTORS排列的向量"""
+    return np.array([event.get(name, 0) for name in INPUT_FACTORS], dtype=float)
+
+class BatchStudentBrain:
+    """N个学生的向量化情绪模拟器
+
+    各状态量是长度为N的数组，每一步的更新规则与StudentBrain相同，
+    青春期随机波动由带种子的numpy Generator生成，因此统计上与逐个模拟StudentBrain一致。
+    """
+    
+    def __init__(self, n, base_arousal=0.5, base_valence=0.5, seed=None):
+        self.n = n
+        self.rng = np.random.default_rng(seed)
+        self.arousal = np.broadcast_to(np.asarray(base_arousal, dtype=float), (n,)).copy()
+        self.valence = np.broadcast_to(np.asarray(base_valence, dtype=float), (n,)).copy()
+        self.stress_level = np.full(n, 0.2)
+        self.fatigue = np.full(n, 0.1)
+        self.weekly_stress = np.zeros(n)
+        self.semester_stress = np.zeros(n)
+        self.adaptation_level = np.ones(n)
+    
+    def step(self, inputs):
+        """根据输入更新所有学生的情绪状态，返回(arousal, valence)数组
+        
+        inputs为形状(N, len(INPUT_FACTORS))的矩阵（每个学生一行），
+        或长度为len(INPUT_FACTORS)的向量（所有学生相同输入）。
+        """
+        inputs = np.asarray(inputs, dtype=float)
+        (task_pressure, fatigue, dopamine, control_sense, social_factor,
+         achievement, weekend_factor, season_factor, exam_factor, holiday_factor) = inputs.T
+        
+        # 更新压力累积
+        self.weekly_stress = np.clip(self.weekly_stress + task_pressure * 0.1, 0, 1)
+        self.semester_stress = np.clip(self.semester_stress + task_pressure * 0.02, 0, 1)
+        
+        # 更新唤醒度和愉悦度
+        arousal_change = (task_pressure * 0.3 + dopamine * 0.4 - fatigue * 0.3
+                          - self.weekly_stress * 0.1 + exam_factor * 0.3 - holiday_factor * 0.2)
+        arousal = np.clip(self.arousal + arousal_change * 0.3, 0, 1)
+        valence_change = (control_sense * 0.3 + social_factor * 0.2 + achievement * 0.4
+                          - task_pressure * 0.2 + weekend_factor * 0.3 + season_factor * 0.2
+                          - exam_factor * 0.2 + holiday_factor * 0.4)
+        valence = np.clip(self.valence + valence_change * 0.3, 0, 1)
+        
+        # 适应性调整和青春期随机波动
+        adaptation_effect = (1 - self.adaptation_level) * 0.1
+        arousal += adaptation_effect + self.rng.uniform(-0.05, 0.05, self.n)
+        valence += -adaptation_effect + self.rng.uniform(-0.05, 0.05, self.n)
+        
+        np.clip(arousal, 0, 1, out=arousal)
+        np.clip(valence, 0, 1, out=valence)
+        self.arousal, self.valence = arousal, valence
+        return self.arousal, self.valence
+    
+    def reset_weekly_stress(self):
+        """周末重置累积压力"""
+        self.weekly_stress *= 0.3
+    
+    def update_adaptation(self, week_num):
+        """更新学期适应程度（week_num可以是标量或每个学生各自的周数数组）"""
+        week_num = np.broadcast_to(np.asarray(week_num, dtype=float), (self.n,))
+        self.adaptation_level = np.where(week_num <= 4, 0.3 + week_num * 0.15,
+                                         np.where(week_num <= 14, 0.9, 0.9 - (week_num - 14) * 0.1))
+    
+    def reset_semester(self):
+        """学期结束重置"""
+        self.semester_stress = np.zeros(self.n)
+        self.adaptation_level = np.ones(self.n)
+
+WEEKS_PER_SEMESTER = 18
+
 # 定义学期重要时间节点
 semester_events = {
     1: "学期开始,新环境适应",
@@ -203,183 +290,303 @@ def generate_week_schedule(week_num, student_brain):
     
     return base_schedule
 
-# 创建学生大脑实例
-student_brain = StudentBrain(base_arousal=0.6, base_valence=0.7)
-
-# 生成整个学期的情绪数据
-semester_data = []
-week_summaries = []
+# 情绪事件的字段，也是CSV的列顺序
+EVENT_FIELDS = ('Student', 'Semester', 'Week', 'Day', 'Time', 'Arousal', 'Valence',
+                'WeeklyStress', 'SemesterStress', 'Adaptation')
+EMOTION_CATEGORIES = ('兴奋开心', '疲惫低落', '心情愉快', '精神紧张', '压力很大', '情绪平静')
 
-print("正在生成学期情绪数据...")
-
-for week_num in range(1, 19):  # 18周学期
-    print(f"生成第{week_num}周数据...")
-    
-    # 更新适应程度
-    student_brain.update_adaptation(week_num)
-    
-    # 生成本周安排
-    week_schedule = generate_week_schedule(week_num, student_brain)
-    
-    week_emotions = []
-    week_stress_sum = 0
-    
-    # 模拟本周每一天
-    for day, schedule in week_schedule.items():
-        for event in schedule:
-            A, V = student_brain.step(event)
-            
-            emotion_entry = {
-                "Week": week_num,
-                "Day": day,
-                "Time": event["time"],
-                "Arousal": round(A, 2),
-                "Valence": round(V, 2),
-                "WeeklyStress": round(student_brain.weekly_stress, 2),
-                "SemesterStress": round(student_brain.semester_stress, 2),
-                "Adaptation": round(student_brain.adaptation_level, 2)
-            }
-            
-            semester_data.append(emotion_entry)
-            week_emotions.append(emotion_entry)
-            week_stress_sum += student_brain.weekly_stress
-    
-    # 周末重置压力
-    if week_num % 1 == 0:  # 每周重置
+def simulate_semester(student_brain, semester=1, student=1, weeks=WEEKS_PER_SEMESTER):
+    """模拟一个学期，逐条生成情绪事件"""
+    for week_num in range(1, weeks + 1):
+        # 更新适应程度
+        student_brain.update_adaptation(week_num)
+        
+        # 模拟本周每一天
+        for day, schedule in generate_week_schedule(week_num, student_brain).items():
+            for event in schedule:
+                A, V = student_brain.step(event)
+                yield {
+                    "Student": student,
+                    "Semester": semester,
+                    "Week": week_num,
+                    "Day": day,
+                    "Time": event["time"],
+                    "Arousal": round(A, 2),
+                    "Valence": round(V, 2),
+                    "WeeklyStress": round(student_brain.weekly_stress, 2),
+                    "SemesterStress": round(student_brain.semester_stress, 2),
+                    "Adaptation": round(student_brain.adaptation_level, 2)
+                }
+        
+        # 周末重置压力
         student_brain.reset_weekly_stress()
-    
-    # 计算本周摘要
-    week_avg_arousal = sum([e["Arousal"] for e in week_emotions]) / len(week_emotions)
-    week_avg_valence = sum([e["Valence"] for e in week_emotions]) / len(week_emotions)
-    week_max_stress = max([e["WeeklyStress"] for e in week_emotions])
-    
-    week_summary = {
-        "week": week_num,
-        "avg_arousal": round(week_avg_arousal, 2),
-        "avg_valence": round(week_avg_valence, 2),
-        "max_stress": round(week_max_stress, 2),
-        "semester_stress": round(student_brain.semester_stress, 2),
-        "adaptation": round(student_brain.adaptation_level, 2),
-        "event": semester_events.get(week_num, "正常学习周")
-    }
-    
-    week_summaries.append(week_summary)
-
-print(f"学期数据生成完成! 共{len(semester_data)}个数据点")
-
-# 数据可视化
-# 1. 学期整体趋势图
-weeks = [w["week"] for w in week_summaries]
-week_arousal = [w["avg_arousal"] for w in week_summaries]
-week_valence = [w["avg_valence"] for w in week_summaries]
-week_stress = [w["semester_stress"] for w in week_summaries]
-week_adaptation = [w["adaptation"] for w in week_summaries]
-
-fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, figsize=(20, 12))
-
-# 子图1: 学期情绪趋势
-ax1.plot(weeks, week_arousal, marker='o', label="平均唤醒度", linewidth=3, markersize=6, color='red')
-ax1.plot(weeks, week_valence, marker='s', label="平均愉悦度", linewidth=3, markersize=6, color='blue')
-ax1.set_xlabel("学期周数", fontsize=12)
-ax1.set_ylabel("情绪数值", fontsize=12)
-ax1.set_title("学期18周情绪变化趋势", fontsize=14, fontweight='bold')
-ax1.grid(True, alpha=0.3)
-ax1.legend(fontsize=11)
 
-# 标注重要事件
-event_weeks = [1, 3, 8, 16, 17, 18]
-for week in event_weeks:
-    if week <= len(weeks):
-        ax1.axvline(x=week, color='gray', linestyle='--', alpha=0.5)
-        ax1.text(week, 0.9, semester_events[week][:6], rotation=90, fontsize=8)
+def simulate(students=1, semesters=1, seed=None, base_arousal=0.6, base_valence=0.7):
+    """依次模拟每名学生的连续多个学期，逐条生成情绪事件"""
+    rng = random.Random(seed)
+    for student in range(1, students + 1):
+        student_brain = StudentBrain(base_arousal=base_arousal, base_valence=base_valence, rng=rng)
+        for semester in range(1, semesters + 1):
+            yield from simulate_semester(student_brain, semester, student)
+            student_brain.reset_semester()
 
-# 子图2: 压力累积和适应度
-ax2.plot(weeks, week_stress, marker='^', label="学期累积压力", linewidth=3, color='orange')
-ax2.plot(weeks, week_adaptation, marker='v', label="适应程度", linewidth=3, color='green')
-ax2.set_xlabel("学期周数", fontsize=12)
-ax2.set_ylabel("数值", fontsize=12)
-ax2.set_title("压力累积与适应程度变化", fontsize=14, fontweight='bold')
-ax2.grid(True, alpha=0.3)
-ax2.legend(fontsize=11)
+def write_csv(events, fp):
+    """把事件逐条写成CSV，同时原样传出，便于继续汇总"""
+    writer = csv.DictWriter(fp, fieldnames=EVENT_FIELDS)
+    writer.writeheader()
+    for entry in events:
+        writer.writerow(entry)
+        yield entry
 
-# 子图3: 每周情绪分布箱型图
-week_nums = list(range(1, 19))
-arousal_data = []
-valence_data = []
+def write_jsonl(events, fp):
+    """把事件逐条写成JSON Lines，同时原样传出"""
+    for entry in events:
+        fp.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        yield entry
 
-for week in week_nums:
-    week_data = [e for e in semester_data if e["Week"] == week]
-    arousal_data.append([e["Arousal"] for e in week_data])
-    valence_data.append([e["Valence"] for e in week_data])
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl}
 
-ax3.boxplot(arousal_data, positions=week_nums, widths=0.6)
-ax3.set_xlabel("学期周数", fontsize=12)
-ax3.set_ylabel("唤醒度分布", fontsize=12)
-ax3.set_title("每周唤醒度分布情况", fontsize=14, fontweight='bold')
-ax3.grid(True, alpha=0.3)
-
-# 子图4: 情绪状态分类统计
-emotion_counts = {"兴奋开心": 0, "疲惫低落": 0, "心情愉快": 0, "精神紧张": 0, "压力很大": 0, "情绪平静": 0}
-
-for entry in semester_data:
+def classify_emotion(entry):
+    """情绪状态分类"""
     if entry["Arousal"] > 0.7 and entry["Valence"] > 0.7:
-        emotion_counts["兴奋开心"] += 1
+        return "兴奋开心"
     elif entry["Arousal"] < 0.4 and entry["Valence"] < 0.4:
-        emotion_counts["疲惫低落"] += 1
+        return "疲惫低落"
     elif entry["Valence"] > 0.7:
-        emotion_counts["心情愉快"] += 1
+        return "心情愉快"
     elif entry["Arousal"] > 0.7:
-        emotion_counts["精神紧张"] += 1
+        return "精神紧张"
     elif entry["SemesterStress"] > 0.6:
-        emotion_counts["压力很大"] += 1
+        return "压力很大"
     else:
-        emotion_counts["情绪平静"] += 1
-
-emotions = list(emotion_counts.keys())
-counts = list(emotion_counts.values())
-colors = ['#ff9999', '#66b3ff', '#99ff99', '#ffcc99', '#ff99cc', '#c2c2f0']
-
-ax4.pie(counts, labels=emotions, autopct='%1.1f%%', colors=colors, startangle=90)
-ax4.set_title("学期情绪状态分布", fontsize=14, fontweight='bold')
-
-plt.tight_layout()
-plt.show()
+        return "情绪平静"
 
-# 打印学期摘要报告
-print("\n" + "="*60)
-print("🎓 学期情绪分析报告")
-print("="*60)
-
-print(f"\n📊 整体统计:")
-semester_avg_arousal = sum([e["Arousal"] for e in semester_data]) / len(semester_data)
-semester_avg_valence = sum([e["Valence"] for e in semester_data]) / len(semester_data)
-max_semester_stress = max([e["SemesterStress"] for e in semester_data])
-
-print(f"学期平均唤醒度: {semester_avg_arousal:.2f}")
-print(f"学期平均愉悦度: {semester_avg_valence:.2f}")
-print(f"最大学期压力: {max_semester_stress:.2f}")
+class SemesterStats:
+    """按学期周次流式汇总情绪事件，内存占用与事件数无关
+    
+    多名学生、多个学期的同一周合并统计：均值取所有事件的平均，周末状态（学期压力、适应程度）取各学期周末值的平均。
+    唤醒度按0.01精度分桶计数（事件值已保留两位小数），箱型图的分位数由分桶计数得出。
+    """
+    
+    def __init__(self, weeks=WEEKS_PER_SEMESTER):
+        self.weeks = weeks
+        self.count = 0
+        self.arousal_sum = 0.0
+        self.valence_sum = 0.0
+        self.max_semester_stress = 0.0
+        self.emotion_counts = {name: 0 for name in EMOTION_CATEGORIES}
+        self.week_count = np.zeros(weeks + 1, dtype=np.int64)
+        self.week_arousal = np.zeros(weeks + 1)
+        self.week_valence = np.zeros(weeks + 1)
+        self.week_max_stress = np.zeros(weeks + 1)
+        self.week_end_runs = np.zeros(weeks + 1, dtype=np.int64)
+        self.week_end_stress = np.zeros(weeks + 1)
+        self.week_end_adaptation = np.zeros(weeks + 1)
+        self.arousal_histogram = np.zeros((weeks + 1, 101), dtype=np.int64)
+        self._last = None
+    
+    def add(self, entry):
+        week = entry["Week"]
+        if self._last is not None and self._run_key(self._last) != self._run_key(entry):
+            self._close_week()
+        self._last = entry
+        
+        self.count += 1
+        self.arousal_sum += entry["Arousal"]
+        self.valence_sum += entry["Valence"]
+        self.max_semester_stress = max(self.max_semester_stress, entry["SemesterStress"])
+        self.emotion_counts[classify_emotion(entry)] += 1
+        self.week_count[week] += 1
+        self.week_arousal[week] += entry["Arousal"]
+        self.week_valence[week] += entry["Valence"]
+        self.week_max_stress[week] = max(self.week_max_stress[week], entry["WeeklyStress"])
+        self.arousal_histogram[week, int(round(entry["Arousal"] * 100))] += 1
+    
+    def consume(self, events):
+        for entry in events:
+            self.add(entry)
+        self._close_week()
+        return self
+    
+    @staticmethod
+    def _run_key(entry):
+        return entry["Student"], entry["Semester"], entry["Week"]
+    
+    def _close_week(self):
+        """记录上一周结束时的学期压力和适应程度"""
+        if self._last is None:
+            return
+        week = self._last["Week"]
+        self.week_end_runs[week] += 1
+        self.week_end_stress[week] += self._last["SemesterStress"]
+        self.week_end_adaptation[week] += self._last["Adaptation"]
+        self._last = None
+    
+    def week_summaries(self):
+        summaries = []
+        for week in range(1, self.weeks + 1):
+            if not self.week_count[week]:
+                continue
+            runs = max(self.week_end_runs[week], 1)
+            summaries.append({
+                "week": week,
+                "avg_arousal": round(self.week_arousal[week] / self.week_count[week], 2),
+                "avg_valence": round(self.week_valence[week] / self.week_count[week], 2),
+                "max_stress": round(float(self.week_max_stress[week]), 2),
+                "semester_stress": round(self.week_end_stress[week] / runs, 2),
+                "adaptation": round(self.week_end_adaptation[week] / runs, 2),
+                "event": semester_events.get(week, "正常学习周")
+            })
+        return summaries
+    
+    def arousal_boxplot_stats(self, week):
+        """由分桶计数得出某一周唤醒度的箱型图统计量（供Axes.bxp使用）"""
+        counts = self.arousal_histogram[week]
+        total = counts.sum()
+        cumulative = np.cumsum(counts)
+        quantile = lambda q: np.searchsorted(cumulative, q * total, side='left') / 100
+        q1, median, q3 = quantile(0.25), quantile(0.5), quantile(0.75)
+        present = np.nonzero(counts)[0] / 100
+        iqr = q3 - q1
+        inside = present[(present >= q1 - 1.5 * iqr) & (present <= q3 + 1.5 * iqr)]
+        return {'q1': q1, 'med': median, 'q3': q3, 'whislo': inside.min(), 'whishi': inside.max(),
+                'fliers': present[(present < q1 - 1.5 * iqr) | (present > q3 + 1.5 * iqr)]}
 
-print(f"\n📅 关键时期分析:")
-for week_summary in week_summaries:
-    if week_summary["week"] in semester_events:
-        print(f"第{week_summary['week']:2d}周 - {week_summary['event']:<15} | "
-              f"愉悦度: {week_summary['avg_valence']:.2f} | "
-              f"压力: {week_summary['semester_stress']:.2f} | "
-              f"适应: {week_summary['adaptation']:.2f}")
+def plot_summary(stats, path):
+    """绘制学期趋势、压力与适应、每周唤醒度分布和情绪状态分布，保存为图片"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    matplotlib.rcParams['font.sans-serif'] = ['SimHei', 'Arial Unicode MS', 'DejaVu Sans']
+    matplotlib.rcParams['axes.unicode_minus'] = False
+    
+    week_summaries = stats.week_summaries()
+    weeks = [w["week"] for w in week_summaries]
+    week_arousal = [w["avg_arousal"] for w in week_summaries]
+    week_valence = [w["avg_valence"] for w in week_summaries]
+    week_stress = [w["semester_stress"] for w in week_summaries]
+    week_adaptation = [w["adaptation"] for w in week_summaries]
+    
+    fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, figsize=(20, 12))
+    
+    # 子图1: 学期情绪趋势
+    ax1.plot(weeks, week_arousal, marker='o', label="平均唤醒度", linewidth=3, markersize=6, color='red')
+    ax1.plot(weeks, week_valence, marker='s', label="平均愉悦度", linewidth=3, markersize=6, color='blue')
+    ax1.set_xlabel("学期周数", fontsize=12)
+    ax1.set_ylabel("情绪数值", fontsize=12)
+    ax1.set_title(f"学期{stats.weeks}周情绪变化趋势", fontsize=14, fontweight='bold')
+    ax1.grid(True, alpha=0.3)
+    ax1.legend(fontsize=11)
+    
+    # 标注重要事件
+    event_weeks = [1, 3, 8, 16, 17, 18]
+    for week in event_weeks:
+        if week <= len(weeks):
+            ax1.axvline(x=week, color='gray', linestyle='--', alpha=0.5)
+            ax1.text(week, 0.9, semester_events[week][:6], rotation=90, fontsize=8)
+    
+    # 子图2: 压力累积和适应度
+    ax2.plot(weeks, week_stress, marker='^', label="学期累积压力", linewidth=3, color='orange')
+    ax2.plot(weeks, week_adaptation, marker='v', label="适应程度", linewidth=3, color='green')
+    ax2.set_xlabel("学期周数", fontsize=12)
+    ax2.set_ylabel("数值", fontsize=12)
+    ax2.set_title("压力累积与适应程度变化", fontsize=14, fontweight='bold')
+    ax2.grid(True, alpha=0.3)
+    ax2.legend(fontsize=11)
+    
+    # 子图3: 每周情绪分布箱型图
+    ax3.bxp([stats.arousal_boxplot_stats(week) for week in weeks], positions=weeks, widths=0.6)
+    ax3.set_xlabel("学期周数", fontsize=12)
+    ax3.set_ylabel("唤醒度分布", fontsize=12)
+    ax3.set_title("每周唤醒度分布情况", fontsize=14, fontweight='bold')
+    ax3.grid(True, alpha=0.3)
+    
+    # 子图4: 情绪状态分类统计
+    emotions = list(stats.emotion_counts.keys())
+    counts = list(stats.emotion_counts.values())
+    colors = ['#ff9999', '#66b3ff', '#99ff99', '#ffcc99', '#ff99cc', '#c2c2f0']
+    
+    ax4.pie(counts, labels=emotions, autopct='%1.1f%%', colors=colors, startangle=90)
+    ax4.set_title("学期情绪状态分布", fontsize=14, fontweight='bold')
+    
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
 
-print(f"\n🎯 情绪状态分布:")
-total_points = len(semester_data)
-for emotion, count in emotion_counts.items():
-    percentage = (count / total_points) * 100
-    print(f"{emotion}: {count}次 ({percentage:.1f}%)")
+def print_report(stats, file=sys.stdout):
+    """打印学期摘要报告"""
+    out = lambda *args: print(*args, file=file)
+    week_summaries = stats.week_summaries()
+    
+    out("\n" + "="*60)
+    out("🎓 学期情绪分析报告")
+    out("="*60)
+    
+    out(f"\n📊 整体统计:")
+    out(f"学期平均唤醒度: {stats.arousal_sum / stats.count:.2f}")
+    out(f"学期平均愉悦度: {stats.valence_sum / stats.count:.2f}")
+    out(f"最大学期压力: {stats.max_semester_stress:.2f}")
+    
+    out(f"\n📅 关键时期分析:")
+    for week_summary in week_summaries:
+        if week_summary["week"] in semester_events:
+            out(f"第{week_summary['week']:2d}周 - {week_summary['event']:<15} | "
+                f"愉悦度: {week_summary['avg_valence']:.2f} | "
+                f"压力: {week_summary['semester_stress']:.2f} | "
+                f"适应: {week_summary['adaptation']:.2f}")
+    
+    out(f"\n🎯 情绪状态分布:")
+    for emotion, count in stats.emotion_counts.items():
+        percentage = (count / stats.count) * 100
+        out(f"{emotion}: {count}次 ({percentage:.1f}%)")
+    
+    if len(week_summaries) == WEEKS_PER_SEMESTER:
+        out(f"\n📈 学期发展趋势:")
+        early_valence = sum([w["avg_valence"] for w in week_summaries[:6]]) / 6
+        mid_valence = sum([w["avg_valence"] for w in week_summaries[6:12]]) / 6
+        late_valence = sum([w["avg_valence"] for w in week_summaries[12:]]) / 6
+        
+        out(f"学期初期愉悦度 (1-6周): {early_valence:.2f}")
+        out(f"学期中期愉悦度 (7-12周): {mid_valence:.2f}")
+        out(f"学期后期愉悦度 (13-18周): {late_valence:.2f}")
+        out(f"中期相比初期: {mid_valence - early_valence:+.2f}")
+        out(f"后期相比中期: {late_valence - mid_valence:+.2f}")
 
-print(f"\n📈 学期发展趋势:")
-early_valence = sum([w["avg_valence"] for w in week_summaries[:6]]) / 6
-mid_valence = sum([w["avg_valence"] for w in week_summaries[6:12]]) / 6  
-late_valence = sum([w["avg_valence"] for w in week_summaries[12:]]) / 6
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='学生学期情绪模拟')
+    parser.add_argument('--students', type=int, default=1, help='模拟的学生数')
+    parser.add_argument('--semesters', type=int, default=1, help='每名学生连续模拟的学期数')
+    parser.add_argument('--seed', type=int, help='随机种子，指定后结果可复现')
+    parser.add_argument('--output', help='逐条写出情绪事件的文件，- 表示标准输出')
+    parser.add_argument('--format', choices=sorted(WRITERS), help='事件文件格式，默认按扩展名判断（.jsonl为JSON Lines，其余为CSV）')
+    parser.add_argument('--plot', help='把汇总图保存到该图片文件（如semester.png）')
+    parser.add_argument('--no-report', action='store_true', help='不打印摘要报告')
+    args = parser.parse_args(argv)
+    if args.students < 1 or args.semesters < 1:
+        parser.error('--students和--semesters至少为1')
+    
+    # 事件写到标准输出时，进度和报告改写到标准错误
+    console = sys.stderr if args.output == '-' else sys.stdout
+    print("正在生成学期情绪数据...", file=sys.stderr)
+    events = simulate(args.students, args.semesters, args.seed)
+    
+    output = None
+    if args.output:
+        output_format = args.format or ('jsonl' if args.output.endswith(('.jsonl', '.ndjson')) else 'csv')
+        output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8', newline='')
+        events = WRITERS[output_format](events, output)
+    try:
+        stats = SemesterStats().consume(events)
+    finally:
+        if output not in (None, sys.stdout):
+            output.close()
+    
+    print(f"学期数据生成完成! 共{stats.count}个数据点", file=sys.stderr)
+    if args.plot:
+        plot_summary(stats, args.plot)
+        print(f"汇总图已保存到 {args.plot}", file=sys.stderr)
+    if not args.no_report:
+        print_report(stats, console)
 
-print(f"学期初期愉悦度 (1-6周): {early_valence:.2f}")
-print(f"学期中期愉悦度 (7-12周): {mid_valence:.2f}")
-print(f"学期后期愉悦度 (13-18周): {late_valence:.2f}")
-print(f"中期相比初期: {mid_valence - early_valence:+.2f}")
-print(f"后期相比中期: {late_valence - mid_valence:+.2f}")
\ No newline at end of file
+if __name__ == '__main__':
+    main()